@@ -0,0 +1,128 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_bulk_load.py [rows] [round_trip_ms]
+#
+# Compares the previous insert_rows_json path (10,000-row streaming inserts) with
+# scripts/bq_bulk_load.py (local Parquet / NDJSON file + one load job) against a
+# local stand-in for the BigQuery client. The stand-in serializes request bodies
+# the way the client library does and sleeps round_trip_ms per API call, so the
+# numbers show client-side CPU plus request count, not BigQuery server time.
+
+import io
+import os, sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+
+from google.cloud import bigquery
+import bq_bulk_load
+
+
+class LocalBigQueryClient:
+    def __init__(self, round_trip_ms=50):
+        self.round_trip_ms = round_trip_ms
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference('benchmark-project', dataset_id)
+
+    def insert_rows_json(self, table_ref, rows):
+        body = json.dumps({'rows': [{'json': row} for row in rows]}).encode('utf-8')
+        return self._call(len(body), [])
+
+    def load_table_from_file(self, file, table_ref, job_config=None):
+        return self._call(len(file.read()), LocalLoadJob())
+
+    def _call(self, size, result):
+        self.requests += 1
+        self.bytes_sent += size
+        time.sleep(self.round_trip_ms / 1000)
+        return result
+
+
+class LocalLoadJob:
+    job_id = 'local-load-job'
+
+    def result(self):
+        return self
+
+
+SCHEMA = [bigquery.SchemaField(name, 'STRING', mode='NULLABLE') for name in (
+    'contentId', 'mediaId', 'title', 'runtime', 'formattedRuntime', 'logLine', 'releaseYear',
+    'studioId', 'actors', 'directors', 'genres', 'categories',
+)]
+
+
+def make_records(rows):
+    rng = random.Random(7)
+    words = ['space', 'crew', 'mission', 'moon', 'station', 'signal', 'orbit', 'storm', 'night', 'family']
+    return [
+        {
+            'contentId': f'{i}',
+            'mediaId': f'm{i}',
+            'title': ' '.join(rng.choices(words, k=3)).title(),
+            'runtime': f'{rng.randint(1200, 9000)}',
+            'formattedRuntime': '1h 30m',
+            'logLine': ' '.join(rng.choices(words, k=30)),
+            'releaseYear': f'{rng.randint(1970, 2024)}',
+            'studioId': f'{rng.randint(1, 50)}',
+            'actors': "['Actor One', 'Actor Two', 'Actor Three']",
+            'directors': "['Director One']",
+            'genres': "['Drama', 'Sci-Fi']",
+            'categories': "['Movies']",
+        }
+        for i in range(rows)
+    ]
+
+
+def streaming_inserts(client, records, batch_size=10000):
+    table_ref = client.dataset('lunar_data_ds').table('webdata')
+    for i in range(0, len(records), batch_size):
+        client.insert_rows_json(table_ref, records[i:i + batch_size])
+
+
+def bulk_load(client, records, source_format):
+    loader = bq_bulk_load.BulkLoader(client, 'lunar_data_ds', 'webdata', SCHEMA, source_format=source_format)
+    sys.stdout = io.StringIO()
+    try:
+        loader.load(iter(records))
+    finally:
+        sys.stdout = sys.__stdout__
+
+
+def run(name, fn, round_trip_ms):
+    client = LocalBigQueryClient(round_trip_ms)
+    start_time = time.perf_counter()
+    fn(client)
+    elapsed = time.perf_counter() - start_time
+    print(f'{name:<26} {elapsed*1000:10.1f} ms {client.requests:8d} requests {client.bytes_sent/1e6:10.2f} MB sent')
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    round_trip_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    records = make_records(rows)
+
+    print(f'Rows: {rows}, round trip: {round_trip_ms} ms')
+    run('insert_rows_json (before)', lambda client: streaming_inserts(client, records), round_trip_ms)
+    run('load job, NDJSON', lambda client: bulk_load(client, records, 'NEWLINE_DELIMITED_JSON'), round_trip_ms)
+    if bq_bulk_load.pa is not None:
+        run('load job, Parquet', lambda client: bulk_load(client, records, 'PARQUET'), round_trip_ms)
+    else:
+        print('load job, Parquet           skipped (pyarrow not installed)')
@@ -0,0 +1,103 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_burst.py [requests] [spread_seconds] [profile]
+#
+#   requests  Number of new users asking about the same notice (default 200)
+#   spread    Seconds over which their questions arrive (default 2)
+#   profile   Upstream latency profile from standins.PROFILES (default vertex)
+#
+# Replays the burst that follows an outage notice: first-turn /chat requests asking a
+# handful of phrasings of the same question, arriving uniformly over spread_seconds,
+# against the local stand-ins. Runs once with SINGLE_FLIGHT off and once with it on,
+# with the response cache and retrieval memo off so that only in-flight coalescing is
+# measured. Reports latency, upstream calls and the coalescing stats of /stats.
+
+import os, sys
+import time
+import random
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('TRACE_EXPORTER', 'none')
+os.environ.setdefault('KB_VERSION_POLL_SECONDS', '3600')
+# A similarity threshold above 1 turns the response cache off
+os.environ.setdefault('RESPONSE_CACHE_SIMILARITY', '2')
+os.environ.setdefault('RETRIEVAL_CACHE_SIZE', '0')
+
+import standins
+import bench_chat_load
+
+QUESTIONS = [
+    'I was charged twice this month',
+    'I was charged twice this month!',
+    'i was charged  twice this month',
+    'Why was I charged twice?',
+]
+
+
+async def burst(client, requests, spread, rng):
+    latencies, errors = [], 0
+
+    async def one(delay, user_comment):
+        nonlocal errors
+        await asyncio.sleep(delay)
+        start_time = time.perf_counter()
+        try:
+            await bench_chat_load.send(client, '/chat', user_comment, None)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+        except Exception:
+            errors += 1
+
+    await asyncio.gather(*(one(rng.uniform(0, spread), rng.choice(QUESTIONS)) for i in range(requests)))
+    return sorted(latencies), errors
+
+
+async def main(requests, spread, profile_name):
+    upstream, tables = standins.install(standins.Profile(**standins.PROFILES[profile_name]))
+
+    import main as app_main
+    async with app_main.app.test_app() as test_app:
+        client = test_app.test_client()
+        print(f'{"single_flight":<14} {"requests":>8} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"router":>7} {"retrieval":>9} {"generation":>10}')
+        for enabled in (False, True):
+            app_main.flights.enabled = enabled
+            app_main.flights.counts.clear()
+            calls_before = dict(app_main.llm_client.calls)
+            retrievals_before = upstream_queries(app_main)
+
+            latencies, errors = await burst(client, requests, spread, random.Random(7))
+
+            calls = {k: v - calls_before[k] for k, v in app_main.llm_client.calls.items()}
+            print(f'{"on" if enabled else "off":<14} {requests:8d} {errors:6d} {bench_chat_load.percentile(latencies, 0.5):9.1f} {bench_chat_load.percentile(latencies, 0.95):9.1f} '
+                  f'{calls["router"]:7d} {upstream_queries(app_main) - retrievals_before:9d} {calls["generation"]:10d}')
+        print()
+        print(app_main.flights.stats())
+
+
+def upstream_queries(app_main):
+    '''
+        Retrievals run so far (index and BigQuery), from the retrieval stats of BQClient.
+    '''
+    return sum(count for source, count in app_main.bq_obj.stats()['sources'].items() if source != 'memo')
+
+
+if __name__ == '__main__':
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    spread = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    profile_name = sys.argv[3] if len(sys.argv) > 3 else 'vertex'
+    asyncio.run(main(requests, spread, profile_name))
@@ -0,0 +1,200 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_chat_load.py [rps] [duration_seconds] [profile] [endpoint]
+#
+#   rps       Target requests per second (default 20)
+#   duration  Seconds during which new conversations are started (default 30)
+#   profile   Upstream latency profile from standins.PROFILES: zero, fast, vertex or slow (default vertex)
+#   endpoint  /chat or /chat/stream (default /chat)
+#
+# Replays multi-turn conversations against the app in-process, with Vertex AI and
+# BigQuery replaced by the local stand-ins in standins.py. Conversations start as a
+# seeded Poisson process sized so that requests arrive at the target rate, and each
+# conversation sends its turns one after the other with the same session_id.
+#
+# Reports latency p50/p95/p99 per route under load, then replays every route serially
+# to measure CPU time and peak Python allocations per request. The app's own settings
+# (PIPELINE_MODE, RESPONSE_CACHE_*, VECTOR_INDEX_TABLES, ...) are read from the
+# environment as usual. BENCH_SEED (default 7) and BENCH_THINK_SECONDS (default 0.5)
+# control the replay.
+
+import os, sys
+import json
+import time
+import random
+import asyncio
+import resource
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('TRACE_EXPORTER', 'none')
+os.environ.setdefault('KB_VERSION_POLL_SECONDS', '3600')
+
+import standins
+
+# (route, turns). Placeholders are filled from the fixture tables per conversation.
+CONVERSATIONS = [
+    ('cancellation', ['I want to cancel my subscription', 'Will I keep access until the end of the month?', 'Ok, and can I come back later?']),
+    ('cancellation', ['How do I end my membership?', 'Do I get a refund for the days left?']),
+    ('payments', ['I was charged twice this month', 'It was on my {card} card', 'When will the refund show up?']),
+    ('payments', ['How do I update my credit card?', 'Is there a {plan} plan that is cheaper?']),
+    ('login', ['I forgot my password', 'I did not get the verification code', 'Can I change the email address on my account?']),
+    ('login', ['I cannot log in on my TV', 'It says my account is locked']),
+    ('recommendations', ['Can you recommend a good {genre} movie?', 'Something from the {decade}s?', 'Anything like {title}?']),
+    ('recommendations', ['What should I watch tonight with my family?', 'Suggest a {genre} series instead']),
+    ('media', ['How many seasons does {title} have?', 'Who is in the cast?', 'Is the first episode available?']),
+    ('media', ['Is {title} streaming now?', 'When was it released?']),
+    ('general', ['Hello', 'What are your support hours?', 'Thanks for your help']),
+]
+
+
+def fill(turn, rng, tables):
+    media = rng.choice(tables['webdata_embeddings'])
+    return turn.format(
+        title=media['title'],
+        genre=rng.choice(standins.GENRES).lower(),
+        decade=rng.choice(('80', '90', '2000', '2010')),
+        card=rng.choice(('Visa', 'Mastercard', 'Amex')),
+        plan=rng.choice(('basic', 'standard', 'ad-supported')),
+    )
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def send(client, endpoint, user_comment, session_id):
+    payload = {'user_comment': user_comment}
+    if session_id:
+        payload['session_id'] = session_id
+    response = await client.post(endpoint, json=payload)
+    body = (await response.get_data()).decode()
+    if response.status_code != 200:
+        raise RuntimeError(f'HTTP {response.status_code}')
+    if endpoint == '/chat/stream':
+        body = body.rsplit('event: done\ndata: ', 1)[1].split('\n', 1)[0]
+    payload = json.loads(body)
+    if not payload.get('agent_response'):
+        raise RuntimeError('Empty agent_response')
+    return payload['session_id']
+
+
+async def run_conversation(client, endpoint, route, turns, think_seconds, results, run_start):
+    session_id = None
+    for turn in turns:
+        start_time = time.perf_counter()
+        try:
+            session_id = await send(client, endpoint, turn, session_id)
+            error = None
+        except Exception as e:
+            error = f'{e}'
+        results.append((route, (time.perf_counter() - start_time) * 1000, error, start_time - run_start))
+        await asyncio.sleep(think_seconds)
+
+
+async def load_phase(client, endpoint, rps, duration, think_seconds, rng, tables):
+    results, tasks = [], []
+    avg_turns = sum(len(turns) for route, turns in CONVERSATIONS) / len(CONVERSATIONS)
+    start_time = time.perf_counter()
+    next_start = 0.0
+    while next_start < duration:
+        delay = start_time + next_start - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        route, turns = rng.choice(CONVERSATIONS)
+        tasks.append(asyncio.create_task(run_conversation(client, endpoint, route, [fill(t, rng, tables) for t in turns], think_seconds, results, start_time)))
+        next_start += rng.expovariate(rps / avg_turns)
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start_time
+
+
+async def profile_phase(client, endpoint, rng, tables, upstream, repeats=5):
+    '''
+        Serial replay of every route with upstream latency off (it does not use CPU).
+        Returns {route: (cpu_ms_per_request, alloc_kb_per_request)}.
+    '''
+    upstream.__dict__.update(standins.PROFILES['zero'])
+    profile = {}
+    for route, turns in CONVERSATIONS:
+        cpu, alloc, count = profile.get(route, (0.0, 0.0, 0))
+        for i in range(repeats):
+            # Unique questions so that every request misses the caches
+            user_comment = f'{fill(turns[0], rng, tables)} ({rng.randint(0, 1_000_000)})'
+            cpu_start = time.process_time()
+            await send(client, endpoint, user_comment, None)
+            cpu += time.process_time() - cpu_start
+
+            # Allocations are traced in a second request, tracemalloc inflates the CPU time
+            user_comment = f'{fill(turns[0], rng, tables)} ({rng.randint(0, 1_000_000)})'
+            tracemalloc.start()
+            await send(client, endpoint, user_comment, None)
+            alloc += tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            count += 1
+        profile[route] = (cpu, alloc, count)
+    return {route: (cpu * 1000 / count, alloc / 1024 / count) for route, (cpu, alloc, count) in profile.items()}
+
+
+async def main(rps, duration, profile_name, endpoint):
+    seed = int(os.environ.get('BENCH_SEED', 7))
+    think_seconds = float(os.environ.get('BENCH_THINK_SECONDS', 0.5))
+    upstream, tables = standins.install(standins.Profile(seed=seed, **standins.PROFILES[profile_name]))
+
+    import main as app_main
+    async with app_main.app.test_app() as test_app:
+        client = test_app.test_client()
+        rng = random.Random(seed)
+
+        # Warm up the caches of the app and of the imported modules
+        for route, turns in CONVERSATIONS:
+            await send(client, endpoint, fill(turns[0], rng, tables), None)
+        calls_before = dict(app_main.llm_client.calls)
+
+        cpu_start = time.process_time()
+        results, elapsed = await load_phase(client, endpoint, rps, duration, think_seconds, rng, tables)
+        load_cpu = time.process_time() - cpu_start
+        calls = {k: v - calls_before[k] for k, v in app_main.llm_client.calls.items()}
+
+        per_route = await profile_phase(client, endpoint, rng, tables, upstream)
+
+    print(f'Endpoint: {endpoint}   Profile: {profile_name}   Mode: {app_main.chat_pipeline.mode}   Seed: {seed}')
+    # Conversations still running after the arrival window are drained, but not counted in the rate
+    offered = sum(1 for r in results if r[3] < duration) / duration
+    print(f'Requests: {len(results)} in {elapsed:.1f} s ({offered:.1f} rps over the first {duration:.0f} s, target {rps})   Errors: {sum(1 for r in results if r[2])}')
+    print(f'Upstream calls per request: ' + ', '.join(f'{k} {v / max(1, len(results)):.2f}' for k, v in calls.items()))
+    print(f'CPU under load: {load_cpu * 1000 / max(1, len(results)):.2f} ms/request   Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+    print()
+    print(f'{"route":<16} {"requests":>8} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"cpu ms/req":>11} {"alloc KB/req":>13}')
+    for route in sorted({r[0] for r in results} | set(per_route)) + ['all']:
+        latencies = sorted(ms for r, ms, error, offset in results if (route == 'all' or r == route) and not error)
+        errors = sum(1 for r, ms, error, offset in results if (route == 'all' or r == route) and error)
+        cpu, alloc = per_route.get(route, (None, None))
+        print(f'{route:<16} {len(latencies) + errors:8d} {errors:6d} {percentile(latencies, 0.5):9.1f} {percentile(latencies, 0.95):9.1f} {percentile(latencies, 0.99):9.1f} '
+              f'{"" if cpu is None else f"{cpu:.2f}":>11} {"" if alloc is None else f"{alloc:.1f}":>13}')
+    for error in sorted({r[2] for r in results if r[2]})[:5]:
+        print(f'[ ERROR ] {error}')
+
+
+if __name__ == '__main__':
+    rps = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    profile_name = sys.argv[3] if len(sys.argv) > 3 else 'vertex'
+    endpoint = sys.argv[4] if len(sys.argv) > 4 else '/chat'
+    asyncio.run(main(rps, duration, profile_name, endpoint))
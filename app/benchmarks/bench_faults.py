@@ -0,0 +1,128 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_faults.py [rps] [phase_seconds] [endpoint]
+#
+#   rps       Requests per second (default 10)
+#   phase     Seconds per phase (default 10)
+#   endpoint  /chat or /chat/stream (default /chat)
+#
+# Sends first-turn questions against the local stand-ins (fast profile) while injecting
+# faults, one phase after the other:
+#
+#   healthy      no faults
+#   flaky        10% of the upstream calls fail and 5% stall for stall_ms
+#   gemini_down  every Gemini call fails
+#   bigquery_down every BigQuery call fails (retrieval runs in BigQuery, no local indexes)
+#   recovered    no faults, after the circuits' reset time
+#
+# Reports latency, failed requests (HTTP errors or empty answers), how answers were
+# served and what the upstream layer did (retries, hedges, timeouts, open circuits).
+# BENCH_STALL_MS (default 4000) sets the stall. The app's UPSTREAM_POLICIES and
+# CIRCUIT_* settings are read from the environment as usual.
+
+import os, sys
+import time
+import random
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ.setdefault('TRACE_EXPORTER', 'none')
+os.environ.setdefault('KB_VERSION_POLL_SECONDS', '3600')
+os.environ.setdefault('CIRCUIT_RESET_SECONDS', '2')
+# Retrieval goes to BigQuery so that its faults reach the app
+os.environ.setdefault('VECTOR_INDEX_TABLES', '')
+os.environ.setdefault('RETRIEVAL_CACHE_SIZE', '0')
+
+import standins
+import bench_chat_load
+
+PHASES = [
+    ('healthy', {}),
+    ('flaky', {'error_rate': 0.10, 'stall_rate': 0.05}),
+    ('gemini_down', {'down': {'gemini'}}),
+    ('bigquery_down', {'down': {'bigquery'}}),
+    ('recovered', {}),
+]
+
+
+async def phase(client, endpoint, rps, seconds, rng, tables):
+    results = []
+
+    async def one(delay, user_comment):
+        await asyncio.sleep(delay)
+        start_time = time.perf_counter()
+        try:
+            await bench_chat_load.send(client, endpoint, user_comment, None)
+            error = None
+        except Exception as e:
+            error = f'{e}'
+        results.append(((time.perf_counter() - start_time) * 1000, error))
+
+    requests = [(i / rps, bench_chat_load.fill(rng.choice(bench_chat_load.CONVERSATIONS)[1][0], rng, tables)) for i in range(int(rps * seconds))]
+    await asyncio.gather(*(one(delay, user_comment) for delay, user_comment in requests))
+    return results
+
+
+def upstream_totals(app_main):
+    totals = {}
+    for name, upstream in (('gemini', app_main.llm_client.upstream), ('embeddings', app_main.embedding_client.upstream), ('bigquery', app_main.bq_obj.upstream)):
+        for stage, counts in upstream.stats()['stages'].items():
+            for key in ('retries', 'hedges', 'hedge_wins', 'timeouts', 'failures', 'rejected'):
+                totals[key] = totals.get(key, 0) + counts.get(key, 0)
+    return totals
+
+
+async def main(rps, seconds, endpoint):
+    upstream, tables = standins.install(standins.Profile(stall_ms=int(os.environ.get('BENCH_STALL_MS', 4000)), **standins.PROFILES['fast']))
+
+    import main as app_main
+    async with app_main.app.test_app() as test_app:
+        client = test_app.test_client()
+        rng = random.Random(7)
+
+        print(f'Endpoint: {endpoint}   {rps} rps, {seconds:.0f} s per phase   Stall: {upstream.stall_ms} ms')
+        print(f'{"phase":<14} {"requests":>8} {"failed":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"kb_less":>7} {"cached":>6} {"static":>6} '
+              f'{"retries":>7} {"hedges":>6} {"timeouts":>8} {"rejected":>8}  circuits')
+        for name, faults in PHASES:
+            if name == 'recovered':
+                await asyncio.sleep(app_main.circuit_reset_seconds)
+            upstream.error_rate = faults.get('error_rate', 0.0)
+            upstream.stall_rate = faults.get('stall_rate', 0.0)
+            upstream.down = set(faults.get('down', ()))
+
+            fallbacks_before = dict(app_main.telemetry_obj.counters.get('chat_fallback_responses_total', {}))
+            totals_before = upstream_totals(app_main)
+            results = await phase(client, endpoint, rps, seconds, rng, tables)
+            fallbacks = {labels[0][1]: count - fallbacks_before.get(labels, 0) for labels, count in app_main.telemetry_obj.counters.get('chat_fallback_responses_total', {}).items()}
+            totals = {key: value - totals_before.get(key, 0) for key, value in upstream_totals(app_main).items()}
+
+            latencies = sorted(ms for ms, error in results)
+            circuits = ' '.join(f'{u.name}={u.breaker.state}' for u in (app_main.llm_client.upstream, app_main.embedding_client.upstream, app_main.bq_obj.upstream))
+            print(f'{name:<14} {len(results):8d} {sum(1 for ms, error in results if error):6d} '
+                  f'{bench_chat_load.percentile(latencies, 0.5):8.1f} {bench_chat_load.percentile(latencies, 0.95):8.1f} {bench_chat_load.percentile(latencies, 0.99):8.1f} '
+                  f'{fallbacks.get("kb_less", 0):7d} {fallbacks.get("cached", 0):6d} {fallbacks.get("static", 0):6d} '
+                  f'{totals.get("retries", 0):7d} {totals.get("hedges", 0):6d} {totals.get("timeouts", 0):8d} {totals.get("rejected", 0):8d}  {circuits}')
+            for error in sorted({error for ms, error in results if error})[:3]:
+                print(f'[ ERROR ] {error}')
+
+
+if __name__ == '__main__':
+    rps = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    endpoint = sys.argv[3] if len(sys.argv) > 3 else '/chat'
+    asyncio.run(main(rps, seconds, endpoint))
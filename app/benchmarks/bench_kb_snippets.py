@@ -0,0 +1,96 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_kb_snippets.py [iterations]
+#
+# Per-request CPU cost of formatting the media knowledge base for 20, 200 and 2000
+# retrieved rows: the previous per-request loop (dict() per key, json.loads of the
+# content column, episodeLabel regex, += concatenation) against joining the
+# kb_snippet strings precomputed when the vector index is loaded.
+
+import os, sys
+import re
+import json
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from modules import kb_snippet
+
+
+def make_rows(n):
+    rng = random.Random(11)
+    rows = []
+    for i in range(n):
+        content = {
+            'minReleaseYear': rng.randint(1990, 2020),
+            'maxReleaseYear': rng.randint(2020, 2024),
+            'studio': f'Studio {rng.randint(1, 30)}',
+            'formattedEpisodeCount': f'{rng.randint(6, 120)} Episodes',
+            'formattedSeasonCount': f'{rng.randint(1, 10)} Seasons',
+            'childContent': [{'episodeLabel': f'S1 E{j}', 'title': f'Episode {j}'} for j in range(1, 4)],
+            'description': 'A crew on a long mission to the far side of the moon. ' * 4,
+        }
+        rows.append({
+            'contentId': f'{i}',
+            'mediaId': f'm{i}',
+            'title': f'Title {i}',
+            'runtime': f'{rng.randint(1200, 9000)}',
+            'logLine': 'A crew on a long mission to the far side of the moon.',
+            'releaseYear': f'{rng.randint(1970, 2024)}',
+            'contentType': 'series',
+            'content': json.dumps(content),
+        })
+    return rows
+
+
+def legacy_format(catalog_results):
+    kb_snippets = []
+    for catalog_result in catalog_results:
+        catalog_result_processed = ''
+        for k,v in dict(catalog_result).items():
+            if k in ['releaseYear', 'runtime', 'mediaId', 'logLine', 'contentType', 'studio', 'title', 'content']:
+                if k == 'content':
+                    json_content = json.loads(dict(catalog_result)['content'])
+                    for k2,v2 in json_content.items():
+                        if k2 in ['minReleaseYear','maxReleaseYear','studio','formattedEpisodeCount','formattedSeasonCount']:
+                            catalog_result_processed += f'{k2}:\t{v2}\n'
+                        elif k2 in ['childContent']:
+                            match = re.search(r"'episodeLabel':\s*'([^']+)'", f"{json_content['childContent'][0]}")
+                            if match:
+                                catalog_result_processed += f'episodeLabel:\t{match.group(1)}\n'
+                else:
+                    catalog_result_processed += f'{k}:\t{v}\n'
+        kb_snippets.append(catalog_result_processed)
+    return '\n'.join(kb_snippets)
+
+
+def precomputed_format(catalog_results):
+    return '\n'.join(kb_snippet.snippets(catalog_results, 'webdata_embeddings'))
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f'{"rows":>6} {"before (us)":>14} {"after (us)":>12} {"speedup":>9}')
+    for n in (20, 200, 2000):
+        rows = make_rows(n)
+        indexed_rows = kb_snippet.attach_snippets([dict(row) for row in rows], 'webdata_embeddings')
+        assert legacy_format(rows) == precomputed_format(indexed_rows)
+
+        number = max(1, iterations * 20 // n)
+        before = timeit.timeit(lambda: legacy_format(rows), number=number) / number
+        after = timeit.timeit(lambda: precomputed_format(indexed_rows), number=number) / number
+        print(f'{n:6d} {before*1e6:14.1f} {after*1e6:12.1f} {before/after:8.1f}x')
@@ -0,0 +1,61 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_model_registry.py [iterations]
+#
+# Measures the per-call setup overhead of a Gemini call before (new GenerativeModel,
+# SafetySettings and GenerationConfig on every call) and after the GCP_GenAI model
+# registry. No request is sent to Vertex AI.
+
+import os, sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from vertexai.generative_models import GenerativeModel, GenerationConfig, HarmCategory, HarmBlockThreshold, SafetySetting
+from modules import llm
+
+
+def setup_per_call(model_id='gemini-1.5-flash-001'):
+    llm_model_gemini = GenerativeModel(model_id)
+    safety_config = [
+        SafetySetting(category=HarmCategory.HARM_CATEGORY_HATE_SPEECH, threshold=HarmBlockThreshold.BLOCK_NONE),
+        SafetySetting(category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, threshold=HarmBlockThreshold.BLOCK_NONE),
+        SafetySetting(category=HarmCategory.HARM_CATEGORY_HARASSMENT, threshold=HarmBlockThreshold.BLOCK_NONE),
+        SafetySetting(category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, threshold=HarmBlockThreshold.BLOCK_NONE),
+    ]
+    generation_config = GenerationConfig(temperature=0.5, top_p=0.8, top_k=40, candidate_count=1, max_output_tokens=1024, stop_sequences=None)
+    return llm_model_gemini, safety_config, generation_config
+
+
+def setup_registry(llm_client, model_id='gemini-1.5-flash-001'):
+    llm_model_gemini = llm_client._gemini_model(model_id)
+    safety_config = llm_client._safety_config()
+    generation_config = llm_client._generation_config(0.5, 1024, 0.8, 40, None)
+    return llm_model_gemini, safety_config, generation_config
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    llm_client = llm.GCP_GenAI(GCP_PROJECT_ID=os.environ.get('GCP_PROJECT_ID', 'benchmark-project'), GCP_REGION=os.environ.get('GCP_REGION', 'us-central1'))
+    setup_registry(llm_client)
+
+    before = timeit.timeit(setup_per_call, number=iterations) / iterations
+    after = timeit.timeit(lambda: setup_registry(llm_client), number=iterations) / iterations
+
+    print(f'Iterations:            {iterations}')
+    print(f'Per-call setup before: {before*1e6:10.2f} us')
+    print(f'Per-call setup after:  {after*1e6:10.2f} us')
+    print(f'Speedup:               {before/after:10.1f}x')
@@ -0,0 +1,113 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python bench_paginated_fetch.py [records] [page_latency_ms] [failure_rate]
+#
+# Starts a local stand-in for the catalog API (paged playContentArray.playContents
+# responses, page_latency_ms per request, failure_rate of requests answered with
+# 503) and crawls it with scripts/paginated_fetcher.py at several parallelism
+# levels. It then checks that an interrupted crawl resumes from its checkpoint.
+
+import os, sys
+import json
+import time
+import random
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+
+import requests
+from paginated_fetcher import PaginatedFetcher
+
+
+class CatalogHandler(BaseHTTPRequestHandler):
+    records = []
+    page_latency_ms = 20
+    failure_rate = 0.0
+    # Pages answered with 500 on every attempt, to simulate an outage mid-crawl
+    broken_pages = set()
+    requests_served = 0
+
+    def do_GET(self):
+        CatalogHandler.requests_served += 1
+        params = parse_qs(urlparse(self.path).query)
+        page = int(params.get('page', ['1'])[0])
+        page_size = int(params.get('pageSize', ['500'])[0])
+        time.sleep(self.page_latency_ms / 1000)
+
+        if page in self.broken_pages:
+            return self._send(500, {'error': 'unavailable'})
+        if random.random() < self.failure_rate:
+            return self._send(503, {'error': 'try again'})
+
+        start = (page - 1) * page_size
+        self._send(200, {'playContentArray': {'playContents': self.records[start:start + page_size]}})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CatalogHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/catalog'
+
+
+def crawl(url, parallelism, checkpoint_dir=None, page_size=100):
+    fetcher = PaginatedFetcher(url, page_size=page_size, parallelism=parallelism, backoff_seconds=0.05, checkpoint_dir=checkpoint_dir)
+    return fetcher, list(fetcher.fetch_records())
+
+
+if __name__ == '__main__':
+    total_records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    CatalogHandler.page_latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    CatalogHandler.failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    CatalogHandler.records = [{'contentId': i, 'title': f'Title {i}', 'logLine': 'A crew on a mission to the moon.'} for i in range(total_records)]
+    server, url = start_server()
+
+    print(f'Records: {total_records}, page latency: {CatalogHandler.page_latency_ms} ms, failure rate: {CatalogHandler.failure_rate}')
+    for parallelism in (1, 4, 16):
+        CatalogHandler.requests_served = 0
+        start_time = time.perf_counter()
+        fetcher, records = crawl(url, parallelism)
+        elapsed = time.perf_counter() - start_time
+        assert sorted(record['contentId'] for record in records) == list(range(total_records))
+        print(f'parallelism {parallelism:3d}: {elapsed*1000:9.1f} ms, {CatalogHandler.requests_served} requests')
+
+    checkpoint_dir = tempfile.mkdtemp(prefix='catalog_crawl_')
+    broken_page = total_records // 100 // 2
+    CatalogHandler.broken_pages = {broken_page}
+    try:
+        crawl(url, 4, checkpoint_dir)
+    except requests.exceptions.RequestException:
+        print(f'Crawl interrupted at page {broken_page}')
+    CatalogHandler.broken_pages = set()
+    CatalogHandler.requests_served = 0
+    fetcher, records = crawl(url, 4, checkpoint_dir)
+    assert sorted(record['contentId'] for record in records) == list(range(total_records))
+    print(f'Resumed crawl: {fetcher.pages_resumed} pages from checkpoint, {fetcher.pages_fetched} fetched, {CatalogHandler.requests_served} requests')
+    fetcher.clear_checkpoint()
+    server.shutdown()
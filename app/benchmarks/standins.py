@@ -0,0 +1,366 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand-ins for Vertex AI and BigQuery, and fixture knowledge base tables,
+# used by the benchmarks to run the app offline.
+#
+#   FakeGenAI            Drop-in for llm.GCP_GenAI. Sleeps according to a Profile and
+#                        returns deterministic answers, router categories and embeddings.
+#   LocalBigQueryClient  Drop-in for google.cloud.bigquery.Client, serving fixture tables
+#                        to BQClient (index snapshots, retrieval queries, table versions).
+#   fixture_tables()     Rows shaped like webdata_embeddings and articledata_embeddings.
+#   install()            Swaps both stand-ins in. Call it before importing main.
+#
+# Profiles can also inject faults: a share of the calls fail (error_rate) or stall for
+# stall_ms (stall_rate), and the dependencies named in down ('gemini', 'embeddings',
+# 'bigquery') fail every call. Attributes can be changed while the app runs.
+
+import os, sys
+import re
+import json
+import time
+import zlib
+import random
+import asyncio
+import datetime
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from modules import llm, bq, prompt_template, resilience
+from modules.lexical_index import tokenize
+from modules.router import KeywordStage
+
+EMBEDDING_DIMS = 64
+
+
+class InjectedFault(Exception):
+    pass
+
+
+class Profile:
+    '''
+        Latency and fault model of the upstream services. Latencies are in ms, each one
+        drawn uniformly within +/- jitter of its mean from a seeded RNG.
+    '''
+
+    def __init__(self, router_ms=250, first_token_ms=400, tokens_per_second=120, output_tokens=160, embedding_ms=60, bigquery_ms=900, jitter=0.25, seed=7, error_rate=0.0, stall_rate=0.0, stall_ms=30000, down=()):
+        self.router_ms = router_ms
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.embedding_ms = embedding_ms
+        self.bigquery_ms = bigquery_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.down = set(down)
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.faults = {'errors': 0, 'stalls': 0}
+
+    def seconds(self, ms):
+        with self._lock:
+            return ms * (1 + self.rng.uniform(-self.jitter, self.jitter)) / 1000
+
+    def generation_seconds(self, output_tokens):
+        return self.seconds(self.first_token_ms) + output_tokens / self.tokens_per_second
+
+    def fault(self, dependency):
+        '''
+            Raises InjectedFault for a failed call, otherwise returns the seconds it stalls (0 for most calls).
+        '''
+        with self._lock:
+            roll = self.rng.random()
+            if dependency in self.down or roll < self.error_rate:
+                self.faults['errors'] += 1
+                raise InjectedFault(f'{dependency} is unavailable')
+            if roll < self.error_rate + self.stall_rate:
+                self.faults['stalls'] += 1
+                return self.stall_ms / 1000
+        return 0.0
+
+
+PROFILES = {
+    # No upstream latency, measures the app's own overhead
+    'zero': dict(router_ms=0, first_token_ms=0, tokens_per_second=1e9, embedding_ms=0, bigquery_ms=0, jitter=0),
+    'fast': dict(router_ms=60, first_token_ms=120, tokens_per_second=400, embedding_ms=15, bigquery_ms=300),
+    'vertex': dict(router_ms=250, first_token_ms=400, tokens_per_second=120, embedding_ms=60, bigquery_ms=900),
+    'slow': dict(router_ms=900, first_token_ms=1500, tokens_per_second=40, embedding_ms=200, bigquery_ms=3000),
+    # Vertex latencies with 5% failed and 5% stalled calls
+    'faulty': dict(router_ms=250, first_token_ms=400, tokens_per_second=120, embedding_ms=60, bigquery_ms=900, error_rate=0.05, stall_rate=0.05),
+}
+
+
+def embed_text(text, dims=EMBEDDING_DIMS):
+    '''
+        Deterministic bag-of-tokens embedding: texts sharing tokens get similar vectors.
+    '''
+    vector = np.zeros(dims, dtype=np.float32)
+    for token in tokenize(text):
+        h = zlib.crc32(token.encode())
+        vector[h % dims] += 1.0 if (h >> 16) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+
+class FakeGenAI(llm.GCP_GenAI):
+    '''
+        Stand-in for llm.GCP_GenAI, keeping its model cascade. Router prompts are answered
+        with the keyword router's category, other prompts with an answer of
+        profile.output_tokens tokens (cut at the tier's max_output_tokens) in the
+        markdown Gemini emits (bold, links and knowledge base urls).
+    '''
+
+    def __init__(self, GCP_PROJECT_ID='', GCP_REGION='', cascade=None, upstream=None, profile=None):
+        self.cascade = cascade or llm.ModelCascade()
+        self.upstream = upstream or resilience.Upstream('gemini')
+        self.profile = profile or Profile()
+        self.keyword_stage = KeywordStage()
+        self.router_prefix = prompt_template.prompt_router.split('{user_comment}')[0]
+
+        self._lock = threading.Lock()
+        self.calls = {'router': 0, 'generation': 0, 'stream': 0, 'embedding': 0}
+        self.output_tokens = 0
+
+    def warm(self, *args, **kwargs):
+        pass
+
+    def _count(self, kind, tokens=0):
+        with self._lock:
+            self.calls[kind] += 1
+            self.output_tokens += tokens
+
+    def _is_router_prompt(self, prompt):
+        return prompt.startswith(self.router_prefix)
+
+    def _route(self, prompt):
+        route, confidence = self.keyword_stage.classify(prompt[len(self.router_prefix):])
+        return route or 'general'
+
+    def answer(self, prompt, output_tokens=None):
+        question = prompt.rsplit('User:', 1)[-1][:80].strip().replace('\n', ' ')
+        words = ['Here', 'is', 'what', 'I', 'found', 'about', f'**{question}**.']
+        filler = 'You can manage this from the **Account** page or see [the help article](https://help.example.com/a/1) for details.'.split()
+        output_tokens = output_tokens or self.profile.output_tokens
+        while len(words) < output_tokens:
+            words.extend(filler)
+        words = words[:output_tokens]
+        return ' '.join(words) + '\n[Knowledge Base URL: https://help.example.com/a/1]'
+
+    async def complete_async(self, prompt, model_id, temperature, max_output_tokens):
+        await asyncio.sleep(self.profile.fault('gemini'))
+        if self._is_router_prompt(prompt):
+            await asyncio.sleep(self.profile.seconds(self.profile.router_ms))
+            self._count('router', 1)
+            return {'text': self._route(prompt), 'input_tokens': len(prompt) // 4, 'output_tokens': 1, 'finish_reason': 'STOP', 'avg_logprobs': None}
+        output_tokens = min(self.profile.output_tokens, max_output_tokens)
+        await asyncio.sleep(self.profile.generation_seconds(output_tokens))
+        self._count('generation', output_tokens)
+        return {
+            'text': self.answer(prompt, output_tokens),
+            'input_tokens': len(prompt) // 4,
+            'output_tokens': output_tokens,
+            'finish_reason': 'MAX_TOKENS' if output_tokens < self.profile.output_tokens else 'STOP',
+            'avg_logprobs': None,
+        }
+
+    async def stream_complete_async(self, prompt, model_id, temperature, max_output_tokens):
+        await asyncio.sleep(self.profile.fault('gemini') + self.profile.seconds(self.profile.first_token_ms))
+        output_tokens = min(self.profile.output_tokens, max_output_tokens)
+        for chunk in self._chunks(prompt, output_tokens=output_tokens):
+            await asyncio.sleep(8 / self.profile.tokens_per_second)
+            yield chunk
+        self._count('stream', output_tokens)
+
+    def _chunks(self, prompt, tokens_per_chunk=8, output_tokens=None):
+        words = self.answer(prompt, output_tokens).split(' ')
+        for i in range(0, len(words), tokens_per_chunk):
+            yield ' '.join(words[i:i + tokens_per_chunk]) + (' ' if i + tokens_per_chunk < len(words) else '')
+
+    def text_embedding(self, input_list, google_embeddings_model='text-embedding-004'):
+        time.sleep(self.profile.fault('embeddings') + self.profile.seconds(self.profile.embedding_ms))
+        self._count('embedding')
+        return [embed_text(text) for text in input_list]
+
+    async def text_embedding_async(self, input_list, google_embeddings_model='text-embedding-004'):
+        await asyncio.sleep(self.profile.fault('embeddings') + self.profile.seconds(self.profile.embedding_ms))
+        self._count('embedding')
+        return [embed_text(text) for text in input_list]
+
+
+class LocalQueryJob:
+
+    def __init__(self, rows, seconds, bytes_processed):
+        self.job_id = f'local_{zlib.crc32(f"{time.perf_counter_ns()}".encode()):08x}'
+        self.rows = rows
+        self.seconds = seconds
+        self.total_bytes_processed = bytes_processed
+        self.total_bytes_billed = max(bytes_processed, 10 * 1024 * 1024)
+        self.slot_millis = int(seconds * 1000)
+        self.cache_hit = False
+        self.location = 'US'
+        self.done_at = time.monotonic() + seconds
+
+    def result(self, timeout=None):
+        # The job runs from its creation, like a BigQuery job polled several times
+        running = max(0.0, self.done_at - time.monotonic())
+        if timeout is not None and running > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f'Job {self.job_id} is still running')
+        time.sleep(running)
+        return self.rows
+
+
+class LocalBigQueryClient:
+    '''
+        Stand-in for google.cloud.bigquery.Client over in-memory fixture tables. Handles the
+        queries BQClient sends: full table snapshots, question embeddings and the
+        parameterized retrieval query (exact cosine scan, filters matched as regexes).
+    '''
+    TABLE_PATTERN = re.compile(r'`[A-Za-z0-9_-]+\.([A-Za-z0-9_]+)`')
+
+    def __init__(self, tables, profile=None):
+        self.tables = tables
+        self.profile = profile or Profile()
+        self.modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.queries = 0
+        self.cancelled_jobs = 0
+
+    def get_table(self, table_ref, timeout=None):
+        class Table:
+            modified = self.modified
+        return Table()
+
+    def _params(self, job_config):
+        params = {}
+        for p in getattr(job_config, 'query_parameters', None) or []:
+            params[p.name] = p.values if hasattr(p, 'values') else p.value
+        return params
+
+    def query_and_wait(self, query, job_config=None, wait_timeout=None):
+        self.queries += 1
+        params = self._params(job_config)
+        if 'ML.GENERATE_EMBEDDING' in query and 'top_matches' not in query:
+            seconds = self.profile.fault('bigquery') + self.profile.seconds(self.profile.embedding_ms)
+            LocalQueryJob([], seconds, 0).result(timeout=wait_timeout)
+            return [{'ml_generate_embedding_result': embed_text(params['user_query'])}]
+        table_id = self.TABLE_PATTERN.search(query).group(1)
+        return [dict(row) for row in self.tables[table_id]]
+
+    def query(self, query, job_config=None, timeout=None):
+        self.queries += 1
+        stall_seconds = self.profile.fault('bigquery')
+        params = self._params(job_config)
+        table_id = self.TABLE_PATTERN.search(query).group(1)
+        rows = self.tables[table_id]
+
+        filters = [re.compile(value) for name, value in sorted(params.items()) if name.startswith('filter_')]
+        if filters:
+            rows = [row for row in rows if all(f.search(' '.join(f'{row.get(field) or ""}' for field in bq.FILTER_FIELDS).lower()) for f in filters)]
+
+        query_vector = np.asarray(params.get('query_embedding') or embed_text(params.get('user_query', '')), dtype=np.float32)
+        scores = [float(np.dot(row['text_embedding'], query_vector)) for row in rows]
+        top = sorted(range(len(rows)), key=lambda i: -scores[i])[:params.get('k', 20)]
+        bytes_processed = sum(len(json.dumps(row)) for row in self.tables[table_id])
+        return LocalQueryJob([dict(rows[i]) for i in top], stall_seconds + self.profile.seconds(self.profile.bigquery_ms), bytes_processed)
+
+    def cancel_job(self, job_id, location=None):
+        self.cancelled_jobs += 1
+
+
+GENRES = ('Comedy', 'Drama', 'Sci-Fi', 'Horror', 'Romance', 'Documentary', 'Action', 'Family', 'Thriller', 'Animation')
+MEDIA_WORDS = ('moon', 'crew', 'detective', 'kitchen', 'island', 'robot', 'family', 'heist', 'school', 'storm', 'desert', 'band', 'river', 'ghost', 'court')
+ARTICLE_TOPICS = {
+    'cancellation': ('How to cancel your subscription', 'cancel,subscription,membership', 'You can cancel your membership at any time from the Account page. Your plan stays active until the end of the billing period.'),
+    'payments': ('Update your payment method', 'payment,billing,card,refund', 'Change the card on file from Account > Billing. Refunds are issued to the original payment method within 5 to 10 days.'),
+    'login': ('Reset your password', 'login,password,account,email', 'Use Forgot password on the sign-in page. A verification code is sent to the email address on your account.'),
+    'general': ('Contact support', 'support,help,hours', 'Support is available every day from 8am to 10pm. You can also chat with us from the Help page.'),
+}
+
+
+def make_webdata(n, seed=11):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        words = rng.sample(MEDIA_WORDS, 3)
+        genres = rng.sample(GENRES, 2)
+        title = f'The {words[0].title()} {words[1].title()} {i}'
+        log_line = f'A {genres[0].lower()} about a {words[0]}, a {words[1]} and a {words[2]}.'
+        content = {
+            'minReleaseYear': rng.randint(1980, 2020),
+            'maxReleaseYear': rng.randint(2020, 2024),
+            'studio': f'Studio {rng.randint(1, 30)}',
+            'formattedEpisodeCount': f'{rng.randint(6, 120)} Episodes',
+            'formattedSeasonCount': f'{rng.randint(1, 10)} Seasons',
+            'childContent': [{'episodeLabel': f'S1 E{j}', 'title': f'Episode {j}'} for j in range(1, 4)],
+            'description': log_line * 3,
+        }
+        rows.append({
+            'contentId': f'{i}',
+            'mediaId': f'm{i}',
+            'title': title,
+            'logLine': log_line,
+            'genres': ', '.join(genres),
+            'actors': f'Actor {rng.randint(1, 500)}, Actor {rng.randint(1, 500)}',
+            'releaseYear': f'{rng.randint(1970, 2024)}',
+            'runtime': f'{rng.randint(1200, 9000)}',
+            'contentType': rng.choice(('movie', 'series')),
+            'content': json.dumps(content),
+            'text_embedding': embed_text(f'{title} {log_line} {" ".join(genres)}'),
+        })
+    return rows
+
+
+def make_articledata(n, seed=13):
+    rng = random.Random(seed)
+    topics = list(ARTICLE_TOPICS.values())
+    rows = []
+    for i in range(n):
+        title, keywords, desc = topics[i % len(topics)]
+        title = f'{title} ({i})'
+        rows.append({
+            'id': f'{i}',
+            'title': title,
+            'desc': desc + ' ' + rng.choice(('Applies to all plans.', 'Not available on gift plans.', 'See also the FAQ.')),
+            'keywords': keywords,
+            'url': f'https://help.example.com/a/{i}',
+            'lang': 'en',
+            'text_embedding': embed_text(f'{title} {desc} {keywords}'),
+        })
+    return rows
+
+
+def fixture_tables(media_rows=2000, article_rows=400):
+    return {
+        'webdata_embeddings': make_webdata(media_rows),
+        'articledata_embeddings': make_articledata(article_rows),
+    }
+
+
+def install(profile=None, tables=None):
+    '''
+        Replaces GCP_GenAI and the BigQuery client used by BQClient with the local stand-ins.
+        Returns (profile, tables). Call before main is imported.
+    '''
+    profile = profile or Profile()
+    tables = tables if tables is not None else fixture_tables()
+    llm.GCP_GenAI = lambda GCP_PROJECT_ID='', GCP_REGION='', **kwargs: FakeGenAI(GCP_PROJECT_ID, GCP_REGION, profile=profile, **kwargs)
+    bq.bigquery.Client = lambda *args, **kwargs: LocalBigQueryClient(tables, profile=profile)
+    return profile, tables
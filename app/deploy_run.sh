@@ -28,6 +28,30 @@ else
     echo "GCP_REGION is set to '${GCP_REGION}'"
 fi
 
+MAX_CONCURRENT_REQUESTS=${MAX_CONCURRENT_REQUESTS:-80}
+
+# Forward the app settings of .env to Cloud Run. Variables that are unset or empty are
+# left out, so the app uses its defaults. The values go through a YAML file because
+# MODEL_TIERS and UPSTREAM_POLICIES are JSON, whose commas --set-env-vars would split on.
+ENV_VARS_FILE=$(mktemp)
+trap 'rm -f "$ENV_VARS_FILE"' EXIT
+for name in GCP_PROJECT_ID GCP_REGION BQ_DATASET_ID EMBEDDING_MODEL_NAME BRAND BRAND_LOGO_IMG APP_BACKGROUND_IMG \
+    VECTOR_INDEX_TABLES VECTOR_INDEX_BACKEND RETRIEVAL_MODE RETRIEVAL_TOP_K RETRIEVAL_FUSION_CANDIDATES \
+    RETRIEVAL_CACHE_SIZE RETRIEVAL_CACHE_TTL_SECONDS RETRIEVAL_FILTERS KB_LANG \
+    RERANK_TOP_N KB_TOKEN_BUDGET RERANK_MMR_LAMBDA \
+    MODEL_TIERS CASCADE_SIMPLE_PROMPT_TOKENS CASCADE_MIN_AVG_LOGPROB \
+    UPSTREAM_POLICIES CIRCUIT_FAILURE_THRESHOLD CIRCUIT_RESET_SECONDS \
+    EMBEDDING_CACHE_SIZE EMBEDDING_CACHE_TTL_SECONDS ROUTER_CONFIDENCE_THRESHOLD ROUTER_CENTROID_TEMPERATURE \
+    MAX_CONCURRENT_REQUESTS PIPELINE_MODE ROUTER_DEADLINE_SECONDS RETRIEVAL_DEADLINE_SECONDS \
+    RESPONSE_CACHE_SIMILARITY RESPONSE_CACHE_SIZE RESPONSE_CACHE_TTL_SECONDS RESPONSE_CACHE_MAX_HISTORY_TURNS KB_VERSION_POLL_SECONDS \
+    PROMPT_MAX_TOKENS PROMPT_MIN_HISTORY_TURNS SINGLE_FLIGHT SINGLE_FLIGHT_MAX_HISTORY_TURNS \
+    CONVERSATION_STORE CONVERSATION_STORE_URL CONVERSATION_WINDOW_TURNS CONVERSATION_IDLE_TTL_SECONDS CONVERSATION_MAX_SESSIONS \
+    LOG_LEVEL TRACE_SAMPLE_RATE TRACE_EXPORTER; do
+    if [ -n "${!name}" ]; then
+        printf '%s: %s\n' "$name" "$(printf '%s' "${!name}" | python3 -c 'import json, sys; print(json.dumps(sys.stdin.read()))')" >> "$ENV_VARS_FILE"
+    fi
+done
+
 gcloud run deploy lunar-support-ai-ui \
 --source src \
 --region $GCP_REGION \
@@ -36,12 +60,8 @@ gcloud run deploy lunar-support-ai-ui \
 --max-instances 3 \
 --cpu 1 \
 --memory 512Mi \
---timeout 20 \
+--timeout 60 \
+--concurrency $MAX_CONCURRENT_REQUESTS \
 --session-affinity \
---set-env-vars GCP_PROJECT_ID=$GCP_PROJECT_ID \
---set-env-vars GCP_REGION=$GCP_REGION \
---set-env-vars BRAND=$BRAND \
---set-env-vars BRAND_LOGO_IMG=$BRAND_LOGO_IMG \
---set-env-vars APP_BACKGROUND_IMG=$APP_BACKGROUND_IMG \
---set-env-vars EMBEDDING_MODEL_NAME=$EMBEDDING_MODEL_NAME \
+--env-vars-file "$ENV_VARS_FILE" \
 --allow-unauthenticated
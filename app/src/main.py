@@ -14,121 +14,457 @@
 
 import os
 import json
-import re
-from flask import Flask, render_template, request, jsonify
-from modules import llm, prompt_template, utils, bq
+import time
+import asyncio
+from quart import Quart, Response, render_template, request, jsonify
+from modules import llm, prompt_template, utils, bq, embeddings, router, pipeline, response_cache, conversation_store, retrieval_filters, reranker, telemetry, single_flight, resilience
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 gcp_project_id = os.environ.get('GCP_PROJECT_ID','')
 gcp_region = os.environ.get('GCP_REGION','')
 brand = os.environ.get('BRAND','')
 
-llm_client = llm.GCP_GenAI(GCP_PROJECT_ID=gcp_project_id, GCP_REGION=gcp_region)
-bq_obj = bq.BQClient()
+# Max /chat requests processed at once by this instance. Keep in line with the
+# Cloud Run --concurrency setting in deploy_run.sh.
+max_concurrent_requests = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 80))
+
+# How often to check the knowledge base tables for reloads by the loader scripts
+kb_version_poll_seconds = int(os.environ.get('KB_VERSION_POLL_SECONDS', 300))
+kb_tables = sorted(set(pipeline.ROUTE_TABLES.values()))
+
+# Route-specific retrieval partitions: article topic per support route, genres and
+# release years named in media questions. KB_LANG optionally restricts articles to a language.
+retrieval_filters_enabled = os.environ.get('RETRIEVAL_FILTERS', 'true').lower() == 'true'
+kb_lang = os.environ.get('KB_LANG', '')
+
+# Retrieved rows are reranked and trimmed to RERANK_TOP_N snippets within KB_TOKEN_BUDGET before prompting
+kb_reranker = reranker.Reranker(
+    top_n=int(os.environ.get('RERANK_TOP_N', 5)),
+    token_budget=int(os.environ.get('KB_TOKEN_BUDGET', 1500)),
+    mmr_lambda=float(os.environ.get('RERANK_MMR_LAMBDA', 0.7)),
+)
+
+# Clients are created once per process in startup()
+llm_client = None
+embedding_client = None
+bq_obj = None
+intent_router = None
+chat_pipeline = None
+answer_cache = None
+request_slots = None
+
+# Chat history is kept server-side, keyed by session_id
+conversations = conversation_store.ConversationStore(
+    conversation_store.create_backend(
+        os.environ.get('CONVERSATION_STORE', 'memory'),
+        url=os.environ.get('CONVERSATION_STORE_URL', ''),
+        max_sessions=int(os.environ.get('CONVERSATION_MAX_SESSIONS', 10000)),
+        idle_ttl_seconds=int(os.environ.get('CONVERSATION_IDLE_TTL_SECONDS', 1800)),
+    ),
+    window_turns=int(os.environ.get('CONVERSATION_WINDOW_TURNS', 6)),
+)
+
+# Identical questions in flight at the same time (same route and short history) share one
+# router / retrieval pass and one Gemini generation
+flights = single_flight.SingleFlight(
+    max_history_turns=int(os.environ.get('SINGLE_FLIGHT_MAX_HISTORY_TURNS', 1)),
+    enabled=os.environ.get('SINGLE_FLIGHT', 'true').lower() == 'true',
+)
+
+# Deadlines, retries and hedging per upstream stage (UPSTREAM_POLICIES overrides stages of
+# resilience.UPSTREAM_POLICIES as JSON), and a circuit breaker per dependency
+upstream_policies = {**resilience.UPSTREAM_POLICIES, **json.loads(os.environ.get('UPSTREAM_POLICIES') or '{}')}
+circuit_failure_threshold = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+circuit_reset_seconds = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+
+# Served when Gemini is unavailable and no cached answer is close enough
+DEGRADED_RESPONSE = "Sorry, I'm having trouble answering right now. Please try again in a few minutes."
+
+# Per-stage spans for every request, exported for TRACE_SAMPLE_RATE of them (and every failed one)
+telemetry_obj = telemetry.Telemetry(
+    sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 0.1)),
+    exporter=os.environ.get('TRACE_EXPORTER', 'log'),
+)
+
+# Brand specific prompt parts are rendered once at import time
+prompt_builder = prompt_template.PromptBuilder(
+    brand,
+    max_tokens=int(os.environ.get('PROMPT_MAX_TOKENS', 8000)),
+    min_history_turns=int(os.environ.get('PROMPT_MIN_HISTORY_TURNS', 2)),
+)
+
+async def llm_router(user_comment):
+    return await llm_client.generate_async(prompt_template.prompt_router.format(
+        user_comment=user_comment
+    ), stage='router', validate=router.is_route)
+
+def route_filters(route, user_comment):
+    if not retrieval_filters_enabled:
+        return []
+    return retrieval_filters.route_filters(route, user_comment, lang=kb_lang)
+
+def upstream(name):
+    return resilience.Upstream(name, policies=upstream_policies, breaker=resilience.CircuitBreaker(
+        name,
+        failure_threshold=circuit_failure_threshold,
+        reset_seconds=circuit_reset_seconds,
+    ))
+
+def load_clients():
+    global llm_client, embedding_client, bq_obj, intent_router, chat_pipeline, answer_cache
+
+    # Router calls and short FAQ answers start on the small tier and escalate on empty or low-confidence output
+    llm_client = llm.GCP_GenAI(GCP_PROJECT_ID=gcp_project_id, GCP_REGION=gcp_region, cascade=llm.ModelCascade(
+        tiers=json.loads(os.environ['MODEL_TIERS']) if os.environ.get('MODEL_TIERS') else llm.MODEL_TIERS,
+        simple_prompt_tokens=int(os.environ.get('CASCADE_SIMPLE_PROMPT_TOKENS', 1500)),
+        min_avg_logprob=float(os.environ.get('CASCADE_MIN_AVG_LOGPROB', -1.0)),
+    ), upstream=upstream('gemini'))
+    llm_client.warm()
+    embedding_client = embeddings.EmbeddingClient(
+        llm_client,
+        max_size=int(os.environ.get('EMBEDDING_CACHE_SIZE', 10000)),
+        ttl_seconds=int(os.environ.get('EMBEDDING_CACHE_TTL_SECONDS', 3600)),
+        upstream=upstream('embeddings'),
+    )
+    bq_obj = bq.BQClient(
+        embed_fn=embedding_client.embed,
+        retrieval_mode=os.environ.get('RETRIEVAL_MODE', 'hybrid'),
+        top_k=int(os.environ.get('RETRIEVAL_TOP_K', 20)),
+        fusion_candidates=int(os.environ.get('RETRIEVAL_FUSION_CANDIDATES', 50)),
+        result_cache_size=int(os.environ.get('RETRIEVAL_CACHE_SIZE', 2000)),
+        result_cache_ttl_seconds=int(os.environ.get('RETRIEVAL_CACHE_TTL_SECONDS', 600)),
+        upstream=upstream('bigquery'),
+    )
+
+    # Snapshot the embeddings tables into in-process vector indexes. Tables that fail
+    # to load (or are left out of VECTOR_INDEX_TABLES) are queried in BigQuery instead.
+    for table_id in os.environ.get('VECTOR_INDEX_TABLES','webdata_embeddings,articledata_embeddings').split(','):
+        if table_id.strip():
+            bq_obj.load_index(table_id.strip(), backend=os.environ.get('VECTOR_INDEX_BACKEND','numpy'))
+    bq_obj.refresh_table_versions(kb_tables)
+
+    intent_router = router.IntentRouter(
+        stages=[
+            router.KeywordStage(),
+            router.CentroidStage(
+                embed_fn=embedding_client.embed_async,
+                embed_many_fn=embedding_client.embed_many,
+                temperature=float(os.environ.get('ROUTER_CENTROID_TEMPERATURE', 0.15)),
+            ),
+        ],
+        fallback_fn=llm_router,
+        confidence_threshold=float(os.environ.get('ROUTER_CONFIDENCE_THRESHOLD', 0.75)),
+    )
+
+    answer_cache = response_cache.ResponseCache(
+        similarity_threshold=float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0.95)),
+        max_size=int(os.environ.get('RESPONSE_CACHE_SIZE', 2000)),
+        ttl_seconds=int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 3600)),
+        max_history_turns=int(os.environ.get('RESPONSE_CACHE_MAX_HISTORY_TURNS', 1)),
+    )
+
+    chat_pipeline = pipeline.ChatPipeline(
+        intent_router,
+        bq_obj,
+        embedding_client,
+        response_cache=answer_cache,
+        filters_fn=route_filters,
+        mode=os.environ.get('PIPELINE_MODE', 'concurrent'),
+        router_deadline=float(os.environ.get('ROUTER_DEADLINE_SECONDS', 3)),
+        retrieval_deadline=float(os.environ.get('RETRIEVAL_DEADLINE_SECONDS', 5)),
+    )
+
+@app.before_serving
+async def startup():
+    global request_slots
+
+    # Client setup and index snapshots are blocking, keep them off the event loop
+    await asyncio.to_thread(load_clients)
+    request_slots = asyncio.Semaphore(max_concurrent_requests)
+    app.add_background_task(watch_kb_versions)
+
+async def watch_kb_versions():
+    '''
+        Invalidates cached responses (and reloads vector indexes) when a knowledge
+        base table is rebuilt by the loader / embeddings scripts.
+    '''
+    while True:
+        await asyncio.sleep(kb_version_poll_seconds)
+        for table_id in await asyncio.to_thread(bq_obj.refresh_table_versions, kb_tables):
+            answer_cache.invalidate(table_id)
 
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    # Extract data from the request payload
-    data = request.json
-    user_comment = data.get('user_comment', '')
-    chat_history = data.get('chat_history', [])
-    try:
-        llm_route = llm_client.call_gemini(prompt=prompt_template.prompt_router.format(
-            user_comment=user_comment
-        )).strip()
-        print(f'llm route: {llm_route}')
+@app.route('/stats')
+async def stats():
+    return jsonify({
+        "embeddings": embedding_client.stats(),
+        "router": intent_router.stats(),
+        "pipeline": chat_pipeline.stats(),
+        "retrieval": bq_obj.stats(),
+        "rerank": kb_reranker.stats(),
+        "response_cache": answer_cache.stats(),
+        "prompt": prompt_builder.stats(),
+        "conversations": conversations.stats(),
+        "single_flight": flights.stats(),
+        "models": llm_client.cascade.stats(),
+        "upstreams": {
+            "gemini": llm_client.upstream.stats(),
+            "embeddings": embedding_client.upstream.stats(),
+            "bigquery": bq_obj.upstream.stats(),
+        },
+        "telemetry": telemetry_obj.stats(),
+    })
+
+@app.route('/metrics')
+async def metrics():
+    return Response(telemetry_obj.metrics(), mimetype='text/plain; version=0.0.4')
+
+def build_prompt(user_comment, chat_history, pipeline_result):
+    '''
+        Formats the knowledge base retrieved by the chat pipeline and returns the full prompt.
+    '''
+    llm_route = pipeline_result['route']
+    catalog_results = pipeline_result['catalog_results']
 
-        # Retrieve Knowledge Base
+    with telemetry.span('prompt_build', route=llm_route) as span:
+        # Knowledge Base snippets are precomputed per row when the index is loaded, then reranked and trimmed
+        rerank_stats = None
         if llm_route in ['recommendations','media']:
-            print(f'Retrieving Media Knowledge Base')
-            catalog_results = bq_obj.query(user_query=user_comment, table_id='webdata_embeddings')
-
-            catalog_results_processed = ''
-            for catalog_result in catalog_results:
-                for k,v in dict(catalog_result).items():
-                    if k in ['releaseYear', 'runtime', 'mediaId', 'logLine', 'contentType', 'studio', 'title', 'content']:
-                        if k == 'content':
-                            json_content = json.loads(dict(catalog_result)['content'])
-                            for k2,v2 in json_content.items():
-                                if k2 in ['minReleaseYear','maxReleaseYear','studio','formattedEpisodeCount','formattedSeasonCount']:
-                                    catalog_results_processed += f'{k2}:\t{v2}\n'
-                                elif k2 in ['childContent']:
-                                    match = re.search(r"'episodeLabel':\s*'([^']+)'", f"{json_content['childContent'][0]}")
-                                    if match:
-                                        catalog_results_processed += f'episodeLabel:\t{match.group(1)}\n'
-
-                        else:
-                            catalog_results_processed += f'{k}:\t{v}\n'
-                
-                catalog_results_processed += '\n'
-
-            prompt=prompt_template.prompt_persona.format(brand=brand) + '\n' + prompt_template.prompt_media.format(
-                user_comment=user_comment,
-                chat_history=json.dumps(chat_history),
-                knowledge_base=catalog_results_processed,
-                brand=brand
-            )
+            kb_snippets, rerank_stats = kb_reranker.select(user_comment, catalog_results, pipeline_result['table_id'], route=llm_route)
+            prompt = prompt_builder.build('media', user_comment, chat_history, kb_snippets, route=llm_route)
         elif llm_route in ['cancellation','payments','login']:
-            print(f'Retrieving Article Knowledge Base')
-            catalog_results = bq_obj.query(user_query=user_comment, table_id='articledata_embeddings')
-            catalog_results = '\n'.join([json.dumps(dict(c)) for c in catalog_results])
-
-            prompt=prompt_template.prompt_persona.format(brand=brand) + '\n' + prompt_template.prompt_support.format(
-                user_comment=user_comment,
-                chat_history=json.dumps(chat_history),
-                knowledge_base=catalog_results,
-                brand=brand
-            )
+            kb_snippets, rerank_stats = kb_reranker.select(user_comment, catalog_results, pipeline_result['table_id'], route=llm_route)
+            prompt = prompt_builder.build('support', user_comment, chat_history, kb_snippets, route=llm_route)
         else:
-            prompt=prompt_template.prompt_persona.format(brand=brand) + '\n' + prompt_template.prompt_support.format(
-                user_comment=user_comment,
-                chat_history=json.dumps(chat_history),
-                knowledge_base='',
-                brand=brand
-            )
-
-        # LLM Response
-        print(f'Prompt: {prompt}')
-        llm_response = llm_client.call_gemini(prompt)
-        llm_response = utils.format_summary(llm_response)
-        agent_response = f"{llm_response}"
+            prompt = prompt_builder.build('support', user_comment, chat_history, route=llm_route)
 
-        # Chat History
-        chat_history.append({"user": user_comment, "agent": agent_response})
+        span.set(**{'prompt.tokens': len(prompt) // prompt_template.CHARS_PER_TOKEN, 'kb.rows': len(catalog_results)})
+        if rerank_stats is not None:
+            span.set(**{'kb.rows_out': rerank_stats['rows_out'], 'kb.tokens_saved': rerank_stats['tokens_saved']})
+
+    return prompt
+
+async def generate_response(prompt, route):
+    '''
+        Gemini call through the model cascade in a "generation" span. Token counts are
+        estimated from characters, the llm.call spans below carry the reported ones.
+    '''
+    with telemetry.span('generation', **{'gen_ai.system': 'vertex_ai'}) as span:
+        llm_response = await llm_client.generate_async(prompt, stage='answer', route=route)
+        span.set(**{
+            'gen_ai.usage.input_tokens': len(prompt) // prompt_template.CHARS_PER_TOKEN,
+            'gen_ai.usage.output_tokens': len(llm_response) // prompt_template.CHARS_PER_TOKEN,
+        })
+    return llm_response
+
+async def answer(user_comment, chat_history, pipeline_result):
+    '''
+        Prompt, Gemini call and formatting for a pipeline result that missed the response cache.
+    '''
+    prompt = build_prompt(user_comment, chat_history, pipeline_result)
+
+    # LLM Response
+    start_time = time.perf_counter()
+    llm_response = await generate_response(prompt, pipeline_result['route'])
+    agent_response = format_response(llm_response)
+    cache_response(pipeline_result, chat_history, agent_response, (time.perf_counter() - start_time) * 1000)
+    return agent_response
+
+async def run_pipeline(user_comment, chat_history, trace):
+    pipeline_result, joined = await flights.do(
+        flights.key('pipeline', user_comment, chat_history),
+        lambda: chat_pipeline.run(user_comment, chat_history),
+    )
+    trace.set(**{'coalesced.pipeline': joined})
+    return pipeline_result
+
+def format_response(llm_response):
+    with telemetry.span('formatting', chars=len(llm_response)):
+        return utils.format_summary(llm_response)
 
-        # Response Payload
-        response_payload = {
-            "agent_response": agent_response,
-            "chat_history": chat_history
-        }
+def build_fallback_prompt(user_comment, chat_history):
+    return prompt_builder.build('media', user_comment, chat_history, route='fallback')
+
+async def fallback_response(user_comment, chat_history, error, trace):
+    '''
+        Answer when the main path failed. A failure of the app itself gets one knowledge
+        base-less answer while Gemini is available. When Gemini failed (deadline exceeded,
+        circuit open) it is not called again: the closest cached answer is served, or
+        DEGRADED_RESPONSE.
+    '''
+    if not isinstance(error, resilience.UpstreamError) and llm_client.upstream.available():
+        try:
+            llm_response = await generate_response(build_fallback_prompt(user_comment, chat_history), 'fallback')
+            if llm_response:
+                trace.set(fallback='kb_less')
+                return format_response(llm_response)
+        except Exception as e:
+            print(f'[ EXCEPTION ] {e}')
+
+    try:
+        agent_response = answer_cache.lookup_fallback(await embedding_client.embed_async(user_comment), chat_history)
     except Exception as e:
         print(f'[ EXCEPTION ] {e}')
+        agent_response = None
+    trace.set(fallback='cached' if agent_response is not None else 'static')
+    return agent_response if agent_response is not None else format_response(DEGRADED_RESPONSE)
+
+def sse_event(event, payload):
+    return f'event: {event}\ndata: {json.dumps(payload)}\n\n'
 
-        # LLM Response
-        prompt=prompt_template.prompt_persona.format(brand=brand) + '\n' + prompt_template.prompt_media.format(
-            user_comment=user_comment,
-            chat_history=json.dumps(chat_history),
-            knowledge_base=''
+def cache_response(pipeline_result, chat_history, agent_response, generation_ms):
+    if pipeline_result is not None and pipeline_result['query_embedding'] is not None:
+        answer_cache.put(
+            pipeline_result['query_embedding'],
+            pipeline_result['route'],
+            pipeline_result['kb_version'],
+            agent_response,
+            cost_ms=pipeline_result['timings']['end_to_end'] + generation_ms,
+            table_id=pipeline_result['table_id'],
+            chat_history=chat_history,
         )
-        llm_response = llm_client.call_gemini(prompt)
-        llm_response = utils.format_summary(llm_response)
-        agent_response = f"{llm_response}"
+
+async def load_conversation(data):
+    '''
+        Returns (session_id, chat_history) for a /chat payload. Clients send session_id and
+        user_comment, a first turn without session_id starts a new session. Older clients
+        send the whole chat_history instead: session_id is None and nothing is stored.
+    '''
+    session_id = data.get('session_id')
+    if session_id is None and 'chat_history' not in data:
+        session_id = conversations.new_session_id()
+    conversation = await asyncio.to_thread(conversations.load, session_id, data.get('chat_history'))
+    return session_id, conversations.history(conversation)
+
+async def save_turn(data, session_id, user_comment, agent_response):
+    if session_id is not None:
+        await asyncio.to_thread(conversations.append, session_id, user_comment, agent_response, data.get('chat_history'))
+
+def response_payload(data, session_id, agent_response):
+    payload = {
+        "agent_response": agent_response,
+    }
+    if session_id is not None:
+        payload["session_id"] = session_id
+    # Older clients still expect the full chat_history back
+    if 'chat_history' in data:
+        payload["chat_history"] = data['chat_history'] + [{"user": data.get('user_comment', ''), "agent": agent_response}]
+    return payload
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    # Extract data from the request payload
+    data = await request.get_json()
+    user_comment = data.get('user_comment', '')
+    with telemetry_obj.trace('chat', endpoint='/chat') as trace:
+        session_id, chat_history = await load_conversation(data)
+
+        async with request_slots:
+            try:
+                pipeline_result = await run_pipeline(user_comment, chat_history, trace)
+                trace.set(route=pipeline_result['route'], route_source=pipeline_result['route_source'])
+                agent_response = pipeline_result['cached_response']
+                trace.set(cached=agent_response is not None)
+
+                if agent_response is None:
+                    agent_response, joined = await flights.do(
+                        flights.key('generation', user_comment, chat_history, route=pipeline_result['route']),
+                        lambda: answer(user_comment, chat_history, pipeline_result),
+                    )
+                    trace.set(**{'coalesced.generation': joined})
+            except Exception as e:
+                print(f'[ EXCEPTION ] {e}')
+                trace.set(route='fallback')
+                agent_response = await fallback_response(user_comment, chat_history, e, trace)
 
         # Chat History
-        chat_history.append({"user": user_comment, "agent": agent_response})
+        await save_turn(data, session_id, user_comment, agent_response)
+
+    return jsonify(response_payload(data, session_id, agent_response))
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    '''
+        Same as /chat, but streams the formatted response as server-sent events:
+        "delta" events carry incremental HTML and a final "done" event carries
+        the full agent_response and the session_id.
+    '''
+    data = await request.get_json()
+    user_comment = data.get('user_comment', '')
+    session_id, chat_history = await load_conversation(data)
+
+    async def generate():
+        with telemetry_obj.trace('chat', endpoint='/chat/stream') as trace:
+            async with request_slots:
+                try:
+                    pipeline_result = await run_pipeline(user_comment, chat_history, trace)
+                    trace.set(route=pipeline_result['route'], route_source=pipeline_result['route_source'])
+                    agent_response = pipeline_result['cached_response']
+                    trace.set(cached=agent_response is not None)
+                    if agent_response is None:
+                        prompt = build_prompt(user_comment, chat_history, pipeline_result)
+                except Exception as e:
+                    print(f'[ EXCEPTION ] {e}')
+                    trace.set(route='fallback')
+                    pipeline_result, agent_response = None, None
+                    prompt = build_fallback_prompt(user_comment, chat_history)
+                llm_route = pipeline_result['route'] if pipeline_result is not None else 'fallback'
+
+                if agent_response is not None:
+                    yield sse_event('delta', {"html": agent_response})
+                else:
+                    start_time = time.perf_counter()
+                    formatter = utils.StreamingFormatter()
+                    formatting_seconds, first_chunk, fallback_text, complete = 0.0, True, None, True
+                    with telemetry.span('generation', **{'gen_ai.system': 'vertex_ai'}) as span:
+                        try:
+                            async for chunk in llm_client.stream_generate_async(prompt, stage='answer', route=llm_route):
+                                if first_chunk:
+                                    span.set(**{'gen_ai.time_to_first_chunk_ms': round((time.perf_counter() - start_time) * 1000, 2)})
+                                    first_chunk = False
+                                format_start = time.perf_counter()
+                                html = formatter.feed(chunk)
+                                formatting_seconds += time.perf_counter() - format_start
+                                if html:
+                                    yield sse_event('delta', {"html": html})
+                        except resilience.UpstreamError as e:
+                            print(f'[ EXCEPTION ] {e}')
+                            if first_chunk:
+                                # Gemini could not be reached, nothing was streamed yet
+                                trace.set(route='fallback')
+                                pipeline_result, fallback_text = None, await fallback_response(user_comment, chat_history, e, trace)
+                                yield sse_event('delta', {"html": fallback_text})
+                            else:
+                                # The stream broke off, the partial answer is not cached
+                                complete = False
+                                trace.set(stream_complete=False)
+
+                        html = formatter.flush()
+                        if html:
+                            yield sse_event('delta', {"html": html})
+
+                        agent_response = formatter.text if fallback_text is None else fallback_text
+                        span.set(**{
+                            'gen_ai.usage.input_tokens': len(prompt) // prompt_template.CHARS_PER_TOKEN,
+                            'gen_ai.usage.output_tokens': len(agent_response) // prompt_template.CHARS_PER_TOKEN,
+                        })
+                    # Formatting is interleaved with the stream, its span covers the summed feed() time
+                    end_time = time.perf_counter()
+                    telemetry.add_span('formatting', end_time - formatting_seconds, end_time, chars=len(agent_response))
+                    if complete:
+                        cache_response(pipeline_result, chat_history, agent_response, (time.perf_counter() - start_time) * 1000)
 
-        # Response Payload
-        response_payload = {
-            "agent_response": agent_response,
-            "chat_history": chat_history
-        }
+            await save_turn(data, session_id, user_comment, agent_response)
+        yield sse_event('done', response_payload(data, session_id, agent_response))
 
-    return jsonify(response_payload)
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
 
 if __name__ == '__main__':
     app.run(port=8080, debug=True)
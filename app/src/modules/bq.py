@@ -13,31 +13,301 @@
 # limitations under the License.
 
 import sys, os
+import re
+import time
+import asyncio
 import logging
+import threading
+import concurrent.futures
+from collections import deque
 from google.cloud import bigquery
+from modules.vector_index import VectorIndex
+from modules.lexical_index import BM25Index, MetadataIndex, reciprocal_rank_fusion
+from modules.embeddings import LRUCache, normalize_text
+from modules.retrieval_filters import FILTER_FIELDS, partition_name
+from modules import kb_snippet, resilience
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
     stream=sys.stdout,
 )
 
+# Table ids are interpolated into the prepared retrieval SQL, everything else is a query parameter
+TABLE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_]+$')
+
+# Seconds between checks for a cancelled retrieval while a BigQuery job runs
+JOB_POLL_SECONDS = 0.25
+
 class BQClient:
-    def __init__(self):
+    def __init__(self, embed_fn=None, retrieval_mode='hybrid', top_k=20, fusion_candidates=50, result_cache_size=2000, result_cache_ttl_seconds=600, upstream=None):
+        '''
+            embed_fn: Optional callable that takes a string and returns its embedding vector.
+                      It must use the same embedding model as the embeddings tables. If not set,
+                      the question is embedded with ML.GENERATE_EMBEDDING in BigQuery.
+            retrieval_mode: 'hybrid' fuses BM25 and vector results of the local indexes with
+                      reciprocal rank fusion, 'vector' uses the vector index only.
+            top_k: Number of rows returned when query() is called without k.
+            fusion_candidates: Number of rows taken from each ranking before fusion.
+            result_cache_size, result_cache_ttl_seconds: Bounds of the memo of query results,
+                      keyed on (table, table version, k, normalized question).
+            upstream: resilience.Upstream of the BigQuery calls. Retrieval and question
+                      embedding queries use the 'retrieval' stage, index snapshots the
+                      'snapshot' stage. Its deadlines become the job timeouts.
+        '''
         self.bq_client = bigquery.Client()
         self.embedding_model_name = os.environ.get('EMBEDDING_MODEL_NAME','')
-    
-    def query(self, user_query, table_id):
-        print(f'Querying BigQuery Table: {table_id}')
+        self.dataset_id = os.environ.get('BQ_DATASET_ID','lunar_data_ds')
+        self.embed_fn = embed_fn
+        self.retrieval_mode = retrieval_mode
+        self.top_k = top_k
+        self.fusion_candidates = fusion_candidates
+        self.indexes = {}
+        self.lexical_indexes = {}
+        self.metadata_indexes = {}
+        self.result_cache = LRUCache(max_size=result_cache_size, ttl_seconds=result_cache_ttl_seconds)
+        self._retrieval_sql = {}
+        self.upstream = upstream or resilience.Upstream('bigquery')
+
+        self._stats_lock = threading.Lock()
+        self.sources = {'memo': 0, 'index': 0, 'bigquery': 0}
+        self.job_totals = {'jobs': 0, 'bytes_processed': 0, 'bytes_billed': 0, 'slot_ms': 0, 'cache_hits': 0}
+        self.partition_timings = {}
+        self.index_backends = {}
+        self.table_versions = {}
+
+    def load_index(self, table_id, backend='numpy'):
+        '''
+            Snapshots the text_embedding column of table_id into an in-process VectorIndex,
+            its text columns into a BM25Index in hybrid mode, and its metadata columns
+            into a MetadataIndex for filtered searches.
+            The prompt snippet of every row is built here, once per snapshot.
+            If the snapshot fails, queries against table_id keep using BigQuery.
+        '''
+        try:
+            print(f'Loading vector index for BigQuery Table: {table_id}')
+            rows = self._general_query(f'select * from `{self.dataset_id}.{table_id}`')
+            index = VectorIndex(rows, embedding_column='text_embedding', backend=backend)
+            kb_snippet.attach_snippets(index.rows, table_id)
+            if self.retrieval_mode == 'hybrid':
+                self.lexical_indexes[table_id] = BM25Index(index.rows)
+            self.metadata_indexes[table_id] = MetadataIndex(index.rows, FILTER_FIELDS)
+            self.indexes[table_id] = index
+            self.index_backends[table_id] = backend
+        except Exception as e:
+            logging.exception(f'Unable to load vector index for {table_id}. Falling back to BigQuery. {e}')
+
+    def table_version(self, table_id):
+        '''
+            Version of the knowledge base in table_id (its last-modified time), as of the last refresh.
+        '''
+        return self.table_versions.get(table_id, '')
+
+    def refresh_table_versions(self, table_ids):
+        '''
+            Re-reads the last-modified time of each table, reloads the vector index of
+            tables that changed since the previous refresh and returns their ids.
+        '''
+        changed = []
+        for table_id in table_ids:
+            try:
+                modified = self.bq_client.get_table(f'{self.dataset_id}.{table_id}', timeout=self.upstream.policy('retrieval')['deadline']).modified
+            except Exception as e:
+                logging.exception(f'Unable to read the version of {table_id}. {e}')
+                continue
+
+            version = modified.isoformat() if modified else ''
+            previous = self.table_versions.get(table_id)
+            self.table_versions[table_id] = version
+            if previous is not None and previous != version:
+                print(f'BigQuery Table {table_id} changed. Previous version: {previous}. New version: {version}')
+                changed.append(table_id)
+                if table_id in self.indexes:
+                    self.load_index(table_id, backend=self.index_backends[table_id])
+
+        return changed
+
+    def query(self, user_query, table_id, k=None, query_embedding=None, filters=None):
+        '''
+            query_embedding: Optional precomputed embedding of user_query. When set, neither
+                             the local index nor BigQuery re-embeds the question.
+            filters: Optional retrieval filters (see retrieval_filters) restricting the
+                             search to a partition of the table.
+        '''
+        return self.query_with_stats(user_query, table_id, k=k, query_embedding=query_embedding, filters=filters)[0]
+
+    def has_index(self, table_id):
+        return table_id in self.indexes
+
+    def query_with_stats(self, user_query, table_id, k=None, query_embedding=None, filters=None, cancelled=None):
+        '''
+            Returns (rows, job_stats). job_stats['source'] is 'memo', 'index' or 'bigquery' and
+            job_stats['partition'] names the filters that were applied ('all' for none).
+            BigQuery calls also report job_id, bytes_processed, bytes_billed, slot_ms and cache_hit.
+
+            cancelled: Optional threading.Event. Once it is set, a running BigQuery job is
+                       cancelled and asyncio.CancelledError is raised.
+        '''
+        start_time = time.perf_counter()
+        k = k or self.top_k
+        filters = filters or []
+        memo_key = (table_id, self.table_versions.get(table_id, ''), k, partition_name(filters), normalize_text(user_query))
+        cached = self.result_cache.get(memo_key)
+        if cached is not None:
+            rows, partition = cached
+            return list(rows), self._record(table_id, {'source': 'memo', 'partition': partition}, start_time)
+
+        results = None
+        index = self.indexes.get(table_id)
+        if index is not None:
+            try:
+                if query_embedding is None:
+                    query_embedding = self._embed_query(user_query)
+                candidates, applied = None, []
+                metadata_index = self.metadata_indexes.get(table_id)
+                # The indexes must come from the same snapshot, which is not the case mid-reload
+                if filters and metadata_index is not None and metadata_index.rows is index.rows:
+                    candidates, applied = metadata_index.candidates(filters)
+                results = self._search_index(table_id, index, user_query, query_embedding, k, candidates)
+                if candidates is not None and len(results) < k:
+                    # A small partition is topped up with the best rows from the rest of the table
+                    seen = {id(row) for row in results}
+                    results += [row for row in self._search_index(table_id, index, user_query, query_embedding, k, None) if id(row) not in seen][:k - len(results)]
+                job_stats = {'source': 'index', 'partition': partition_name(applied), 'candidates': len(index) if candidates is None else len(candidates)}
+            except Exception as e:
+                logging.exception(f'Index search on {table_id} failed. Falling back to BigQuery. {e}')
+
+        if results is None:
+            results, job_stats = self._query_bigquery(user_query, table_id, k=k, query_embedding=query_embedding, filters=filters, cancelled=cancelled)
+            if not results and filters:
+                logging.info(f'No rows in partition {partition_name(filters)} of {table_id}. Retrying without filters.')
+                results, job_stats = self._query_bigquery(user_query, table_id, k=k, query_embedding=query_embedding, cancelled=cancelled)
+
+        self.result_cache.put(memo_key, (results, job_stats['partition']))
+        return list(results), self._record(table_id, job_stats, start_time)
+
+    def _search_index(self, table_id, index, user_query, query_embedding, k, candidates):
+        lexical_index = self.lexical_indexes.get(table_id)
+        if lexical_index is not None and lexical_index.rows is index.rows:
+            depth = max(k, self.fusion_candidates)
+            return reciprocal_rank_fusion([
+                index.search(query_embedding, k=depth, candidates=candidates),
+                lexical_index.search(user_query, k=depth, candidates=candidates),
+            ], k=k)
+        return [row for row, score in index.search(query_embedding, k=k, candidates=candidates)]
+
+    async def query_async(self, user_query, table_id, k=None, query_embedding=None, filters=None):
+        '''
+            Awaitable wrapper of query, not async I/O. The BigQuery client library is
+            blocking, so asyncio.to_thread runs the sync call on a thread of the default
+            executor. The event loop stays free, but each call holds a thread until it returns.
+        '''
+        return await asyncio.to_thread(self.query, user_query, table_id, k=k, query_embedding=query_embedding, filters=filters)
+
+    async def query_with_stats_async(self, user_query, table_id, k=None, query_embedding=None, filters=None):
+        '''
+            Awaitable wrapper of query_with_stats on asyncio.to_thread (see query_async).
+            Cancelling the awaiting task does not stop the worker thread, so it also
+            cancels the BigQuery job the thread is waiting on.
+        '''
+        cancelled = threading.Event()
+        try:
+            return await asyncio.to_thread(self.query_with_stats, user_query, table_id, k=k, query_embedding=query_embedding, filters=filters, cancelled=cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    def _record(self, table_id, job_stats, start_time):
+        job_stats['ms'] = round((time.perf_counter() - start_time) * 1000, 2)
+        with self._stats_lock:
+            self.sources[job_stats['source']] += 1
+            if job_stats['source'] != 'memo':
+                self.partition_timings.setdefault(f"{table_id}/{job_stats['partition']}", deque(maxlen=1000)).append(job_stats['ms'])
+            if job_stats['source'] == 'bigquery':
+                self.job_totals['jobs'] += 1
+                self.job_totals['bytes_processed'] += job_stats['bytes_processed'] or 0
+                self.job_totals['bytes_billed'] += job_stats['bytes_billed'] or 0
+                self.job_totals['slot_ms'] += job_stats['slot_ms'] or 0
+                self.job_totals['cache_hits'] += int(bool(job_stats['cache_hit']))
+        logging.debug(f'Retrieval: {job_stats}')
+        return job_stats
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'top_k': self.top_k,
+                'retrieval_mode': self.retrieval_mode,
+                'sources': dict(self.sources),
+                'bigquery': dict(self.job_totals),
+                'result_cache': self.result_cache.stats(),
+                'partitions': {partition: self._summary(timings) for partition, timings in self.partition_timings.items()},
+            }
+
+    def _summary(self, timings):
+        ordered = sorted(timings)
+        return {
+            'count': len(ordered),
+            'avg_ms': round(sum(ordered) / len(ordered), 2),
+            'p50_ms': round(ordered[len(ordered) // 2], 2),
+            'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+        }
+
+    def _embed_query(self, user_query):
+        if self.embed_fn is not None:
+            return self.embed_fn(user_query)
 
         query = f'''
-with query_embeddings as (
+select ml_generate_embedding_result from
+ML.GENERATE_EMBEDDING(MODEL `{self.dataset_id}.{self.embedding_model_name}`,
+    (select @user_query as content),
+    STRUCT(TRUE as flatten_json_output)
+)
+        '''
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('user_query', 'STRING', user_query)]
+        )
+        rows = self.upstream.call_sync('retrieval', lambda timeout: self.bq_client.query_and_wait(query, job_config=job_config, wait_timeout=timeout))
+        return list(rows)[0]['ml_generate_embedding_result']
+
+    def _retrieval_query(self, table_id, embed_in_bigquery, filter_fields=()):
+        '''
+            Prepared retrieval SQL for table_id. The SQL text is identical for every question,
+            so BigQuery can reuse its cached results and plan. filter_fields holds the columns
+            of each filter, matched against the @filter_<i> regular expressions. The filters
+            narrow the rows ranked, they do not reduce the bytes scanned (see retrieval_filters).
+        '''
+        key = (table_id, embed_in_bigquery, filter_fields)
+        sql = self._retrieval_sql.get(key)
+        if sql is not None:
+            return sql
+
+        if not TABLE_ID_PATTERN.match(table_id) or not TABLE_ID_PATTERN.match(self.dataset_id):
+            raise ValueError(f'Invalid table id: {self.dataset_id}.{table_id}')
+        if any(field not in FILTER_FIELDS for fields in filter_fields for field in fields):
+            raise ValueError(f'Invalid filter fields: {filter_fields}')
+
+        where_sql = ''
+        if filter_fields:
+            conditions = [
+                "regexp_contains(lower(concat(" + ", ' ', ".join(f"ifnull(cast(s.`{field}` as string), '')" for field in fields) + f")), @filter_{i})"
+                for i, fields in enumerate(filter_fields)
+            ]
+            where_sql = '\n  where\n    ' + '\n    and '.join(conditions)
+
+        if embed_in_bigquery:
+            query_embeddings_sql = f'''
     select ml_generate_embedding_result from 
-    ML.GENERATE_EMBEDDING(MODEL `lunar_data_ds.{self.embedding_model_name}`,
-        (select "{user_query}" as content),
+    ML.GENERATE_EMBEDDING(MODEL `{self.dataset_id}.{self.embedding_model_name}`,
+        (select @user_query as content),
         STRUCT(TRUE as flatten_json_output)
-    )
+    )'''
+        else:
+            query_embeddings_sql = '''
+    select @query_embedding as ml_generate_embedding_result'''
+
+        sql = f'''
+with query_embeddings as ({query_embeddings_sql}
 ),
 top_matches as (
   select 
@@ -47,25 +317,76 @@ top_matches as (
       q.ml_generate_embedding_result, 
       'COSINE') as distance
   from
-    `lunar_data_ds.{table_id}` s,
-    query_embeddings q
+    `{self.dataset_id}.{table_id}` s,
+    query_embeddings q{where_sql}
   order by 
     distance ASC
-  limit 20
+  limit @k
 )
 
 select * except (distance)
 from top_matches
 order by distance ASC
         '''
+        self._retrieval_sql[key] = sql
+        return sql
 
-        logging.debug(f'BigQuery query: {query}')
+    def _query_bigquery(self, user_query, table_id, k=None, query_embedding=None, filters=None, cancelled=None):
+        filters = filters or []
+        logging.debug(f'Querying BigQuery Table: {table_id} ({partition_name(filters)})')
 
-        rows = self.bq_client.query_and_wait(query)
-        results = [r for r in rows]
-        return results
+        query_parameters = [bigquery.ScalarQueryParameter('k', 'INT64', k or self.top_k)]
+        if query_embedding is not None:
+            query_parameters.append(bigquery.ArrayQueryParameter('query_embedding', 'FLOAT64', list(query_embedding)))
+        else:
+            query_parameters.append(bigquery.ScalarQueryParameter('user_query', 'STRING', user_query))
+        for i, f in enumerate(filters):
+            pattern = '(^|[^a-z0-9])(' + '|'.join(re.escape(term) for term in f['terms']) + ')([^a-z0-9]|$)'
+            query_parameters.append(bigquery.ScalarQueryParameter(f'filter_{i}', 'STRING', pattern))
+
+        query = self._retrieval_query(table_id, embed_in_bigquery=query_embedding is None, filter_fields=tuple(tuple(f['fields']) for f in filters))
+        if cancelled is not None and cancelled.is_set():
+            raise asyncio.CancelledError()
+        job, rows = self.upstream.call_sync('retrieval', lambda timeout: self._run_job(query, bigquery.QueryJobConfig(query_parameters=query_parameters), timeout, cancelled))
+        results = kb_snippet.attach_snippets(rows, table_id)
+
+        job_stats = {
+            'source': 'bigquery',
+            'partition': partition_name(filters),
+            'job_id': job.job_id,
+            'bytes_processed': job.total_bytes_processed,
+            'bytes_billed': job.total_bytes_billed,
+            'slot_ms': job.slot_millis,
+            'cache_hit': job.cache_hit,
+        }
+        return results, job_stats
     
+    def _run_job(self, query, job_config, timeout, cancelled=None):
+        '''
+            Returns (job, rows). A job still running after timeout seconds, or once the
+            cancelled event is set, is cancelled.
+        '''
+        deadline = time.monotonic() + timeout
+        job = self.bq_client.query(query, job_config=job_config, timeout=timeout)
+        try:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    # CancelledError is not an Exception, the upstream layer does not retry it
+                    raise asyncio.CancelledError()
+                remaining = deadline - time.monotonic()
+                try:
+                    return job, [dict(r) for r in job.result(timeout=max(0.0, min(JOB_POLL_SECONDS, remaining)))]
+                except concurrent.futures.TimeoutError:
+                    if remaining <= JOB_POLL_SECONDS:
+                        raise
+        except BaseException:
+            try:
+                self.bq_client.cancel_job(job.job_id, location=job.location)
+            except Exception as e:
+                logging.warning(f'Unable to cancel BigQuery job {job.job_id}. {e}')
+            raise
+
     def _general_query(self, query_str):
-        rows = self.bq_client.query_and_wait(query_str)
+        rows = self.upstream.call_sync('snapshot', lambda timeout: self.bq_client.query_and_wait(query_str, wait_timeout=timeout))
         results = [r for r in rows]
         return results
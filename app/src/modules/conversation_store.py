@@ -0,0 +1,268 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+class InMemoryBackend:
+    '''
+        Per-instance session store. Idle sessions expire after idle_ttl_seconds and
+        the least recently used sessions are evicted beyond max_sessions. Relies on
+        Cloud Run session affinity to keep a conversation on one instance.
+    '''
+
+    def __init__(self, max_sessions=10000, idle_ttl_seconds=1800):
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            data, updated_at = entry
+            if updated_at + self.idle_ttl_seconds < time.time():
+                del self._sessions[session_id]
+                self.evictions += 1
+                return None
+            return json.loads(data)
+
+    def update(self, session_id, fn):
+        '''
+            Stores fn(conversation), conversation being the stored one or None, as one
+            atomic read-modify-write.
+        '''
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            conversation = None
+            if entry is not None and entry[1] + self.idle_ttl_seconds >= time.time():
+                conversation = json.loads(entry[0])
+            conversation = fn(conversation)
+            self._sessions[session_id] = (json.dumps(conversation), time.time())
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+        return conversation
+
+    def stats(self):
+        return {'backend': 'memory', 'sessions': len(self._sessions), 'evictions': self.evictions}
+
+
+class SQLiteBackend:
+    '''
+        Session store in a local SQLite file, shared by every worker on the instance.
+        Updates run in BEGIN IMMEDIATE transactions, which take the write lock of the
+        file before reading, so workers do not overwrite each other's turns.
+    '''
+
+    def __init__(self, path='conversations.db', max_sessions=10000, idle_ttl_seconds=1800):
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('create table if not exists sessions (session_id text primary key, data text, updated_at real)')
+        self._conn.execute('create index if not exists sessions_updated_at on sessions (updated_at)')
+        self._conn.commit()
+        self.evictions = 0
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                'select data from sessions where session_id = ? and updated_at >= ?',
+                (session_id, time.time() - self.idle_ttl_seconds),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, session_id, fn):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('begin immediate')
+            try:
+                row = self._conn.execute(
+                    'select data from sessions where session_id = ? and updated_at >= ?',
+                    (session_id, now - self.idle_ttl_seconds),
+                ).fetchone()
+                conversation = fn(json.loads(row[0]) if row else None)
+                self._conn.execute(
+                    'insert or replace into sessions (session_id, data, updated_at) values (?, ?, ?)',
+                    (session_id, json.dumps(conversation), now),
+                )
+                cursor = self._conn.execute('delete from sessions where updated_at < ?', (now - self.idle_ttl_seconds,))
+                self.evictions += cursor.rowcount
+                cursor = self._conn.execute(
+                    'delete from sessions where session_id in (select session_id from sessions order by updated_at desc limit -1 offset ?)',
+                    (self.max_sessions,),
+                )
+                self.evictions += cursor.rowcount
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return conversation
+
+    def stats(self):
+        with self._lock:
+            sessions = self._conn.execute('select count(*) from sessions').fetchone()[0]
+        return {'backend': 'sqlite', 'sessions': sessions, 'evictions': self.evictions}
+
+
+class RedisBackend:
+    '''
+        Session store in Redis (or any Redis-compatible server such as Memorystore),
+        shared across instances. Idle sessions expire through the key TTL. Updates
+        WATCH the session key and write it in MULTI/EXEC, retrying when another
+        instance changed it in between.
+    '''
+
+    def __init__(self, url='redis://localhost:6379/0', idle_ttl_seconds=1800, key_prefix='lunar:session:'):
+        if redis is None:
+            raise ImportError('The redis package is required for the redis conversation store. pip install redis')
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.key_prefix = key_prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, session_id):
+        data = self._client.get(self.key_prefix + session_id)
+        return json.loads(data) if data else None
+
+    def update(self, session_id, fn):
+        key = self.key_prefix + session_id
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    conversation = fn(json.loads(data) if data else None)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(conversation), ex=self.idle_ttl_seconds)
+                    pipe.execute()
+                    return conversation
+                except redis.WatchError:
+                    continue
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+def create_backend(name='memory', url='', max_sessions=10000, idle_ttl_seconds=1800):
+    if name == 'sqlite':
+        return SQLiteBackend(path=url or 'conversations.db', max_sessions=max_sessions, idle_ttl_seconds=idle_ttl_seconds)
+    if name == 'redis':
+        return RedisBackend(url=url or 'redis://localhost:6379/0', idle_ttl_seconds=idle_ttl_seconds)
+    return InMemoryBackend(max_sessions=max_sessions, idle_ttl_seconds=idle_ttl_seconds)
+
+
+def first_sentence(text, max_chars):
+    text = re.sub(r'<[^>]+>', ' ', f'{text}')
+    text = ' '.join(text.split())
+    match = re.match(r'(.+?[.!?])(\s|$)', text)
+    sentence = match.group(1) if match else text
+    return sentence[:max_chars]
+
+
+class ConversationStore:
+    '''
+        Session-keyed chat history.
+
+        Only the last window_turns turns are kept verbatim. Older turns are folded
+        into a rolling extractive summary (first sentence of each side), capped at
+        summary_max_chars, so the history sent to the prompt stays bounded.
+    '''
+
+    def __init__(self, backend, window_turns=6, summary_max_chars=1500):
+        self.backend = backend
+        self.window_turns = window_turns
+        self.summary_max_chars = summary_max_chars
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def load(self, session_id, seed_history=None):
+        '''
+            Returns the conversation for session_id. A conversation that is not stored
+            (or has no session_id) is seeded from seed_history (chat_history sent by
+            older clients) if given.
+        '''
+        conversation = self.backend.get(session_id) if session_id is not None else None
+        if conversation is None:
+            conversation = self._seed(seed_history)
+        return conversation
+
+    def history(self, conversation):
+        '''
+            Chat history for the prompt: the summary of older turns, then the recent turns.
+        '''
+        if conversation['summary']:
+            return [{'summary': conversation['summary']}] + conversation['turns']
+        return list(conversation['turns'])
+
+    def append(self, session_id, user_comment, agent_response, seed_history=None):
+        '''
+            Adds a turn to the stored conversation in one atomic read-modify-write, so
+            concurrent turns of a session are all kept. A conversation that is not stored
+            starts from seed_history. Returns the updated conversation.
+        '''
+        def add_turn(conversation):
+            conversation = conversation or self._seed(seed_history)
+            self._append(conversation, user_comment, agent_response)
+            return conversation
+        return self.backend.update(session_id, add_turn)
+
+    def _seed(self, seed_history):
+        conversation = {'summary': '', 'turns': []}
+        for turn in seed_history or []:
+            if turn.get('user') or turn.get('agent'):
+                self._append(conversation, turn.get('user') or '', turn.get('agent') or '')
+        return conversation
+
+    def _append(self, conversation, user_comment, agent_response):
+        conversation['turns'].append({'user': user_comment, 'agent': agent_response})
+        if len(conversation['turns']) > self.window_turns:
+            evicted = conversation['turns'][:-self.window_turns]
+            conversation['turns'] = conversation['turns'][-self.window_turns:]
+            summary = conversation['summary'] + ''.join(
+                f"User asked: {first_sentence(turn['user'], 120)} Agent: {first_sentence(turn['agent'], 160)}\n"
+                for turn in evicted
+            )
+            conversation['summary'] = summary[-self.summary_max_chars:]
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats['window_turns'] = self.window_turns
+        return stats
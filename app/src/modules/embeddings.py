@@ -0,0 +1,280 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from modules import resilience
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+def normalize_text(text):
+    '''
+        Lowercases and collapses whitespace so that "Reset  Password " and
+        "reset password" share a cache entry.
+    '''
+    return ' '.join(f'{text}'.lower().split())
+
+
+def normalize_history(chat_history):
+    '''
+        Hashable form of a chat history ([{'user': ..., 'agent': ...}, ...]) with every
+        message normalized, for keys that must only match the same conversation.
+    '''
+    return tuple(tuple(sorted((k, normalize_text(v)) for k, v in turn.items())) for turn in chat_history or [])
+
+
+# Runs the blocking text_embedding requests, so that they can be given up on after the stage deadline
+embedding_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='embeddings')
+
+
+class LRUCache:
+    '''
+        Thread-safe LRU cache with a per-entry TTL.
+    '''
+
+    def __init__(self, max_size=10000, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class EmbeddingClient:
+    '''
+        Caching, batching embedding layer on top of GCP_GenAI.text_embedding.
+
+        Concurrent calls that miss the cache are grouped: the first caller waits
+        batch_window_ms for others to join, then sends one get_embeddings request
+        for the whole group. Texts that normalize to the same key (see normalize_text)
+        share a cache entry and in-flight slot, and the first original text seen for
+        the key is the one embedded.
+        embed/embed_many batch across threads, embed_async/embed_many_async batch
+        across coroutines on the running event loop. Both share the cache.
+        Batches are sent through upstream (resilience.Upstream, stage 'embedding').
+    '''
+
+    def __init__(self, llm_client, google_embeddings_model='text-embedding-004', max_size=10000, ttl_seconds=3600, batch_window_ms=5, max_batch_size=250, upstream=None):
+        self.llm_client = llm_client
+        self.upstream = upstream or resilience.Upstream('embeddings')
+        self.google_embeddings_model = google_embeddings_model
+        self.cache = LRUCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._inflight = {}
+        self._leader_active = False
+
+        self._async_queue = []
+        self._async_inflight = {}
+        self._async_flush = None
+
+        self.batches = 0
+        self.batched_texts = 0
+
+    def embed(self, text):
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts):
+        keys = [normalize_text(t) for t in texts]
+        futures = {}
+        lead = False
+
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in futures:
+                    continue
+
+                vector = self.cache.get(key)
+                if vector is not None:
+                    futures[key] = Future()
+                    futures[key].set_result(vector)
+                elif key in self._inflight:
+                    futures[key] = self._inflight[key]
+                else:
+                    futures[key] = Future()
+                    self._inflight[key] = futures[key]
+                    self._queue.append((key, text))
+
+            if self._queue and not self._leader_active:
+                self._leader_active = True
+                lead = True
+
+        if lead:
+            self._run_batches()
+
+        return [futures[key].result() for key in keys]
+
+    def _run_batches(self):
+        time.sleep(self.batch_window)
+        while True:
+            with self._lock:
+                batch = self._queue[:self.max_batch_size]
+                del self._queue[:self.max_batch_size]
+                if not batch:
+                    self._leader_active = False
+                    return
+
+            try:
+                # The Vertex AI client takes no timeout, so the request runs on an executor and is given up on after it
+                vectors = self.upstream.call_sync('embedding', lambda timeout: embedding_executor.submit(
+                    self.llm_client.text_embedding, [text for key, text in batch], google_embeddings_model=self.google_embeddings_model,
+                ).result(timeout=timeout))
+                if len(vectors) != len(batch):
+                    raise ValueError(f'Expected {len(batch)} embeddings, received {len(vectors)}')
+                self.batches += 1
+                self.batched_texts += len(batch)
+                for (key, text), vector in zip(batch, vectors):
+                    self.cache.put(key, vector)
+                    self._inflight[key].set_result(vector)
+            except Exception as e:
+                logging.exception(f'At EmbeddingClient._run_batches. {e}')
+                for key, text in batch:
+                    if not self._inflight[key].done():
+                        self._inflight[key].set_exception(e)
+            finally:
+                with self._lock:
+                    for key, text in batch:
+                        self._inflight.pop(key, None)
+
+    async def embed_async(self, text):
+        return (await self.embed_many_async([text]))[0]
+
+    async def embed_many_async(self, texts):
+        loop = asyncio.get_running_loop()
+        keys = [normalize_text(t) for t in texts]
+        futures = {}
+
+        for key, text in zip(keys, texts):
+            if key in futures:
+                continue
+
+            vector = self.cache.get(key)
+            if vector is not None:
+                futures[key] = loop.create_future()
+                futures[key].set_result(vector)
+            elif key in self._async_inflight:
+                futures[key] = self._async_inflight[key]
+            else:
+                futures[key] = loop.create_future()
+                self._async_inflight[key] = futures[key]
+                self._async_queue.append((key, text))
+
+        if self._async_queue and self._async_flush is None:
+            self._async_flush = loop.create_task(self._run_batches_async())
+
+        # Shield the shared futures so one cancelled caller does not cancel the others
+        return [await asyncio.shield(futures[key]) for key in keys]
+
+    async def _run_batches_async(self):
+        try:
+            await asyncio.sleep(self.batch_window)
+            while self._async_queue:
+                batch = self._async_queue[:self.max_batch_size]
+                del self._async_queue[:self.max_batch_size]
+
+                try:
+                    vectors = await self.upstream.call('embedding', lambda: self.llm_client.text_embedding_async([text for key, text in batch], google_embeddings_model=self.google_embeddings_model))
+                    if len(vectors) != len(batch):
+                        raise ValueError(f'Expected {len(batch)} embeddings, received {len(vectors)}')
+                    self.batches += 1
+                    self.batched_texts += len(batch)
+                    for (key, text), vector in zip(batch, vectors):
+                        self.cache.put(key, vector)
+                        self._async_inflight[key].set_result(vector)
+                except Exception as e:
+                    logging.exception(f'At EmbeddingClient._run_batches_async. {e}')
+                    for key, text in batch:
+                        if not self._async_inflight[key].done():
+                            self._async_inflight[key].set_exception(e)
+                finally:
+                    for key, text in batch:
+                        future = self._async_inflight.pop(key, None)
+                        # Only still pending when the flush task was cancelled mid-batch
+                        if future is not None and not future.done():
+                            future.set_exception(resilience.UpstreamError('Embedding batch cancelled'))
+        finally:
+            # A cancelled flush must not leave callers waiting or block the next flush
+            self._async_flush = None
+            for key, text in self._async_queue:
+                future = self._async_inflight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(resilience.UpstreamError('Embedding batch cancelled'))
+            self._async_queue.clear()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['batches'] = self.batches
+        stats['batched_texts'] = self.batched_texts
+        stats['avg_batch_size'] = round(self.batched_texts / self.batches, 2) if self.batches else 0.0
+        return stats
@@ -0,0 +1,103 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import json
+
+# Snippet format used for the rows of each knowledge base table
+TABLE_FORMATS = {
+    'webdata_embeddings': 'media',
+    'articledata_embeddings': 'support',
+}
+
+MEDIA_FIELDS = ('releaseYear', 'runtime', 'mediaId', 'logLine', 'contentType', 'studio', 'title', 'content')
+MEDIA_CONTENT_FIELDS = ('minReleaseYear', 'maxReleaseYear', 'studio', 'formattedEpisodeCount', 'formattedSeasonCount')
+EPISODE_LABEL = re.compile(r"'episodeLabel':\s*'([^']+)'")
+
+# Article columns the support prompt needs. The other columns (ids, slugs, hashes, timestamps) are dropped.
+SUPPORT_FIELDS = ('title', 'desc', 'keywords', 'url')
+
+SNIPPET_COLUMN = 'kb_snippet'
+# Length of the row before projection, to report what projection saves
+SOURCE_CHARS_COLUMN = 'kb_snippet_source_chars'
+EXCLUDED_COLUMNS = ('text_embedding', 'ml_generate_embedding_result', SNIPPET_COLUMN, SOURCE_CHARS_COLUMN)
+
+
+def media_snippet(row):
+    '''
+        Tab-separated "field:\tvalue" lines for a media catalog row. Details nested in a
+        JSON content column (release years, studio, episode/season counts and the first
+        episode label) are flattened into the same lines.
+    '''
+    lines = []
+    for k, v in row.items():
+        if k not in MEDIA_FIELDS:
+            continue
+        if k != 'content':
+            lines.append(f'{k}:\t{v}\n')
+            continue
+
+        try:
+            json_content = json.loads(v)
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(json_content, dict):
+            continue
+        for k2, v2 in json_content.items():
+            if k2 in MEDIA_CONTENT_FIELDS:
+                lines.append(f'{k2}:\t{v2}\n')
+            elif k2 == 'childContent' and v2:
+                match = EPISODE_LABEL.search(f'{v2[0]}')
+                if match:
+                    lines.append(f'episodeLabel:\t{match.group(1)}\n')
+    return ''.join(lines)
+
+
+def support_snippet(row):
+    '''
+        JSON of the SUPPORT_FIELDS of an article row, or of every column when the row has none of them.
+    '''
+    projected = {k: row[k] for k in SUPPORT_FIELDS if row.get(k) not in (None, '', 'null')}
+    if not projected:
+        projected = {k: v for k, v in row.items() if k not in EXCLUDED_COLUMNS}
+    return json.dumps(projected, default=str)
+
+
+def source_chars(row):
+    return len(json.dumps({k: v for k, v in row.items() if k not in EXCLUDED_COLUMNS}, default=str))
+
+
+def build_snippet(row, table_id):
+    if TABLE_FORMATS.get(table_id) == 'media':
+        return media_snippet(row)
+    return support_snippet(row)
+
+
+def attach_snippets(rows, table_id):
+    '''
+        Stores the prompt snippet of each row under rows[i]['kb_snippet'] so the request
+        path only has to join them. rows must be dicts. Returns rows.
+    '''
+    for row in rows:
+        if row.get(SNIPPET_COLUMN) is None:
+            row[SOURCE_CHARS_COLUMN] = source_chars(row)
+            row[SNIPPET_COLUMN] = build_snippet(row, table_id)
+    return rows
+
+
+def snippets(rows, table_id):
+    '''
+        Prompt snippets for retrieved rows, built on the fly only for rows without one.
+    '''
+    return [row.get(SNIPPET_COLUMN) if row.get(SNIPPET_COLUMN) is not None else build_snippet(dict(row), table_id) for row in rows]
@@ -0,0 +1,168 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import os
+import sys
+import time
+import logging
+from collections import Counter
+import numpy as np
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+# Columns produced by load_data_website.py and load_data_articles.py. Missing columns are ignored.
+LEXICAL_FIELDS = ('title', 'logLine', 'actors', 'genres', 'desc', 'keywords')
+
+# Keeps error codes and hyphenated tokens such as "e-1043" or "sci-fi" whole
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(f'{text}'.lower())
+
+
+class BM25Index:
+    '''
+        In-process BM25 index over the text columns of a knowledge base snapshot.
+
+        Postings are stored as flat NumPy arrays (CSR layout): for term t, the
+        documents are doc_ids[offsets[t]:offsets[t+1]] with the matching
+        term_freqs, so the index costs about 6 bytes per posting.
+    '''
+
+    def __init__(self, rows, fields=LEXICAL_FIELDS, k1=1.2, b=0.75):
+        start_time = time.perf_counter()
+        self.rows = rows
+        self.k1 = k1
+        self.b = b
+
+        postings = {}
+        doc_lengths = np.zeros(len(rows), dtype=np.float32)
+        for doc_id, row in enumerate(rows):
+            tokens = []
+            for field in fields:
+                value = row.get(field)
+                if value is not None:
+                    tokens.extend(tokenize(value))
+            doc_lengths[doc_id] = len(tokens)
+            for term, freq in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, freq))
+
+        self.vocabulary = {term: term_id for term_id, term in enumerate(postings)}
+        lengths = np.fromiter((len(docs) for docs in postings.values()), dtype=np.int64, count=len(postings))
+        self.offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.doc_ids = np.fromiter((doc_id for docs in postings.values() for doc_id, freq in docs), dtype=np.int32, count=int(self.offsets[-1]))
+        self.term_freqs = np.fromiter((min(freq, 65535) for docs in postings.values() for doc_id, freq in docs), dtype=np.uint16, count=int(self.offsets[-1]))
+
+        self.doc_count = len(rows)
+        avg_length = float(doc_lengths.mean()) if len(rows) else 0.0
+        # Per-document part of the BM25 denominator, precomputed once
+        self.length_norms = (k1 * (1 - b + b * doc_lengths / avg_length)).astype(np.float32) if avg_length else np.full(len(rows), k1, dtype=np.float32)
+        self.idf = np.log(1 + (self.doc_count - lengths + 0.5) / (lengths + 0.5)).astype(np.float32)
+
+        logging.info(f'Built BM25 index with {self.doc_count} rows, {len(self.vocabulary)} terms and {len(self.doc_ids)} postings ({self.nbytes() / 1e6:.1f} MB) in {(time.perf_counter() - start_time)*1000:.1f} ms')
+
+    def __len__(self):
+        return self.doc_count
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.doc_ids.nbytes + self.term_freqs.nbytes + self.length_norms.nbytes + self.idf.nbytes
+
+    def search(self, query, k=20, candidates=None):
+        '''
+            Returns a list of (row, bm25_score) tuples, best first. Rows that share no term with the query are not returned.
+            candidates: Optional array of row positions to restrict the search to.
+        '''
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+        if not term_ids:
+            return []
+
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end].astype(np.float32)
+            scores[docs] += self.idf[term_id] * freqs * (self.k1 + 1) / (freqs + self.length_norms[docs])
+
+        if candidates is not None:
+            mask = np.zeros(self.doc_count, dtype=bool)
+            mask[candidates] = True
+            scores[~mask] = 0
+
+        matched = np.flatnonzero(scores)
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]] if k < len(matched) else matched
+        top = top[np.argsort(-scores[top])]
+        return [(self.rows[i], float(scores[i])) for i in top]
+
+
+class MetadataIndex:
+    '''
+        Token -> row positions map over the metadata columns of a snapshot, used to
+        restrict a search to the rows matching a set of retrieval filters.
+    '''
+
+    def __init__(self, rows, fields):
+        postings = {}
+        for doc_id, row in enumerate(rows):
+            for field in fields:
+                value = row.get(field)
+                if value is None:
+                    continue
+                for term in set(tokenize(value)):
+                    postings.setdefault((field, term), []).append(doc_id)
+        self.postings = {key: np.asarray(doc_ids, dtype=np.int32) for key, doc_ids in postings.items()}
+        self.rows = rows
+        self.doc_count = len(rows)
+
+    def candidates(self, filters):
+        '''
+            Returns (positions, applied_filters). positions is a sorted array of the rows that
+            match every applied filter, or None when no filter applies. A filter that matches
+            no row is skipped.
+        '''
+        positions, applied = None, []
+        for f in filters:
+            matches = [self.postings[(field, term)] for field in f['fields'] for term in f['terms'] if (field, term) in self.postings]
+            if not matches:
+                continue
+            matched = np.unique(np.concatenate(matches))
+            narrowed = matched if positions is None else np.intersect1d(positions, matched, assume_unique=True)
+            if len(narrowed) == 0:
+                continue
+            positions = narrowed
+            applied.append(f)
+        return positions, applied
+
+
+def reciprocal_rank_fusion(result_lists, k=20, rrf_k=60):
+    '''
+        Fuses ranked lists of (row, score) tuples with reciprocal rank fusion:
+        score(row) = sum over lists of 1 / (rrf_k + rank). Rows are matched by identity,
+        so every list must come from the same snapshot. Returns the top k rows.
+    '''
+    fused = {}
+    for results in result_lists:
+        for rank, (row, score) in enumerate(results, start=1):
+            entry = fused.setdefault(id(row), [row, 0.0])
+            entry[1] += 1.0 / (rrf_k + rank)
+    ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)
+    return [row for row, score in ranked[:k]]
@@ -12,24 +12,135 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
 import json
+import time
+import threading
 import vertexai
 import logging
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Tool, HarmCategory, HarmBlockThreshold, SafetySetting
-from vertexai.language_models import TextGenerationModel
-from vertexai.preview.generative_models import grounding
+from collections import deque
+from vertexai.generative_models import GenerativeModel, GenerationConfig, HarmCategory, HarmBlockThreshold, SafetySetting
+from vertexai.language_models import TextGenerationModel, TextEmbeddingModel
+from modules import telemetry, resilience, prompt_template
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
     stream=sys.stdout,
 )
 
+# Model tiers of the cascade, cheapest first. Costs are USD per 1M tokens.
+MODEL_TIERS = {
+    'small': {'model_id': 'gemini-1.5-flash-8b', 'temperature': 0.2, 'max_output_tokens': 512, 'input_cost': 0.0375, 'output_cost': 0.15},
+    'standard': {'model_id': 'gemini-1.5-flash-002', 'temperature': 0.5, 'max_output_tokens': 1024, 'input_cost': 0.075, 'output_cost': 0.30},
+    'large': {'model_id': 'gemini-1.5-pro-002', 'temperature': 0.5, 'max_output_tokens': 2048, 'input_cost': 1.25, 'output_cost': 5.00},
+}
+
+
+class ModelCascade:
+    '''
+        Picks the model tier each Gemini call starts on, and when to move up a tier.
+
+        Router calls start on router_tier with router_max_output_tokens and temperature 0.
+        Answers for simple_routes whose prompt is under simple_prompt_tokens start on the
+        first (cheapest) tier, every other answer on answer_tier. A call escalates to the
+        next tier when it returns no text, stops for any reason other than STOP, has
+        avg_logprobs below min_avg_logprob (when the model reports it), or fails the
+        caller's validate(text). The last tier's answer is returned as is. Calls that fail
+        (errors, deadlines, open circuit) do not escalate: the tiers share one upstream,
+        and the upstream policy has already retried them.
+    '''
+
+    def __init__(self, tiers=MODEL_TIERS, router_tier='small', answer_tier='standard', simple_routes=('cancellation', 'payments', 'login', 'general'), simple_prompt_tokens=1500, min_avg_logprob=-1.0, router_max_output_tokens=8, window=1000):
+        self.tiers = tiers
+        self.order = list(tiers)
+        self.router_tier = router_tier
+        self.answer_tier = answer_tier
+        self.simple_routes = simple_routes
+        self.simple_prompt_tokens = simple_prompt_tokens
+        self.min_avg_logprob = min_avg_logprob
+        self.router_max_output_tokens = router_max_output_tokens
+        self.window = window
+
+        self._lock = threading.Lock()
+        self.tier_stats = {name: {'calls': 0, 'accepted': 0, 'escalations': {}, 'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0, 'latencies': deque(maxlen=window)} for name in self.order}
+
+    def model_ids(self):
+        return tuple(dict.fromkeys(tier['model_id'] for tier in self.tiers.values()))
+
+    def plan(self, stage, route=None, prompt=''):
+        '''
+            Returns the list of (tier_name, model_id, temperature, max_output_tokens) to try, in order.
+        '''
+        if stage == 'router':
+            start = self.router_tier
+        elif route in self.simple_routes and len(prompt) // prompt_template.CHARS_PER_TOKEN <= self.simple_prompt_tokens:
+            start = self.order[0]
+        else:
+            start = self.answer_tier
+
+        attempts = []
+        for name in self.order[self.order.index(start):]:
+            tier = self.tiers[name]
+            if stage == 'router':
+                attempts.append((name, tier['model_id'], 0.0, self.router_max_output_tokens))
+            else:
+                attempts.append((name, tier['model_id'], tier['temperature'], tier['max_output_tokens']))
+        return attempts
+
+    def escalation_reason(self, completion, validate=None):
+        '''
+            Returns why a completion should be retried on the next tier, or None to accept it.
+        '''
+        if not completion['text'].strip():
+            return 'empty'
+        if completion['finish_reason'] not in (None, 'STOP', 'FINISH_REASON_UNSPECIFIED'):
+            return completion['finish_reason'].lower()
+        if completion['avg_logprobs'] is not None and completion['avg_logprobs'] < self.min_avg_logprob:
+            return 'low_confidence'
+        if validate is not None and not validate(completion['text']):
+            return 'invalid'
+        return None
+
+    def record(self, tier_name, ms, completion, reason):
+        tier = self.tiers[tier_name]
+        with self._lock:
+            stats = self.tier_stats[tier_name]
+            stats['calls'] += 1
+            stats['latencies'].append(ms)
+            if reason is None:
+                stats['accepted'] += 1
+            else:
+                stats['escalations'][reason] = stats['escalations'].get(reason, 0) + 1
+            if completion is not None:
+                stats['input_tokens'] += completion['input_tokens'] or 0
+                stats['output_tokens'] += completion['output_tokens'] or 0
+                stats['cost_usd'] += ((completion['input_tokens'] or 0) * tier['input_cost'] + (completion['output_tokens'] or 0) * tier['output_cost']) / 1e6
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for name, tier_stats in self.tier_stats.items():
+                ordered = sorted(tier_stats['latencies'])
+                stats[name] = {
+                    'model_id': self.tiers[name]['model_id'],
+                    'calls': tier_stats['calls'],
+                    'accepted': tier_stats['accepted'],
+                    'escalations': dict(tier_stats['escalations']),
+                    'input_tokens': tier_stats['input_tokens'],
+                    'output_tokens': tier_stats['output_tokens'],
+                    'cost_usd': round(tier_stats['cost_usd'], 6),
+                    'p50_ms': round(ordered[len(ordered) // 2], 2) if ordered else None,
+                    'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2) if ordered else None,
+                }
+            return stats
+
+
 class GCP_GenAI:
 
-    def __init__(self, GCP_PROJECT_ID, GCP_REGION):
+    def __init__(self, GCP_PROJECT_ID, GCP_REGION, cascade=None, upstream=None):
         if GCP_PROJECT_ID=="":
             logging.warning(f'GCP_PROJECT_ID ENV variable is empty. Be sure to set the GCP_PROJECT_ID ENV variable.')
         
@@ -40,89 +151,186 @@ class GCP_GenAI:
         self.GCP_REGION = GCP_REGION
         self.vertexai_obj = vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
 
-    def call_gemini(self, 
-        prompt,
-        model_id='gemini-1.5-flash-001',
-        temperature=0.5, 
-        max_output_tokens=1024, 
-        top_p=0.8,
-        top_k=40, 
-        stop_sequences=None, 
-        safety_settings=None,
-        return_raw=False,
-        ground_in_google_search=False,
-        ):
+        # Model registry: model handles and generation configs are built once per
+        # key and shared by every call (and thread) afterwards.
+        self.models = {}
+        self.generation_configs = {}
+        self.models_lock = threading.Lock()
+        self.safety_config = self._build_safety_config()
+        self.cascade = cascade or ModelCascade()
+        # Deadlines, retries, hedging and circuit breaking of the cascade's Gemini calls
+        self.upstream = upstream or resilience.Upstream('gemini')
+
+    def warm(self, gemini_model_ids=None, embedding_model_ids=('text-embedding-004',)):
         '''
-            The Vertex AI Gemini API supports multimodal prompts as input and ouputs text or code.
-            https://cloud.google.com/vertex-ai/docs/generative-ai/model-reference/gemini
-            https://cloud.google.com/vertex-ai/docs/generative-ai/multimodal/send-chat-prompts-gemini
+            Builds model handles (and the default generation config) ahead of the first request.
+            gemini_model_ids defaults to the models of the cascade tiers.
         '''
         try:
-            # Initialize Model
-            logging.info(f'Calling Gemini model {model_id}')
-            llm_model_gemini = GenerativeModel(model_id)
-
-            safety_config = [
-                SafetySetting(
-                    category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=HarmBlockThreshold.BLOCK_NONE,
-                ),
-                SafetySetting(
-                    category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=HarmBlockThreshold.BLOCK_NONE,
-                ),
-                SafetySetting(
-                    category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=HarmBlockThreshold.BLOCK_NONE,
-                ),
-                SafetySetting(
-                    category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=HarmBlockThreshold.BLOCK_NONE,
-                ),
-            ]
-
-            if ground_in_google_search:
-
-                # Use Google Search for grounding
-                tool = Tool.from_google_search_retrieval(grounding.GoogleSearchRetrieval())
-
-                response = llm_model_gemini.generate_content(
-                    contents=prompt,
-                    tools=[tool],
-                    generation_config=GenerationConfig(
-                        temperature=temperature,
-                        top_p=top_p,
-                        top_k=top_k,
-                        candidate_count=1,
-                        max_output_tokens=max_output_tokens,
-                        stop_sequences=stop_sequences,
-                    ),
-                    safety_settings=safety_config
-                )
+            for model_id in gemini_model_ids or self.cascade.model_ids():
+                self._gemini_model(model_id)
+            self._generation_config(0.5, 1024, 0.8, 40, None)
+            for model_id in embedding_model_ids:
+                self._embedding_model(model_id)
+        except Exception as e:
+            logging.exception(f'At warm. Models will be loaded on first use. {e}')
 
-            else:
-                response = llm_model_gemini.generate_content(
-                    contents=prompt,
-                    generation_config=GenerationConfig(
-                        temperature=temperature,
-                        top_p=top_p,
-                        top_k=top_k,
-                        candidate_count=1,
-                        max_output_tokens=max_output_tokens,
-                        stop_sequences=stop_sequences,
-                    ),
-                    safety_settings=safety_config
-                )
-
-            #logging.info(f'Gemini LLM response: {response}')
+    def _registry_get(self, registry, key, build):
+        entry = registry.get(key)
+        if entry is None:
+            with self.models_lock:
+                entry = registry.get(key)
+                if entry is None:
+                    entry = build()
+                    registry[key] = entry
+        return entry
 
-            if not return_raw:
-                response = response.candidates[0].content.parts[0].text
+    def _gemini_model(self, model_id):
+        return self._registry_get(self.models, ('gemini', model_id), lambda: GenerativeModel(model_id))
 
-            return response
-        except Exception as e:
-            logging.exception(f'At call_gemini. {e}')
-            return ''
+    def _palm_text_model(self, model_id):
+        return self._registry_get(self.models, ('palm', model_id), lambda: TextGenerationModel.from_pretrained(model_id))
+
+    def _embedding_model(self, google_embeddings_model):
+        return self._registry_get(self.models, ('embedding', google_embeddings_model), lambda: TextEmbeddingModel.from_pretrained(google_embeddings_model))
+
+    def _safety_config(self):
+        return self.safety_config
+
+    def _build_safety_config(self):
+        return [
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=HarmBlockThreshold.BLOCK_NONE,
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=HarmBlockThreshold.BLOCK_NONE,
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=HarmBlockThreshold.BLOCK_NONE,
+            ),
+            SafetySetting(
+                category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=HarmBlockThreshold.BLOCK_NONE,
+            ),
+        ]
+
+    def _generation_config(self, temperature, max_output_tokens, top_p, top_k, stop_sequences):
+        key = (temperature, max_output_tokens, top_p, top_k, tuple(stop_sequences) if stop_sequences else None)
+        return self._registry_get(self.generation_configs, key, lambda: GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            candidate_count=1,
+            max_output_tokens=max_output_tokens,
+            stop_sequences=stop_sequences,
+        ))
+
+    async def generate_async(self, prompt, stage='answer', route=None, validate=None):
+        '''
+            Gemini call routed through the model cascade (see ModelCascade). stage is 'router'
+            or 'answer', route is the route of an answer. validate(text) optionally rejects
+            an answer so the next tier is tried. Each tier is called through self.upstream
+            with the deadline of the stage. A failed call ends the cascade. Returns the best
+            answer, possibly '', and raises resilience.UpstreamError when no tier answered.
+        '''
+        best, answered, error = '', False, None
+        for tier_name, model_id, temperature, max_output_tokens in self.cascade.plan(stage, route, prompt):
+            start_time = time.perf_counter()
+            completion, reason = None, 'error'
+            with telemetry.span('llm.call', **{'gen_ai.request.model': model_id, 'llm.tier': tier_name, 'llm.stage': stage}) as span:
+                try:
+                    completion = await self.upstream.call(stage, lambda: self.complete_async(prompt, model_id, temperature, max_output_tokens))
+                    reason = self.cascade.escalation_reason(completion, validate)
+                    span.set(**{'gen_ai.usage.input_tokens': completion['input_tokens'], 'gen_ai.usage.output_tokens': completion['output_tokens']})
+                except resilience.UpstreamError as e:
+                    error = e
+                    reason = 'circuit_open' if isinstance(e, resilience.CircuitOpenError) else 'error'
+                span.set(**{'llm.escalation': reason})
+            self.cascade.record(tier_name, (time.perf_counter() - start_time) * 1000, completion, reason)
+
+            if reason is None:
+                return completion['text']
+            if completion is None:
+                # Every tier is behind the same upstream, which already retried the call
+                break
+            answered = True
+            if completion['text'].strip():
+                best = completion['text']
+        if not answered and error is not None:
+            raise error
+        return best
+
+    async def stream_generate_async(self, prompt, stage='answer', route=None):
+        '''
+            Streaming variant of generate_async. A tier is committed to once its first chunk
+            arrives, so only an empty stream escalates. Raises resilience.UpstreamError when
+            the call fails, also after chunks were yielded: a stream cut short is not a
+            complete answer.
+        '''
+        error = None
+        for tier_name, model_id, temperature, max_output_tokens in self.cascade.plan(stage, route, prompt):
+            start_time = time.perf_counter()
+            started, reason, interrupted = False, 'empty', None
+            with telemetry.span('llm.call', **{'gen_ai.request.model': model_id, 'llm.tier': tier_name, 'llm.stage': stage}) as span:
+                try:
+                    async for chunk in self.upstream.stream('stream', lambda: self.stream_complete_async(prompt, model_id, temperature, max_output_tokens)):
+                        started, reason = True, None
+                        yield chunk
+                except resilience.UpstreamError as e:
+                    if started:
+                        interrupted, reason = e, 'interrupted'
+                    else:
+                        error = e
+                        reason = 'circuit_open' if isinstance(e, resilience.CircuitOpenError) else 'error'
+                    logging.warning(f'At stream_generate_async ({tier_name}). {e}')
+                except Exception as e:
+                    if started:
+                        interrupted, reason = resilience.UpstreamError(f'{self.upstream.name} stream failed. {type(e).__name__}: {e}'), 'interrupted'
+                    logging.exception(f'At stream_generate_async ({tier_name}). {e}')
+                span.set(**{'llm.escalation': reason})
+            self.cascade.record(tier_name, (time.perf_counter() - start_time) * 1000, None, reason)
+            if interrupted is not None:
+                raise interrupted
+            if started:
+                return
+            if reason != 'empty':
+                break
+        if error is not None:
+            raise error
+
+    async def complete_async(self, prompt, model_id, temperature, max_output_tokens):
+        '''
+            Single Gemini call used by the cascade. Raises on failure and returns a dict with
+            text, input_tokens, output_tokens, finish_reason and avg_logprobs (None when not reported).
+        '''
+        response = await self._gemini_model(model_id).generate_content_async(
+            contents=prompt,
+            generation_config=self._generation_config(temperature, max_output_tokens, 0.8, 40, None),
+            safety_settings=self._safety_config(),
+        )
+        candidate = response.candidates[0] if response.candidates else None
+        usage = getattr(response, 'usage_metadata', None)
+        return {
+            'text': candidate.content.parts[0].text if candidate is not None and candidate.content.parts else '',
+            'input_tokens': getattr(usage, 'prompt_token_count', None),
+            'output_tokens': getattr(usage, 'candidates_token_count', None),
+            'finish_reason': candidate.finish_reason.name if candidate is not None else 'EMPTY',
+            'avg_logprobs': getattr(candidate, 'avg_logprobs', None) or None,
+        }
+
+    async def stream_complete_async(self, prompt, model_id, temperature, max_output_tokens):
+        responses = await self._gemini_model(model_id).generate_content_async(
+            contents=prompt,
+            generation_config=self._generation_config(temperature, max_output_tokens, 0.8, 40, None),
+            safety_settings=self._safety_config(),
+            stream=True,
+        )
+        async for response in responses:
+            if response.candidates and response.candidates[0].content.parts:
+                yield response.candidates[0].content.parts[0].text
 
     def call_palm_text(self,
         prompt,
@@ -140,7 +348,7 @@ class GCP_GenAI:
                 "top_k": top_k,  # A top_k of 1 means the selected token is the most probable among all tokens.
             }
 
-            llm_model_palm_text = TextGenerationModel.from_pretrained("text-bison")
+            llm_model_palm_text = self._palm_text_model("text-bison")
             response = llm_model_palm_text.predict(prompt,
                 **parameters,
             )
@@ -155,6 +363,8 @@ class GCP_GenAI:
 
     def text_embedding(self, input_list, google_embeddings_model='text-embedding-004') -> list:
         '''
+        Returns one embedding vector per item in input_list, in order.
+
         Available Embeddings Models:
         https://cloud.google.com/vertex-ai/generative-ai/docs/learn/model-versioning#stable-versions-available.md
         
@@ -162,8 +372,14 @@ class GCP_GenAI:
             'Who founded Google',
         ]
         '''
-        model = TextEmbeddingModel.from_pretrained(google_embeddings_model)
+        model = self._embedding_model(google_embeddings_model)
         embeddings = model.get_embeddings(input_list)
-        for embedding in embeddings:
-            vector = embedding.values
-        return vector
+        return [embedding.values for embedding in embeddings]
+
+    async def text_embedding_async(self, input_list, google_embeddings_model='text-embedding-004') -> list:
+        '''
+        Async variant of text_embedding.
+        '''
+        model = self._embedding_model(google_embeddings_model)
+        embeddings = await model.get_embeddings_async(input_list)
+        return [embedding.values for embedding in embeddings]
@@ -0,0 +1,283 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import asyncio
+import logging
+from collections import deque
+from modules import telemetry
+from modules.retrieval_filters import partition_name
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+# Knowledge base table used for each route. Routes not listed get no knowledge base.
+ROUTE_TABLES = {
+    'recommendations': 'webdata_embeddings',
+    'media': 'webdata_embeddings',
+    'cancellation': 'articledata_embeddings',
+    'payments': 'articledata_embeddings',
+    'login': 'articledata_embeddings',
+}
+
+
+class ChatPipeline:
+    '''
+        Routes a user comment and retrieves its knowledge base.
+
+        mode='serial' runs router then retrieval. mode='concurrent' starts the router
+        and retrieval against every knowledge base table with a local index at the same
+        time, then cancels the retrievals the chosen route does not need. Tables served
+        from BigQuery are queried once the route is known.
+        Each stage is bounded by its own deadline in seconds. A router that fails or runs
+        past its deadline falls back to the general route, a retrieval that does gives a
+        knowledge base-less answer (e.g. while the BigQuery circuit is open).
+
+        filters_fn(route, user_comment) returns the retrieval filters of a route (see
+        retrieval_filters.route_filters). In concurrent mode one speculative retrieval
+        runs per distinct (table, filters) pair of the indexed tables across the routes.
+
+        When a response_cache is set and the turn is eligible, the cache is checked
+        once the route is known. On a hit, retrieval is skipped and the result
+        carries the cached_response.
+    '''
+
+    def __init__(self, intent_router, bq_client, embedding_client, response_cache=None, filters_fn=None, mode='concurrent', router_deadline=3.0, retrieval_deadline=5.0, window=1000):
+        self.intent_router = intent_router
+        self.bq_client = bq_client
+        self.embedding_client = embedding_client
+        self.response_cache = response_cache
+        self.filters_fn = filters_fn
+        self.mode = mode
+        self.router_deadline = router_deadline
+        self.retrieval_deadline = retrieval_deadline
+
+        self.timings = {}
+        self.window = window
+        self.timeouts = {'router': 0, 'retrieval': 0}
+        self.failures = {'router': 0, 'retrieval': 0}
+        self.discarded_retrievals = 0
+
+    async def run(self, user_comment, chat_history=None):
+        '''
+            Returns a dict with route, route_source, table_id, kb_version, query_embedding,
+            catalog_results, retrieval_stats (see BQClient.query_with_stats, None when
+            retrieval was skipped), cached_response (None on a cache miss) and timings
+            (ms per stage plus end_to_end).
+        '''
+        start_time = time.perf_counter()
+        timings = {}
+        use_cache = self.response_cache is not None and self.response_cache.eligible(chat_history or [])
+
+        if self.mode == 'concurrent':
+            result = await self._run_concurrent(user_comment, chat_history, timings, use_cache)
+        else:
+            result = await self._run_serial(user_comment, chat_history, timings, use_cache)
+
+        timings['end_to_end'] = (time.perf_counter() - start_time) * 1000
+        # Latency a strictly serial router -> retrieval pipeline would have paid
+        timings['saved'] = max(0.0, timings.get('router', 0) + timings.get('retrieval', 0) - timings['end_to_end'])
+        self._record(timings)
+
+        result['timings'] = {stage: round(ms, 2) for stage, ms in timings.items()}
+        return result
+
+    async def _run_serial(self, user_comment, chat_history, timings, use_cache):
+        route, route_source = await self._route(user_comment, timings)
+        table_id = ROUTE_TABLES.get(route)
+        result = await self._check_cache(user_comment, chat_history, route, route_source, table_id, use_cache)
+        if result['cached_response'] is not None:
+            return result
+
+        catalog_results, retrieval_stats = [], None
+        if table_id is not None:
+            filters = self._filters(route, user_comment)
+            retrieval_start = time.perf_counter()
+            try:
+                catalog_results, retrieval_stats = await asyncio.wait_for(self._retrieve(user_comment, table_id, filters, timings), timeout=self.retrieval_deadline)
+            except asyncio.TimeoutError:
+                self.timeouts['retrieval'] += 1
+                logging.warning(f'Retrieval on {table_id} exceeded its {self.retrieval_deadline}s deadline')
+            except Exception as e:
+                self.failures['retrieval'] += 1
+                logging.warning(f'Retrieval on {table_id} failed. Answering without knowledge base. {e}')
+            self._trace_retrieval(table_id, filters, retrieval_start, None, catalog_results, retrieval_stats)
+
+        result['catalog_results'] = catalog_results
+        result['retrieval_stats'] = retrieval_stats
+        return result
+
+    async def _run_concurrent(self, user_comment, chat_history, timings, use_cache):
+        # Only tables with a local index are searched speculatively. In BigQuery every
+        # partition is a full table scan, so those retrievals wait for the route.
+        plans = {}
+        for plan_route, plan_table_id in ROUTE_TABLES.items():
+            if self.bq_client.has_index(plan_table_id):
+                filters = self._filters(plan_route, user_comment)
+                plans.setdefault((plan_table_id, partition_name(filters)), filters)
+        retrieval_timings = {plan: {} for plan in plans}
+        speculative_start = time.perf_counter()
+        retrievals = {
+            plan: asyncio.create_task(self._retrieve(user_comment, plan[0], filters, retrieval_timings[plan]))
+            for plan, filters in plans.items()
+        }
+        for task in retrievals.values():
+            # Discarded retrievals may fail (e.g. while the BigQuery circuit is open), nobody awaits them
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+        route, route_source = await self._route(user_comment, timings)
+        table_id = ROUTE_TABLES.get(route)
+        filters = self._filters(route, user_comment) if table_id else []
+        plan = (table_id, partition_name(filters)) if table_id else None
+        result = await self._check_cache(user_comment, chat_history, route, route_source, table_id, use_cache)
+
+        for other_plan, task in retrievals.items():
+            if other_plan != plan or result['cached_response'] is not None:
+                # Cancelling the task also cancels a BigQuery job it started (see BQClient.query_with_stats_async)
+                task.cancel()
+                self.discarded_retrievals += 1
+
+        if result['cached_response'] is not None:
+            return result
+
+        catalog_results, retrieval_stats = [], None
+        if table_id is not None:
+            retrieval_start = time.perf_counter()
+            speculative = plan in retrievals
+            if not speculative:
+                retrieval_timings[plan] = {}
+                retrievals[plan] = asyncio.create_task(self._retrieve(user_comment, table_id, filters, retrieval_timings[plan]))
+            try:
+                # A speculative retrieval has been running since the router started, the deadline covers both
+                remaining = max(0.0, self.retrieval_deadline - timings['router'] / 1000) if speculative else self.retrieval_deadline
+                catalog_results, retrieval_stats = await asyncio.wait_for(retrievals[plan], timeout=remaining)
+            except asyncio.TimeoutError:
+                self.timeouts['retrieval'] += 1
+                logging.warning(f'Retrieval on {table_id} exceeded its {self.retrieval_deadline}s deadline')
+            except Exception as e:
+                self.failures['retrieval'] += 1
+                logging.warning(f'Retrieval on {table_id} failed. Answering without knowledge base. {e}')
+            if speculative:
+                timings['retrieval'] = retrieval_timings[plan].get('retrieval', timings['router'] + (time.perf_counter() - retrieval_start) * 1000)
+                trace_start = speculative_start
+            else:
+                timings['retrieval'] = retrieval_timings[plan].get('retrieval', (time.perf_counter() - retrieval_start) * 1000)
+                trace_start = retrieval_start
+            timings['retrieval_after_route'] = (time.perf_counter() - retrieval_start) * 1000
+            self._trace_retrieval(table_id, filters, trace_start, trace_start + timings['retrieval'] / 1000, catalog_results, retrieval_stats)
+
+        result['catalog_results'] = catalog_results
+        result['retrieval_stats'] = retrieval_stats
+        return result
+
+    async def _check_cache(self, user_comment, chat_history, route, route_source, table_id, use_cache):
+        result = {
+            'route': route,
+            'route_source': route_source,
+            'table_id': table_id,
+            'kb_version': self.bq_client.table_version(table_id) if table_id else '',
+            'query_embedding': None,
+            'catalog_results': [],
+            'retrieval_stats': None,
+            'cached_response': None,
+        }
+        if use_cache:
+            result['query_embedding'] = await self._embed(user_comment)
+            result['cached_response'] = self.response_cache.lookup(result['query_embedding'], route, result['kb_version'], chat_history)
+        return result
+
+    async def _route(self, user_comment, timings):
+        start_time = time.perf_counter()
+        with telemetry.span('router') as span:
+            try:
+                route, route_source = await asyncio.wait_for(self.intent_router.route(user_comment), timeout=self.router_deadline)
+            except asyncio.TimeoutError:
+                self.timeouts['router'] += 1
+                logging.warning(f'Router exceeded its {self.router_deadline}s deadline. Using the general route.')
+                route, route_source = 'general', 'timeout'
+            except Exception as e:
+                self.failures['router'] += 1
+                logging.warning(f'Router failed. Using the general route. {e}')
+                route, route_source = 'general', 'error'
+            span.set(route=route, route_source=route_source)
+        timings['router'] = (time.perf_counter() - start_time) * 1000
+        return route, route_source
+
+    def _filters(self, route, user_comment):
+        return self.filters_fn(route, user_comment) if self.filters_fn is not None else []
+
+    async def _retrieve(self, user_comment, table_id, filters, timings):
+        '''
+            Returns (catalog_results, retrieval_stats) as returned by BQClient.query_with_stats.
+        '''
+        start_time = time.perf_counter()
+        result = await self.bq_client.query_with_stats_async(user_query=user_comment, table_id=table_id, query_embedding=await self._embed(user_comment), filters=filters)
+        timings['retrieval'] = (time.perf_counter() - start_time) * 1000
+        return result
+
+    def _trace_retrieval(self, table_id, filters, start_time, end_time, catalog_results, retrieval_stats):
+        span = telemetry.add_span('retrieval', start_time, end_time, **{
+            'db.system': 'bigquery',
+            'db.sql.table': table_id,
+            'retrieval.filters': partition_name(filters),
+            'retrieval.rows': len(catalog_results),
+        })
+        if retrieval_stats is None:
+            span.status = 'timeout'
+            return
+        span.set(**{
+            'retrieval.source': retrieval_stats['source'],
+            'retrieval.partition': retrieval_stats['partition'],
+            'retrieval.candidates': retrieval_stats.get('candidates'),
+            'bigquery.job_id': retrieval_stats.get('job_id'),
+            'bigquery.bytes_processed': retrieval_stats.get('bytes_processed'),
+            'bigquery.bytes_billed': retrieval_stats.get('bytes_billed'),
+            'bigquery.slot_ms': retrieval_stats.get('slot_ms'),
+            'bigquery.cache_hit': retrieval_stats.get('cache_hit'),
+        })
+
+    async def _embed(self, user_comment):
+        try:
+            return await self.embedding_client.embed_async(user_comment)
+        except Exception as e:
+            print(f'[ EXCEPTION ] Unable to embed user comment. {e}')
+            return None
+
+    def _record(self, timings):
+        for stage, ms in timings.items():
+            self.timings.setdefault(stage, deque(maxlen=self.window)).append(ms)
+
+    def stats(self):
+        stats = {
+            'mode': self.mode,
+            'timeouts': dict(self.timeouts),
+            'failures': dict(self.failures),
+            'discarded_retrievals': self.discarded_retrievals,
+            'stages': {},
+        }
+        for stage, values in self.timings.items():
+            ordered = sorted(values)
+            stats['stages'][stage] = {
+                'count': len(ordered),
+                'avg_ms': round(sum(ordered) / len(ordered), 2),
+                'p50_ms': round(ordered[len(ordered) // 2], 2),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+            }
+        return stats
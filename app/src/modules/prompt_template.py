@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
+import threading
+from string import Formatter
+
 prompt_persona = '''
 You are a helfpul {brand} Customer Service Bot called StreamGenie. Your primary goal is to provide accurate and helpful assistance to {brand} customers. 
 
@@ -96,3 +101,114 @@ Your job is to interpret the user question and output a category that is most re
 **User Comment**
 {user_comment}
 '''
+
+# Rough chars-per-token ratio used for prompt budgeting
+CHARS_PER_TOKEN = 4
+
+
+class PromptBuilder:
+    '''
+        Assembles chat prompts from pre-rendered templates.
+
+        At startup each template (persona + guidelines) is split into static text,
+        with {brand} already filled in, and the dynamic fields knowledge_base,
+        chat_history and user_comment. build() writes the static parts and the
+        dynamic values into one buffer. When the prompt would exceed max_tokens it
+        drops, in order: the oldest chat history turns beyond min_history_turns,
+        the lowest ranked knowledge base snippets beyond the first, the remaining
+        history, and finally the tail of the top snippet.
+    '''
+
+    def __init__(self, brand, max_tokens=8000, min_history_turns=2, templates=None):
+        self.max_chars = max_tokens * CHARS_PER_TOKEN
+        self.min_history_turns = min_history_turns
+        templates = templates or {'media': prompt_media, 'support': prompt_support}
+        self.templates = {name: self._compile(prompt_persona + '\n' + template, brand) for name, template in templates.items()}
+
+        self._lock = threading.Lock()
+        self.route_stats = {}
+
+    def _compile(self, template, brand):
+        segments = []
+        literal = ''
+        for literal_text, field_name, format_spec, conversion in Formatter().parse(template):
+            literal += literal_text
+            if field_name is None:
+                continue
+            if field_name == 'brand':
+                literal += brand
+            else:
+                segments.append((literal, field_name))
+                literal = ''
+        static_chars = sum(len(text) for text, field_name in segments) + len(literal)
+        return {'segments': segments, 'tail': literal, 'static_chars': static_chars}
+
+    def build(self, template_name, user_comment, chat_history=(), kb_snippets=(), route=None):
+        template = self.templates[template_name]
+        history = [json.dumps(turn) for turn in chat_history]
+        snippets = list(kb_snippets)
+        truncated = self._fit(template['static_chars'] + len(user_comment), history, snippets)
+
+        buffer = io.StringIO()
+        for text, field_name in template['segments']:
+            buffer.write(text)
+            if field_name == 'user_comment':
+                buffer.write(user_comment)
+            elif field_name == 'knowledge_base':
+                for i, snippet in enumerate(snippets):
+                    if i:
+                        buffer.write('\n')
+                    buffer.write(snippet)
+            elif field_name == 'chat_history':
+                buffer.write('[')
+                for i, turn in enumerate(history):
+                    if i:
+                        buffer.write(', ')
+                    buffer.write(turn)
+                buffer.write(']')
+        buffer.write(template['tail'])
+        prompt = buffer.getvalue()
+
+        self._record(route or template_name, len(prompt), truncated)
+        return prompt
+
+    def _fit(self, fixed_chars, history, snippets):
+        '''
+            Trims history and snippets in place to fit max_chars. Returns True if anything was dropped.
+        '''
+        history_chars = sum(len(turn) + 2 for turn in history)
+        snippet_chars = sum(len(snippet) + 1 for snippet in snippets)
+        overflow = fixed_chars + history_chars + snippet_chars - self.max_chars
+        if overflow <= 0:
+            return False
+
+        while overflow > 0 and len(history) > self.min_history_turns:
+            overflow -= len(history.pop(0)) + 2
+        while overflow > 0 and len(snippets) > 1:
+            overflow -= len(snippets.pop()) + 1
+        while overflow > 0 and history:
+            overflow -= len(history.pop(0)) + 2
+        if overflow > 0 and snippets:
+            snippets[0] = snippets[0][:max(0, len(snippets[0]) - overflow)]
+        return True
+
+    def _record(self, route, chars, truncated):
+        with self._lock:
+            stats = self.route_stats.setdefault(route, {'count': 0, 'total_chars': 0, 'max_chars': 0, 'truncated': 0})
+            stats['count'] += 1
+            stats['total_chars'] += chars
+            stats['max_chars'] = max(stats['max_chars'], chars)
+            stats['truncated'] += int(truncated)
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    'count': stats['count'],
+                    'avg_chars': round(stats['total_chars'] / stats['count'], 1),
+                    'avg_tokens': round(stats['total_chars'] / stats['count'] / CHARS_PER_TOKEN, 1),
+                    'max_tokens': stats['max_chars'] // CHARS_PER_TOKEN,
+                    'truncated': stats['truncated'],
+                }
+                for route, stats in self.route_stats.items()
+            }
@@ -0,0 +1,113 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from modules import kb_snippet
+from modules.lexical_index import tokenize
+from modules.prompt_template import CHARS_PER_TOKEN
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'can', 'do', 'does', 'for', 'from', 'how', 'i', 'in', 'is',
+    'it', 'me', 'my', 'of', 'on', 'or', 'the', 'to', 'what', 'when', 'where', 'which', 'who', 'why', 'with',
+    'you', 'your', 'any', 'there', 'this', 'that', 'about', 'have', 'has', 'want', 'would', 'like', 'please',
+))
+
+
+class Reranker:
+    '''
+        Trims retrieved knowledge base rows to a tight, diverse top_n before prompting.
+
+        Each row gets a relevance score mixing its retrieval rank with the share of
+        the question's terms found in its snippet. Rows are then picked by maximal
+        marginal relevance (mmr_lambda * relevance - (1 - mmr_lambda) * the highest
+        term overlap with a row already picked), so near-duplicates are skipped. Picking
+        stops at top_n rows or when the next snippet would exceed token_budget. The
+        first row is always kept.
+
+        Snippets are the projected kb_snippet strings (see kb_snippet.SUPPORT_FIELDS).
+        stats() reports the prompt tokens saved against the full retrieved rows.
+    '''
+
+    def __init__(self, top_n=5, token_budget=1500, mmr_lambda=0.7, rank_weight=0.5):
+        self.top_n = top_n
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.rank_weight = rank_weight
+
+        self._lock = threading.Lock()
+        self.route_stats = {}
+
+    def select(self, user_comment, rows, table_id, route=None):
+        '''
+            Returns (kb_snippets, rerank_stats) for the rows retrieved for user_comment, best first.
+        '''
+        snippets = kb_snippet.snippets(rows, table_id)
+        if not snippets:
+            return [], None
+
+        query_terms = {term for term in tokenize(user_comment) if term not in STOPWORDS}
+        row_terms = [set(tokenize(snippet)) for snippet in snippets]
+        relevance = [
+            self.rank_weight * (1 - rank / len(snippets)) + (1 - self.rank_weight) * (len(query_terms & terms) / len(query_terms) if query_terms else 0.0)
+            for rank, terms in enumerate(row_terms)
+        ]
+
+        selected = []
+        remaining = list(range(len(snippets)))
+        budget_chars = self.token_budget * CHARS_PER_TOKEN
+        used_chars = 0
+        while remaining and len(selected) < self.top_n:
+            best = max(remaining, key=lambda i: self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * max((self._overlap(row_terms[i], row_terms[j]) for j in selected), default=0.0))
+            remaining.remove(best)
+            if selected and used_chars + len(snippets[best]) > budget_chars:
+                continue
+            selected.append(best)
+            used_chars += len(snippets[best])
+
+        source_chars = sum(row.get(kb_snippet.SOURCE_CHARS_COLUMN) or len(snippet) for row, snippet in zip(rows, snippets))
+        rerank_stats = {
+            'rows_in': len(snippets),
+            'rows_out': len(selected),
+            'tokens_in': source_chars // CHARS_PER_TOKEN,
+            'tokens_out': used_chars // CHARS_PER_TOKEN,
+        }
+        rerank_stats['tokens_saved'] = max(0, rerank_stats['tokens_in'] - rerank_stats['tokens_out'])
+        self._record(route or table_id, rerank_stats)
+        return [snippets[i] for i in selected], rerank_stats
+
+    def _overlap(self, terms_a, terms_b):
+        if not terms_a or not terms_b:
+            return 0.0
+        return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+    def _record(self, route, rerank_stats):
+        with self._lock:
+            stats = self.route_stats.setdefault(route, {'count': 0, 'rows_in': 0, 'rows_out': 0, 'tokens_in': 0, 'tokens_out': 0, 'tokens_saved': 0})
+            stats['count'] += 1
+            for key in ('rows_in', 'rows_out', 'tokens_in', 'tokens_out', 'tokens_saved'):
+                stats[key] += rerank_stats[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    'count': stats['count'],
+                    'avg_rows_in': round(stats['rows_in'] / stats['count'], 1),
+                    'avg_rows_out': round(stats['rows_out'] / stats['count'], 1),
+                    'avg_tokens_in': round(stats['tokens_in'] / stats['count'], 1),
+                    'avg_tokens_out': round(stats['tokens_out'] / stats['count'], 1),
+                    'tokens_saved': stats['tokens_saved'],
+                }
+                for route, stats in self.route_stats.items()
+            }
@@ -0,0 +1,344 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Deadlines, retries, hedged requests and circuit breaking for upstream calls.
+#
+# One Upstream is created per dependency (Gemini, Vertex AI embeddings, BigQuery) and
+# every call to it names a stage. The stage policy sets the deadline of the whole call
+# (attempts and backoff included), the number of retries and whether a duplicate
+# request is sent when the first one runs past the stage's p95 latency. The circuit
+# breaker of the dependency opens after consecutive failures, and calls fail fast with
+# CircuitOpenError until a probe call succeeds.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+# deadline: Seconds for the whole call, split evenly between the attempts left.
+# attempt_deadline: Optional cap per attempt instead of the even split, for slow calls
+#           where a retry only fits after a fast failure (e.g. long answers of the large tier).
+# retries:  Attempts after the first one. hedge: Send a duplicate after the p95 latency.
+# For streams the deadline bounds the wait for the first chunk and between chunks.
+UPSTREAM_POLICIES = {
+    'router': {'deadline': 2.0, 'retries': 1, 'hedge': True},
+    'answer': {'deadline': 40.0, 'attempt_deadline': 35.0, 'retries': 1, 'hedge': False},
+    'stream': {'deadline': 10.0, 'retries': 1, 'hedge': False},
+    'embedding': {'deadline': 2.0, 'retries': 1, 'hedge': True},
+    'retrieval': {'deadline': 5.0, 'retries': 1, 'hedge': False},
+    'snapshot': {'deadline': 300.0, 'retries': 2, 'hedge': False},
+}
+
+
+class UpstreamError(Exception):
+    '''
+        An upstream call failed after its retries, or was not sent.
+    '''
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    '''
+        Opens after failure_threshold consecutive failures. While open, allow() is False
+        except for one probe call every reset_seconds. The probe closes the breaker when
+        it succeeds and re-opens it when it fails.
+    '''
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                # One probe per reset window, also when the previous probe never reported back
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info(f'Circuit {self.name} closed')
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    logging.warning(f'Circuit {self.name} opened after {self.failures} consecutive failures')
+                    self.opened += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self.failures, 'opened': self.opened}
+
+
+class Upstream:
+    '''
+        Calls to one dependency. call() runs a coroutine function, call_sync() a blocking
+        function of its timeout (it must enforce it itself, e.g. as a BigQuery job timeout)
+        and stream() an async generator function. Every failure is retried with full-jitter
+        exponential backoff within the stage deadline, then raised as an UpstreamError.
+
+        Hedged stages send a duplicate request once the first one has run past the p95
+        latency of the stage (after hedge_min_samples calls) and keep the first answer.
+        Hedges are capped at max_hedge_ratio of the calls so a slow dependency does not
+        get twice the load.
+    '''
+
+    def __init__(self, name, policies=UPSTREAM_POLICIES, breaker=None, backoff_seconds=0.1, max_backoff_seconds=2.0, hedge_min_samples=20, max_hedge_ratio=0.1, window=1000):
+        self.name = name
+        self.policies = policies
+        self.breaker = breaker or CircuitBreaker(name)
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.window = window
+
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.counts = {}
+
+    def policy(self, stage):
+        return self.policies.get(stage) or self.policies.get('default') or {'deadline': 30.0, 'retries': 0, 'hedge': False}
+
+    def available(self):
+        '''
+            False while the circuit is open. Does not use up the probe call.
+        '''
+        return self.breaker.state == 'closed' or time.monotonic() - self.breaker.opened_at >= self.breaker.reset_seconds
+
+    async def call(self, stage, fn):
+        policy = self.policy(stage)
+        deadline = time.monotonic() + policy['deadline']
+        attempts = policy['retries'] + 1
+        self._count(stage, 'calls')
+
+        for attempt in range(attempts):
+            self._allow(stage)
+            start_time = time.perf_counter()
+            try:
+                result = await self._attempt(stage, fn, self._attempt_timeout(policy, deadline, attempts - attempt), policy['hedge'])
+            except Exception as e:
+                error = self._failed(stage, e)
+            else:
+                self._succeeded(stage, start_time)
+                return result
+
+            backoff = self._backoff(attempt, deadline)
+            if attempt + 1 == attempts or backoff is None:
+                break
+            self._count(stage, 'retries')
+            await asyncio.sleep(backoff)
+        raise error
+
+    def call_sync(self, stage, fn):
+        policy = self.policy(stage)
+        deadline = time.monotonic() + policy['deadline']
+        attempts = policy['retries'] + 1
+        self._count(stage, 'calls')
+
+        for attempt in range(attempts):
+            self._allow(stage)
+            start_time = time.perf_counter()
+            try:
+                result = fn(self._attempt_timeout(policy, deadline, attempts - attempt))
+            except Exception as e:
+                error = self._failed(stage, e)
+            else:
+                self._succeeded(stage, start_time)
+                return result
+
+            backoff = self._backoff(attempt, deadline)
+            if attempt + 1 == attempts or backoff is None:
+                break
+            self._count(stage, 'retries')
+            time.sleep(backoff)
+        raise error
+
+    async def stream(self, stage, fn):
+        '''
+            Yields the chunks of the async generator returned by fn(). Attempts that fail
+            before their first chunk are retried, a stream that fails after it is not and
+            raises an UpstreamError.
+        '''
+        policy = self.policy(stage)
+        deadline = time.monotonic() + policy['deadline']
+        attempts = policy['retries'] + 1
+        self._count(stage, 'calls')
+
+        for attempt in range(attempts):
+            self._allow(stage)
+            start_time = time.perf_counter()
+            chunks = fn()
+            try:
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), timeout=self._attempt_timeout(policy, deadline, attempts - attempt))
+                except StopAsyncIteration:
+                    self._succeeded(stage, start_time)
+                    return
+                except Exception as e:
+                    error = self._failed(stage, e)
+                else:
+                    self._succeeded(stage, start_time)
+                    yield first
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=policy['deadline'])
+                        except StopAsyncIteration:
+                            return
+                        except asyncio.TimeoutError:
+                            raise self._failed(stage, asyncio.TimeoutError())
+                        except Exception as e:
+                            raise self._failed(stage, e)
+                        yield chunk
+            finally:
+                await chunks.aclose()
+
+            backoff = self._backoff(attempt, deadline)
+            if attempt + 1 == attempts or backoff is None:
+                break
+            self._count(stage, 'retries')
+            await asyncio.sleep(backoff)
+        raise error
+
+    async def _attempt(self, stage, fn, timeout, hedge):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        tasks = [asyncio.ensure_future(fn())]
+        try:
+            hedge_delay = self._hedge_delay(stage) if hedge else None
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, pending = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done and self._hedge_allowed(stage):
+                    self._count(stage, 'hedges')
+                    tasks.append(asyncio.ensure_future(fn()))
+
+            pending = list(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self._count(stage, 'hedge_wins')
+                        return task.result()
+            # Every request failed, raise the error of the first one
+            raise tasks[0].exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _attempt_timeout(self, policy, deadline, attempts_left):
+        remaining = deadline - time.monotonic()
+        if policy.get('attempt_deadline'):
+            return min(policy['attempt_deadline'], remaining)
+        return remaining / attempts_left
+
+    def _allow(self, stage):
+        if not self.breaker.allow():
+            self._count(stage, 'rejected')
+            raise CircuitOpenError(f'Circuit {self.name} is open')
+
+    def _failed(self, stage, e):
+        '''
+            Records a failed attempt and returns the UpstreamError to raise.
+        '''
+        self.breaker.failure()
+        if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+            self._count(stage, 'timeouts')
+            error = DeadlineExceeded(f'{self.name} {stage} exceeded its deadline')
+        else:
+            self._count(stage, 'failures')
+            error = UpstreamError(f'{self.name} {stage} failed. {type(e).__name__}: {e}')
+        error.__cause__ = e
+        logging.warning(f'{error}')
+        return error
+
+    def _succeeded(self, stage, start_time):
+        self.breaker.success()
+        with self._lock:
+            self.latencies.setdefault(stage, deque(maxlen=self.window)).append((time.perf_counter() - start_time) * 1000)
+
+    def _backoff(self, attempt, deadline):
+        '''
+            Full-jitter backoff before the next attempt, or None when it would not fit in the deadline.
+        '''
+        backoff = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+        if time.monotonic() + backoff >= deadline:
+            return None
+        return backoff
+
+    def _hedge_delay(self, stage):
+        with self._lock:
+            latencies = self.latencies.get(stage)
+            if latencies is None or len(latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] / 1000
+
+    def _hedge_allowed(self, stage):
+        with self._lock:
+            counts = self.counts.get(stage, {})
+            return counts.get('hedges', 0) < self.max_hedge_ratio * counts.get('calls', 0)
+
+    def _count(self, stage, key):
+        with self._lock:
+            counts = self.counts.setdefault(stage, {})
+            counts[key] = counts.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            stages = {}
+            for stage, counts in self.counts.items():
+                ordered = sorted(self.latencies.get(stage, ()))
+                stages[stage] = dict(counts)
+                stages[stage]['p50_ms'] = round(ordered[len(ordered) // 2], 2) if ordered else None
+                stages[stage]['p95_ms'] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2) if ordered else None
+        return {'circuit': self.breaker.stats(), 'stages': stages}
@@ -0,0 +1,266 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+from modules.embeddings import normalize_history
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+class _Partition:
+    '''
+        Entries of one (route, kb_version): a preallocated matrix of normalized question
+        vectors, grown by doubling, with the expiry time and history hash of each row.
+        A removed row is filled with the last row, so rows stay contiguous.
+    '''
+
+    def __init__(self, dim, capacity=64):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires_at = np.zeros(capacity)
+        self.histories = np.zeros(capacity, dtype=np.int64)
+        self.entry_ids = []
+
+    def add(self, entry_id, vector, expires_at, history_hash):
+        row = len(self.entry_ids)
+        if row == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.expires_at = np.concatenate([self.expires_at, np.zeros_like(self.expires_at)])
+            self.histories = np.concatenate([self.histories, np.zeros_like(self.histories)])
+        self.vectors[row] = vector
+        self.expires_at[row] = expires_at
+        self.histories[row] = history_hash
+        self.entry_ids.append(entry_id)
+        return row
+
+    def remove(self, row):
+        '''
+            Returns the entry id moved into row, or None when row was the last one.
+        '''
+        last = len(self.entry_ids) - 1
+        moved = None
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.expires_at[row] = self.expires_at[last]
+            self.histories[row] = self.histories[last]
+            self.entry_ids[row] = moved = self.entry_ids[last]
+        self.entry_ids.pop()
+        return moved
+
+    def best(self, query_vector, history_hash, now):
+        '''
+            Returns (row, similarity) of the most similar live entry with the same history, or None.
+        '''
+        count = len(self.entry_ids)
+        if count == 0 or query_vector.shape[0] != self.vectors.shape[1]:
+            return None
+        similarities = self.vectors[:count] @ query_vector
+        similarities[(self.histories[:count] != history_hash) | (self.expires_at[:count] < now)] = -np.inf
+        row = int(np.argmax(similarities))
+        if similarities[row] == -np.inf:
+            return None
+        return row, float(similarities[row])
+
+
+class ResponseCache:
+    '''
+        Semantic cache of formatted agent responses.
+
+        An entry is stored under (route, kb_version) with the embedding of the
+        question and the normalized prior chat history. lookup() returns the stored
+        response of the most similar entry with the same history when its cosine
+        similarity reaches similarity_threshold, so a follow-up answer is only served
+        within the same conversation. Entries are evicted LRU beyond max_size and
+        expire after ttl_seconds. Only turns with at most max_history_turns of prior
+        chat history are cached.
+
+        The vectors of each (route, kb_version) live in one preallocated matrix, so a
+        lookup is a single matrix-vector product. Expired entries are skipped by
+        lookups and dropped as new entries are stored.
+    '''
+
+    def __init__(self, similarity_threshold=0.95, max_size=2000, ttl_seconds=3600, max_history_turns=1):
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.max_history_turns = max_history_turns
+
+        self._entries = OrderedDict()
+        self._partitions = {}
+        # (expires_at, entry_id) in insertion order, which is expiry order for a fixed TTL
+        self._expiry = deque()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_ms = 0.0
+        self.fallback_hits = 0
+
+    def eligible(self, chat_history):
+        return len(chat_history) <= self.max_history_turns
+
+    def lookup(self, query_embedding, route, kb_version, chat_history=None):
+        '''
+            Returns the cached agent_response or None.
+        '''
+        if query_embedding is None:
+            return None
+
+        query_vector = self._normalize(query_embedding)
+        history = normalize_history(chat_history)
+
+        with self._lock:
+            self.lookups += 1
+            entry_id = self._best([self._partitions.get((route, kb_version))], query_vector, history)
+            if entry_id is None:
+                return None
+
+            entry = self._entries[entry_id]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            self.saved_ms += entry['cost_ms']
+            return entry['response']
+
+    def lookup_fallback(self, query_embedding, chat_history=None):
+        '''
+            Returns the cached agent_response with the same chat history closest to
+            query_embedding across every route and knowledge base version, or None.
+            Served when Gemini is unavailable.
+        '''
+        if query_embedding is None:
+            return None
+
+        query_vector = self._normalize(query_embedding)
+        history = normalize_history(chat_history)
+        with self._lock:
+            entry_id = self._best(list(self._partitions.values()), query_vector, history)
+            if entry_id is None:
+                return None
+            self.fallback_hits += 1
+            return self._entries[entry_id]['response']
+
+    def put(self, query_embedding, route, kb_version, response, cost_ms=0.0, table_id=None, chat_history=None):
+        '''
+            cost_ms is the retrieval + generation latency a future hit will save.
+        '''
+        if query_embedding is None or not response:
+            return
+
+        vector = self._normalize(query_embedding)
+        history = normalize_history(chat_history)
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            partition = self._partitions.get((route, kb_version))
+            if partition is None:
+                partition = self._partitions[(route, kb_version)] = _Partition(vector.shape[0])
+            elif vector.shape[0] != partition.vectors.shape[1]:
+                return
+
+            entry_id = self._next_id
+            self._next_id += 1
+            expires_at = now + self.ttl_seconds
+            self._entries[entry_id] = {
+                'partition': (route, kb_version),
+                'row': partition.add(entry_id, vector, expires_at, hash(history)),
+                'history': history,
+                'table_id': table_id,
+                'response': response,
+                'cost_ms': cost_ms,
+            }
+            self._expiry.append((expires_at, entry_id))
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table_id=None):
+        '''
+            Drops entries built from table_id, or every entry when table_id is None.
+        '''
+        with self._lock:
+            if table_id is None:
+                dropped = list(self._entries)
+            else:
+                dropped = [entry_id for entry_id, entry in self._entries.items() if entry['table_id'] == table_id]
+            for entry_id in dropped:
+                self._remove(entry_id)
+            self.invalidations += len(dropped)
+        logging.info(f'Invalidated {len(dropped)} cached responses for {table_id or "all tables"}')
+
+    def _best(self, partitions, query_vector, history):
+        '''
+            Returns the id of the most similar live entry with the same history across
+            partitions when it reaches similarity_threshold, or None. Called with the lock held.
+        '''
+        history_hash = hash(history)
+        now = time.monotonic()
+        best_id, best_similarity = None, self.similarity_threshold
+        for partition in partitions:
+            if partition is None:
+                continue
+            best = partition.best(query_vector, history_hash, now)
+            if best is not None and best[1] >= best_similarity:
+                best_id, best_similarity = partition.entry_ids[best[0]], best[1]
+        # Equal hashes of different histories are not a match
+        if best_id is not None and self._entries[best_id]['history'] != history:
+            return None
+        return best_id
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] < now:
+            expires_at, entry_id = self._expiry.popleft()
+            if entry_id in self._entries:
+                self._remove(entry_id)
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        partition = self._partitions[entry['partition']]
+        moved = partition.remove(entry['row'])
+        if moved is not None:
+            self._entries[moved]['row'] = entry['row']
+        if not partition.entry_ids:
+            del self._partitions[entry['partition']]
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'partitions': len(self._partitions),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'saved_ms': round(self.saved_ms, 2),
+            'fallback_hits': self.fallback_hits,
+        }
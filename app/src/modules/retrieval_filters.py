@@ -0,0 +1,105 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Metadata filters that restrict retrieval to a partition of a knowledge base table.
+#
+# A filter is a dict with a name, the columns it looks at and a list of terms. A
+# row matches when any of the terms appears as a token in any of the columns.
+# Filters are ANDed. The local indexes ignore a filter that matches no row and top
+# up a partition smaller than k with the best rows from the rest of the table.
+# BigQuery retries without filters when the filtered query returns nothing. A
+# filter can reorder and narrow the knowledge base but never empty it.
+#
+# "Partition" here means the subset of rows a filter selects, not a BigQuery table
+# partition. The embeddings tables are neither partitioned nor clustered, and the
+# filters are regexp_contains conditions, so a filtered BigQuery query still scans
+# (and bills) the whole table. The saving is in the local indexes, which only score
+# the candidate rows, and in the relevance of the rows returned.
+
+import re
+
+# Columns that may be used in a filter. They are interpolated into SQL, so keep this an allow-list.
+FILTER_FIELDS = ('title', 'keywords', 'genres', 'releaseYear', 'categories', 'lang')
+
+# Article topics for the support routes, matched against the title and keywords columns
+ROUTE_TOPICS = {
+    'cancellation': ('cancel', 'cancellation', 'cancelling', 'canceling', 'unsubscribe', 'subscription', 'membership', 'pause'),
+    'payments': ('payment', 'payments', 'pay', 'billing', 'bill', 'refund', 'refunds', 'charge', 'charged', 'charges', 'card', 'invoice', 'price', 'plan', 'plans'),
+    'login': ('login', 'log-in', 'sign-in', 'signin', 'password', 'account', 'email', 'reset', 'profile', 'verification', 'code'),
+}
+
+# Routes whose questions can name a genre or a release year
+MEDIA_ROUTES = ('media', 'recommendations')
+
+GENRE_TERMS = (
+    'action', 'adventure', 'animation', 'anime', 'biography', 'comedy', 'crime', 'documentary', 'drama',
+    'family', 'fantasy', 'history', 'horror', 'kids', 'musical', 'mystery', 'reality', 'romance',
+    'sci-fi', 'sports', 'thriller', 'war', 'western',
+)
+GENRE_ALIASES = {'romantic': 'romance', 'scary': 'horror', 'funny': 'comedy', 'documentaries': 'documentary', 'comedies': 'comedy', 'dramas': 'drama', 'thrillers': 'thriller', 'westerns': 'western', 'cartoons': 'animation', 'animated': 'animation', 'science fiction': 'sci-fi', 'scifi': 'sci-fi'}
+
+YEAR_PATTERN = re.compile(r'\b(19[2-9]\d|20[0-4]\d)\b')
+DECADE_PATTERN = re.compile(r"\b(?:(19|20)?([0-9])0)'?s\b")
+
+
+def topic_filter(route):
+    terms = ROUTE_TOPICS.get(route)
+    if not terms:
+        return None
+    return {'name': f'topic:{route}', 'fields': ('title', 'keywords'), 'terms': terms}
+
+
+def genre_filter(user_comment):
+    text = f'{user_comment}'.lower()
+    for alias, genre in GENRE_ALIASES.items():
+        text = re.sub(rf'\b{alias}\b', genre, text)
+    genres = sorted({genre for genre in GENRE_TERMS if re.search(rf'(?<![a-z0-9-]){re.escape(genre)}(?![a-z0-9-])', text)})
+    if not genres:
+        return None
+    return {'name': f"genres:{'+'.join(genres)}", 'fields': ('genres',), 'terms': tuple(genres)}
+
+
+def year_filter(user_comment):
+    text = f'{user_comment}'.lower()
+    years = set(YEAR_PATTERN.findall(text))
+    for century, decade in DECADE_PATTERN.findall(text):
+        # "80s" and "'80s" mean the 1980s, "2010s" spells the century out
+        start = int(f'{century or "19"}{decade}0')
+        if century or decade != '0':
+            years.update(str(year) for year in range(start, start + 10))
+    if not years:
+        return None
+    ordered = sorted(years)
+    name = ordered[0] if len(ordered) == 1 else f'{ordered[0]}-{ordered[-1]}'
+    return {'name': f'releaseYear:{name}', 'fields': ('releaseYear',), 'terms': tuple(ordered)}
+
+
+def route_filters(route, user_comment, use_topics=True, lang=''):
+    '''
+        Filters for the knowledge base of route: the route's article topic and language
+        for the support routes, and genres and release years named in the question
+        for the media routes.
+    '''
+    filters = []
+    if route in MEDIA_ROUTES:
+        filters = [genre_filter(user_comment), year_filter(user_comment)]
+    elif route in ROUTE_TOPICS:
+        filters = [topic_filter(route) if use_topics else None]
+        if lang:
+            filters.append({'name': f'lang:{lang}', 'fields': ('lang',), 'terms': (lang.lower(),)})
+    return [f for f in filters if f is not None]
+
+
+def partition_name(filters):
+    return '+'.join(f['name'] for f in filters) or 'all'
@@ -0,0 +1,256 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import os
+import sys
+import time
+import inspect
+import logging
+import threading
+import numpy as np
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+ROUTES = ['cancellation', 'payments', 'login', 'recommendations', 'media', 'general']
+
+# (pattern, weight). A weight of 2 is strong enough to route on its own.
+KEYWORD_RULES = {
+    'cancellation': [
+        # Match the request to cancel, not the word: "was my flight cancelled?" is a status question
+        (r'(cancel|terminate) (my|the|our)', 2), (r'(how (do|can) i|want to|like to|need to) (cancel|terminate)', 2),
+        (r'cancel\w*', 1), (r'unsubscribe', 2), (r'end my (subscription|membership)', 2),
+        (r'close my account', 2), (r'stop (my )?(subscription|membership)', 2),
+    ],
+    'payments': [
+        (r'refund\w*', 2), (r'payments?', 2), (r'billing', 2), (r'billed', 2), (r'charged?', 2),
+        (r'credit card', 2), (r'invoice', 2), (r'money', 1), (r'price', 1), (r'bill', 1),
+    ],
+    'login': [
+        (r'password', 2), (r'log ?in', 2), (r'sign ?in', 2), (r'username', 2), (r'locked out', 2),
+        (r'account details', 2), (r'email address', 1), (r'verification code', 2), (r'account', 1),
+    ],
+    'recommendations': [
+        (r'recommend\w*', 2), (r'suggest\w*', 2), (r'what should i watch', 2), (r'something to watch', 2),
+        (r'similar to', 2), (r'anything like', 2), (r'good (movies|shows|films)', 2),
+    ],
+    'media': [
+        (r'episodes?', 2), (r'seasons?', 2), (r'trailer', 2), (r'cast', 1), (r'movie', 1),
+        (r'show', 1), (r'series', 1), (r'film', 1), (r'watch', 1), (r'available', 1),
+    ],
+}
+
+# Seed phrases used to build the nearest-centroid classifier
+ROUTE_EXAMPLES = {
+    'cancellation': [
+        'I want to cancel my subscription', 'How do I cancel my account', 'Please end my membership',
+        'I would like to stop my plan',
+    ],
+    'payments': [
+        'I was charged twice this month', 'Can I get a refund', 'How do I update my credit card',
+        'Why is my bill higher than usual',
+    ],
+    'login': [
+        'I forgot my password', 'I cannot log in to my account', 'How do I change my email address',
+        'My account is locked',
+    ],
+    'recommendations': [
+        'What should I watch tonight', 'Recommend a good comedy movie', 'Suggest some shows like this one',
+        'Any good family films',
+    ],
+    'media': [
+        'Is season 2 of this show available', 'When does the next episode come out', 'Who is in the cast of this movie',
+        'Is this film streaming now',
+    ],
+    'general': [
+        'Hello', 'Thanks for your help', 'What are your support hours', 'Can I talk to a person',
+    ],
+}
+
+CONFIDENCE_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+def is_route(text):
+    '''
+        True when raw LLM router output names one of ROUTES.
+    '''
+    return re.sub(r'[^a-z]', '', f'{text}'.strip().lower()) in ROUTES
+
+
+def normalize_route(text):
+    '''
+        Maps raw LLM router output to one of ROUTES, defaulting to general.
+    '''
+    route = re.sub(r'[^a-z]', '', f'{text}'.strip().lower())
+    return route if route in ROUTES else 'general'
+
+
+class KeywordStage:
+    '''
+        Weighted keyword rules. Confidence is the top route's share of the total
+        score, scaled down when only weak keywords matched.
+    '''
+    name = 'keyword'
+
+    def __init__(self, rules=KEYWORD_RULES):
+        self.rules = {
+            route: [(re.compile(rf'\b{pattern}\b', re.IGNORECASE), weight) for pattern, weight in patterns]
+            for route, patterns in rules.items()
+        }
+
+    def classify(self, user_comment):
+        scores = {}
+        for route, patterns in self.rules.items():
+            score = sum(weight for pattern, weight in patterns if pattern.search(user_comment))
+            if score:
+                scores[route] = score
+
+        if not scores:
+            return None, 0.0
+
+        route = max(scores, key=scores.get)
+        top = scores[route]
+        confidence = (top / sum(scores.values())) * min(1.0, top / 2)
+        return route, confidence
+
+
+class CentroidStage:
+    '''
+        Nearest-centroid classifier over embeddings of ROUTE_EXAMPLES. Confidence
+        is the softmax probability of the closest centroid. Cosine similarities
+        between routes differ by only a few hundredths, so a low temperature makes
+        the softmax near one-hot and the router never falls back to Gemini.
+    '''
+    name = 'centroid'
+
+    def __init__(self, embed_fn, embed_many_fn=None, examples=ROUTE_EXAMPLES, temperature=0.15):
+        self.embed_fn = embed_fn
+        self.temperature = temperature
+        self.routes = []
+        self.centroids = None
+
+        try:
+            texts = [(route, text) for route, route_texts in examples.items() for text in route_texts]
+            if embed_many_fn is not None:
+                vectors = embed_many_fn([text for route, text in texts])
+            else:
+                vectors = [embed_fn(text) for route, text in texts]
+
+            centroids = []
+            for route in examples:
+                route_vectors = np.asarray([v for (r, t), v in zip(texts, vectors) if r == route], dtype=np.float32)
+                centroid = route_vectors.mean(axis=0)
+                centroids.append(centroid / np.linalg.norm(centroid))
+                self.routes.append(route)
+            self.centroids = np.vstack(centroids)
+        except Exception as e:
+            logging.exception(f'Unable to build router centroids. Centroid stage disabled. {e}')
+
+    async def classify(self, user_comment):
+        if self.centroids is None:
+            return None, 0.0
+
+        vector = self.embed_fn(user_comment)
+        if inspect.isawaitable(vector):
+            vector = await vector
+        vector = np.asarray(vector, dtype=np.float32)
+        similarities = self.centroids @ (vector / np.linalg.norm(vector))
+        probabilities = np.exp((similarities - similarities.max()) / self.temperature)
+        probabilities /= probabilities.sum()
+        best = int(np.argmax(probabilities))
+        return self.routes[best], float(probabilities[best])
+
+
+class IntentRouter:
+    '''
+        Runs the local stages in order and returns the first route whose confidence
+        reaches confidence_threshold. Otherwise falls back to fallback_fn (the
+        Gemini router). Stages are objects with a name and classify(user_comment).
+        classify and fallback_fn may be plain functions or coroutines.
+    '''
+
+    def __init__(self, stages, fallback_fn, confidence_threshold=0.75):
+        self.stages = stages
+        self.fallback_fn = fallback_fn
+        self.confidence_threshold = confidence_threshold
+
+        self._lock = threading.Lock()
+        self.total = 0
+        self.decisions = {}
+        self.latency_ms = {}
+        self.confidence_histogram = {stage.name: [0] * len(CONFIDENCE_BUCKETS) for stage in stages}
+
+    async def route(self, user_comment):
+        '''
+            Returns (route, source) where source is the stage name or "llm".
+        '''
+        for stage in self.stages:
+            start_time = time.perf_counter()
+            try:
+                result = stage.classify(user_comment)
+                if inspect.isawaitable(result):
+                    result = await result
+                route, confidence = result
+            except Exception as e:
+                logging.exception(f'Router stage {stage.name} failed. {e}')
+                continue
+
+            self._record_confidence(stage.name, confidence)
+            if route is not None and confidence >= self.confidence_threshold:
+                self._record(stage.name, route, start_time)
+                return route, stage.name
+
+        start_time = time.perf_counter()
+        route = self.fallback_fn(user_comment)
+        if inspect.isawaitable(route):
+            route = await route
+        route = normalize_route(route)
+        self._record('llm', route, start_time)
+        return route, 'llm'
+
+    def _record_confidence(self, stage_name, confidence):
+        bucket = next(i for i, upper in enumerate(CONFIDENCE_BUCKETS) if confidence <= upper or upper == 1.0)
+        with self._lock:
+            self.confidence_histogram[stage_name][bucket] += 1
+
+    def _record(self, source, route, start_time):
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        with self._lock:
+            self.total += 1
+            self.decisions.setdefault(source, {}).setdefault(route, 0)
+            self.decisions[source][route] += 1
+            self.latency_ms.setdefault(source, [0, 0.0])
+            self.latency_ms[source][0] += 1
+            self.latency_ms[source][1] += elapsed_ms
+
+    def stats(self):
+        with self._lock:
+            fallbacks = sum(self.decisions.get('llm', {}).values())
+            return {
+                'total': self.total,
+                'fallbacks': fallbacks,
+                'fallback_rate': round(fallbacks / self.total, 4) if self.total else 0.0,
+                'confidence_threshold': self.confidence_threshold,
+                'decisions': {source: dict(routes) for source, routes in self.decisions.items()},
+                'avg_latency_ms': {source: round(total / count, 3) for source, (count, total) in self.latency_ms.items()},
+                'confidence_histogram': {
+                    stage_name: dict(zip([f'le_{upper}' for upper in CONFIDENCE_BUCKETS], counts))
+                    for stage_name, counts in self.confidence_histogram.items()
+                },
+            }
@@ -0,0 +1,97 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import asyncio
+import logging
+from modules.embeddings import normalize_text, normalize_history
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+class SingleFlight:
+    '''
+        Coalesces identical in-flight requests: while a call for a key is running,
+        later calls with the same key wait for it and share its result (or exception)
+        instead of calling the upstream services again.
+
+        Keys are built by key() from the stage, the route, the normalized question and
+        the normalized chat history. Turns with more than max_history_turns of history
+        are never coalesced. The shared call runs in its own task, so a caller that
+        disconnects does not cancel it for the others. Runs on a single event loop.
+    '''
+
+    def __init__(self, max_history_turns=1, enabled=True):
+        self.max_history_turns = max_history_turns
+        self.enabled = enabled
+
+        self._flights = {}
+        self.counts = {}
+
+    def key(self, stage, user_comment, chat_history, route=None):
+        '''
+            Returns the coalescing key of a call, or None when it should not be coalesced.
+        '''
+        chat_history = chat_history or []
+        if not self.enabled or len(chat_history) > self.max_history_turns:
+            return None
+        return (stage, route, normalize_text(user_comment), normalize_history(chat_history))
+
+    async def do(self, key, fn):
+        '''
+            Returns (result, joined) where result is that of await fn() and joined is True
+            when the result was shared from a call already in flight.
+        '''
+        if key is None:
+            return await fn(), False
+
+        stage_counts = self.counts.setdefault(key[0], {'calls': 0, 'joined': 0})
+        stage_counts['calls'] += 1
+
+        future = self._flights.get(key)
+        if future is not None:
+            stage_counts['joined'] += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.ensure_future(fn())
+        self._flights[key] = future
+        future.add_done_callback(lambda done: self._done(key, done))
+        return await asyncio.shield(future), False
+
+    def _done(self, key, future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        # Retrieve the exception so it is not reported as never retrieved when every caller left
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self):
+        '''
+            Per stage: calls eligible for coalescing, calls that joined one in flight
+            (each one an upstream call saved) and the coalescing ratio.
+        '''
+        stats = {'in_flight': len(self._flights), 'stages': {}}
+        for stage, stage_counts in self.counts.items():
+            stats['stages'][stage] = {
+                'calls': stage_counts['calls'],
+                'upstream_calls': stage_counts['calls'] - stage_counts['joined'],
+                'upstream_calls_saved': stage_counts['joined'],
+                'coalescing_ratio': round(stage_counts['joined'] / stage_counts['calls'], 4) if stage_counts['calls'] else 0.0,
+            }
+        return stats
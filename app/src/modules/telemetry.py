@@ -0,0 +1,343 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-request tracing and Prometheus metrics for /chat.
+#
+# A trace is opened per request with Telemetry.trace() and stages are timed with
+# telemetry.span(name), or telemetry.add_span() for work timed elsewhere. Spans
+# parent themselves on the span active in the current context (asyncio tasks
+# inherit it) and are no-ops outside a trace.
+#
+# Metrics are recorded for every request. Spans are only exported for the sampled
+# share of requests (sample_rate) and for requests that failed. exporter='log'
+# writes each trace as one OTLP/JSON line to the "telemetry" logger, exporter='otel'
+# replays the spans into the OpenTelemetry SDK when it is installed and configured.
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+logger = logging.getLogger('telemetry')
+
+# Stages with a latency histogram in /metrics
+STAGES = ('router', 'retrieval', 'prompt_build', 'generation', 'formatting')
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+
+    def __init__(self, trace, name, parent=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start = time.perf_counter()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+
+class NoopSpan:
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+
+    def __init__(self, telemetry, name, sampled, attributes=None):
+        self.telemetry = telemetry
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans = []
+        self.wall_start_ns = time.time_ns()
+        self.root = self.open_span(name, None, attributes)
+
+    def open_span(self, name, parent, attributes=None):
+        span = Span(self, name, parent, attributes)
+        self.spans.append(span)
+        return span
+
+    def set(self, **attributes):
+        self.root.set(**attributes)
+
+    def unix_nano(self, perf_time):
+        return self.wall_start_ns + int((perf_time - self.root.start) * 1e9)
+
+
+@contextmanager
+def span(name, **attributes):
+    '''
+        Times a stage of the current trace. Yields a NoopSpan when no trace is active.
+    '''
+    parent = current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = parent.trace.open_span(name, parent, attributes)
+    current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.status = 'cancelled' if type(e).__name__ == 'CancelledError' else 'error'
+        child.set(error=f'{type(e).__name__}: {e}')
+        raise
+    finally:
+        child.end = time.perf_counter()
+        current_span.set(parent)
+
+
+def add_span(name, start, end=None, **attributes):
+    '''
+        Records a stage of the current trace timed elsewhere, from start to end (perf_counter
+        values, end defaults to now). Used for work whose span can not wrap it directly, such as
+        a speculative retrieval started before the route was known.
+    '''
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+
+    child = parent.trace.open_span(name, parent, attributes)
+    child.start = start
+    child.end = end if end is not None else time.perf_counter()
+    return child
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Telemetry:
+    '''
+        Opens request traces, keeps the Prometheus metrics and exports sampled traces.
+
+        sample_rate: Share of traces exported (0 to 1). Traces with an error are always exported.
+        exporter:    'log' (OTLP/JSON lines), 'otel' (OpenTelemetry SDK) or 'none'.
+    '''
+
+    def __init__(self, service_name='lunar-support-ai', sample_rate=0.1, exporter='log'):
+        self.service_name = service_name
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        if exporter == 'otel' and otel_trace is None:
+            logging.warning('opentelemetry is not installed. Exporting traces to the log instead.')
+            self.exporter = 'log'
+        self.otel_tracer = otel_trace.get_tracer(service_name) if self.exporter == 'otel' else None
+
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.traces = {'started': 0, 'exported': 0, 'errors': 0}
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        '''
+            Opens the root span of a request. Set the route with trace.set(route=...) so
+            the request lands in the right per-route histograms.
+        '''
+        trace = Trace(self, name, random.random() < self.sample_rate, attributes)
+        previous = current_span.get()
+        current_span.set(trace.root)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.root.status = 'error'
+            trace.root.set(error=f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            trace.root.end = time.perf_counter()
+            current_span.set(previous)
+            self.finish(trace)
+
+    def finish(self, trace):
+        failed = any(s.status == 'error' for s in trace.spans)
+        self._record(trace, failed)
+        if self.exporter != 'none' and (trace.sampled or failed):
+            try:
+                self._export(trace)
+            except Exception as e:
+                logging.exception(f'At telemetry export. {e}')
+
+    def _record(self, trace, failed):
+        route = f"{trace.root.attributes.get('route', 'unknown')}"
+        endpoint = f"{trace.root.attributes.get('endpoint', trace.root.name)}"
+        with self._lock:
+            self.traces['started'] += 1
+            self.traces['errors'] += int(failed)
+            self._observe('chat_request_duration_seconds', (('route', route), ('endpoint', endpoint)), trace.root.duration_ms() / 1000)
+            # Requests that shared a stage with an identical request in flight (see single_flight)
+            for key, joined in trace.root.attributes.items():
+                if key.startswith('coalesced.') and joined:
+                    self._count('chat_coalesced_requests_total', (('stage', key[len('coalesced.'):]), ('route', route)), 1)
+            # Answers served without the main path: kb_less, cached or static (see main.fallback_response)
+            if trace.root.attributes.get('fallback'):
+                self._count('chat_fallback_responses_total', (('kind', f"{trace.root.attributes['fallback']}"),), 1)
+            for s in trace.spans:
+                if s.name not in STAGES or s.end is None or s.status != 'ok':
+                    continue
+                self._observe('chat_stage_duration_seconds', (('stage', s.name), ('route', route)), s.duration_ms() / 1000)
+                a = s.attributes
+                if 'gen_ai.usage.input_tokens' in a:
+                    self._count('chat_prompt_tokens_total', (('route', route),), a['gen_ai.usage.input_tokens'])
+                if 'gen_ai.usage.output_tokens' in a:
+                    self._count('chat_completion_tokens_total', (('route', route),), a['gen_ai.usage.output_tokens'])
+                if s.name == 'retrieval' and a.get('retrieval.source'):
+                    table = (('table_id', f"{a.get('db.sql.table', '')}"), ('source', f"{a['retrieval.source']}"))
+                    self._count('retrieval_requests_total', table, 1)
+                    self._count('bigquery_bytes_processed_total', table[:1], a.get('bigquery.bytes_processed') or 0)
+                    self._count('bigquery_slot_milliseconds_total', table[:1], a.get('bigquery.slot_ms') or 0)
+
+    def _observe(self, name, labels, value):
+        histogram = self.histograms.setdefault(name, {}).get(labels)
+        if histogram is None:
+            histogram = self.histograms[name][labels] = Histogram()
+        histogram.observe(value)
+
+    def _count(self, name, labels, value):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def _export(self, trace):
+        if self.otel_tracer is not None:
+            self._export_otel(trace)
+        else:
+            logger.info(json.dumps(self.otlp_json(trace)))
+        with self._lock:
+            self.traces['exported'] += 1
+
+    def _export_otel(self, trace):
+        otel_spans = {}
+        for s in trace.spans:
+            parent = otel_spans.get(s.parent_id)
+            context = otel_trace.set_span_in_context(parent) if parent is not None else None
+            otel_span = self.otel_tracer.start_span(s.name, context=context, start_time=trace.unix_nano(s.start), attributes=self._attribute_values(s.attributes))
+            if s.status != 'ok':
+                otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, s.attributes.get('error', s.status)))
+            otel_spans[s.span_id] = otel_span
+        for s in trace.spans:
+            otel_spans[s.span_id].end(end_time=trace.unix_nano(s.end or trace.root.end))
+
+    def _attribute_values(self, attributes):
+        return {k: v if isinstance(v, (str, bool, int, float)) else f'{v}' for k, v in attributes.items() if v is not None}
+
+    def otlp_json(self, trace):
+        '''
+            Returns the trace in the OTLP/JSON encoding (a single ResourceSpans).
+        '''
+        def value(v):
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': f'{v}'}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': f'{v}'}
+
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'lunar-support-ai.telemetry'}, 'spans': [
+                {
+                    'traceId': trace.trace_id,
+                    'spanId': s.span_id,
+                    'parentSpanId': s.parent_id or '',
+                    'name': s.name,
+                    'startTimeUnixNano': f'{trace.unix_nano(s.start)}',
+                    'endTimeUnixNano': f'{trace.unix_nano(s.end or trace.root.end)}',
+                    'attributes': [{'key': k, 'value': value(v)} for k, v in self._attribute_values(s.attributes).items()],
+                    'status': {'code': 1 if s.status == 'ok' else 2},
+                }
+                for s in trace.spans
+            ]}],
+        }]}
+
+    def metrics(self):
+        '''
+            Returns the metrics in the Prometheus text exposition format.
+        '''
+        def labels_text(labels):
+            return ','.join(f'{k}="{v}"' for k, v in labels)
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels_text(labels + (("le", f"{bound}"),))}}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{labels_text(labels + (("le", "+Inf"),))}}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels_text(labels)}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels_text(labels)}}} {histogram.count}')
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{{{labels_text(labels)}}} {value}')
+            lines.append('# TYPE chat_traces_total counter')
+            for key, value in self.traces.items():
+                lines.append(f'chat_traces_total{{state="{key}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'exporter': self.exporter,
+                'traces': dict(self.traces),
+            }
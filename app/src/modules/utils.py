@@ -12,35 +12,172 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
 import logging
 import re
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
     stream=sys.stdout,
 )
 
+# Single-pass tokenizer for the markdown subset Gemini emits. Every character that
+# is not part of a token is plain text, so text between tokens needs no escaping.
+LABELS = ('User:', 'Agent:', 'user:', 'agent:')
+TOKEN_PATTERN = re.compile(
+    # The lookahead lets the scanner skip plain text without trying each alternative
+    r'(?=[UuAa*\r\n<\[&>])'
+    r'(?:(?P<label>' + '|'.join(re.escape(label) for label in LABELS) + r')'
+    r'|(?P<bold>\*\*)'
+    r'|(?P<newline>\r?\n|<br\s*/?>)'
+    r'|\[(?i:url|knowledge base url):\s*(?P<kb_url>https?://[^\]]+?)\s*\]'
+    r'|\[(?P<link_text>[^\]\n]*)\]\((?P<link_url>[^)\s]*)\)'
+    r'|(?P<special>[&<>]))'
+)
+# End of a chunk that may still become a token: a label prefix, a lone "*", "\r" or part of "<br>"
+PARTIAL_TAIL = re.compile(
+    r'(?:' + '|'.join(re.escape(label[:n]) for label in LABELS for n in range(len(label) - 1, 0, -1)) + r'|\*|\r|<(?:b(?:r\s*/?)?)?)\Z'
+)
+# A complete link token starting at a "[" (the kb_url and link alternatives of TOKEN_PATTERN)
+COMPLETE_LINK = re.compile(r'\[(?i:url|knowledge base url):\s*https?://[^\]]+?\s*\]|\[[^\]\n]*\]\([^)\s]*\)')
+SAFE_URL = re.compile(r'^(?:https?://|mailto:)', re.IGNORECASE)
+ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'}
+ESCAPE_PATTERN = re.compile(r'[&<>"\']')
+
+
+def escape(text):
+    return ESCAPE_PATTERN.sub(lambda m: ESCAPES[m.group()], text)
+
+
+def anchor(url, text):
+    # Only web and mail links become anchors, anything else (e.g. javascript:) stays text
+    if not SAFE_URL.match(url):
+        return escape(text)
+    return f'<a href="{escape(url)}" target="_blank">{escape(text)}</a>'
+
+
 def format_summary(input:str):
-    formatted_str = input.replace('\n','<br>')
-
-    formatted_str = formatted_str.replace('User:','').replace('Agent:','').replace('user:','').replace('agent:','').strip()
-    
-    while '**' in formatted_str:
-        formatted_str = formatted_str.replace('**', '<b>', 1)
-        formatted_str = formatted_str.replace('**', '</b>', 1)
-    
-    # Convert markdown to <a href>
-    formatted_str = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2" target="_blank">\1</a>', formatted_str, flags=re.IGNORECASE)
-    formatted_str = re.sub(r'\[url:\s*(https?://[^\]]+)\]', r'<a href="\1" target="_blank">\1</a>', formatted_str, flags=re.IGNORECASE)
-    formatted_str = re.sub(r'\[Knowledge Base URL:\s*(https?://[^\]]+)\]', r'<a href="\1" target="_blank">\1</a>', formatted_str, flags=re.IGNORECASE)
-    
-    return formatted_str
+    '''
+        Formats a Gemini response as HTML: **bold**, [text](url), [url: ...] and
+        [Knowledge Base URL: ...] links and newlines, with "User:"/"Agent:" labels
+        removed. All other text is HTML-escaped, so the output only contains <b>, <br>
+        and <a href> tags.
+    '''
+    return StreamingFormatter().flush(input)
+
+
+class StreamingFormatter:
+    '''
+        Incremental version of format_summary for streamed responses.
+
+        feed() returns the HTML for the text that can be safely formatted so far.
+        Trailing text that may still turn into markup (a lone "*", an unclosed
+        "[...](...)" link or a partial "User:"/"Agent:" label) is held back until
+        the next chunk or flush(). Bold state is carried across chunks and an
+        unclosed bold is closed by flush(). Each character is tokenized once.
+    '''
+    MAX_HOLDBACK = 2048
+
+    def __init__(self):
+        self.buffer = ''
+        self.bold_open = False
+        self.started = False
+        self.pending_whitespace = ''
+        self.parts = []
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        return self._emit(self._safe_cut(self.buffer))
+
+    def flush(self, chunk=''):
+        '''
+            Formats everything left, including an optional last chunk.
+        '''
+        self.buffer += chunk
+        html = self._emit(len(self.buffer))
+        if self.bold_open:
+            self.bold_open = False
+            self.parts.append('</b>')
+            html += '</b>'
+        self.pending_whitespace = ''
+        return html
+
+    def _safe_cut(self, text):
+        cut = len(text)
+
+        tail = PARTIAL_TAIL.search(text, max(0, cut - 8))
+        if tail:
+            cut = tail.start()
+            # "**" is complete, only an odd run of stars is held back
+            if text[cut] == '*' and (len(text) - len(text.rstrip('*'))) % 2 == 0:
+                cut = len(text)
+
+        # Hold back from the first "[" that may still open a link. A complete link is
+        # skipped whole, so a "[" inside its URL is not mistaken for the start of one.
+        start = text.find('[', max(0, len(text) - self.MAX_HOLDBACK), cut)
+        while start != -1:
+            link = COMPLETE_LINK.match(text, start)
+            if link:
+                start = text.find('[', link.end(), cut)
+                continue
+            close = text.find(']', start)
+            if close == -1 or close == len(text) - 1 or (text[close + 1] == '(' and text.find(')', close) == -1):
+                if text.find('\n', start) == -1:
+                    cut = start
+                    break
+            start = text.find('[', start + 1, cut)
+
+        return cut
+
+    def _emit(self, cut):
+        segment, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        if not segment:
+            return ''
+
+        out = []
+        position = 0
+        for match in TOKEN_PATTERN.finditer(segment):
+            out.append(segment[position:match.start()])
+            position = match.end()
+            kind = match.lastgroup
+            if kind == 'bold':
+                out.append('</b>' if self.bold_open else '<b>')
+                self.bold_open = not self.bold_open
+            elif kind == 'newline':
+                out.append('<br>')
+            elif kind == 'special':
+                out.append(ESCAPES[match.group()])
+            elif kind == 'kb_url':
+                out.append(anchor(match.group('kb_url'), match.group('kb_url')))
+            elif kind == 'link_url':
+                out.append(anchor(match.group('link_url'), match.group('link_text').replace('**', '')))
+        out.append(segment[position:])
+        html = ''.join(out)
+
+        if not self.started:
+            html = html.lstrip()
+            self.started = html != ''
+
+        html = self.pending_whitespace + html
+        stripped = html.rstrip()
+        self.pending_whitespace = html[len(stripped):]
+
+        self.parts.append(stripped)
+        return stripped
+
+
+SPEECH_WHITESPACE = re.compile('(\n|\t|\r)')
+SPEECH_UNSPOKEN = re.compile('[^a-zA-Z0-9 \\.\\!\\?\\,\']')
 
 
 def format_summary_for_speech(input_str):
-    formatted_str = re.sub('(\n|\t|\r)',' ', input_str)
-    formatted_str = re.sub('[^a-zA-Z0-9 \\.\\!\\?\\,\']',' ', formatted_str)
+    formatted_str = SPEECH_WHITESPACE.sub(' ', input_str)
+    formatted_str = SPEECH_UNSPOKEN.sub(' ', formatted_str)
     return formatted_str
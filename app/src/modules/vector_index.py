@@ -0,0 +1,112 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import logging
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    stream=sys.stdout,
+)
+
+class VectorIndex:
+    '''
+        In-process cosine similarity index over a snapshot of an embeddings table
+        (such as webdata_embeddings or articledata_embeddings).
+
+        Vectors are L2-normalized once at build time so a query is a single
+        matrix-vector product. When backend='hnsw' and hnswlib is installed,
+        an approximate HNSW graph is used instead of the exact NumPy scan.
+    '''
+
+    def __init__(self, rows, embedding_column='text_embedding', backend='numpy'):
+        start_time = time.perf_counter()
+        self.embedding_column = embedding_column
+
+        rows = [dict(r) for r in rows]
+        dims = max((len(r.get(embedding_column) or []) for r in rows), default=0)
+
+        # Rows whose embedding failed have an empty vector, skip them
+        rows = [r for r in rows if dims and len(r.get(embedding_column) or []) == dims]
+
+        vectors = np.asarray([r[embedding_column] for r in rows], dtype=np.float32).reshape(len(rows), dims)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.vectors = vectors / norms
+        self.rows = [{k: v for k, v in r.items() if k != embedding_column} for r in rows]
+        self.dims = dims
+
+        self.hnsw = None
+        if backend == 'hnsw':
+            if hnswlib is None:
+                logging.warning('hnswlib is not installed. Falling back to the exact NumPy index.')
+            elif len(self.rows) > 0:
+                self.hnsw = hnswlib.Index(space='cosine', dim=dims)
+                self.hnsw.init_index(max_elements=len(self.rows), ef_construction=200, M=16)
+                self.hnsw.add_items(self.vectors, np.arange(len(self.rows)))
+
+        logging.info(f'Built vector index with {len(self.rows)} rows and {dims} dims in {(time.perf_counter() - start_time)*1000:.1f} ms')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query_vector, k=20, candidates=None):
+        '''
+            Returns a list of (row, cosine_similarity) tuples, most similar first.
+            candidates: Optional array of row positions to restrict the search to. Filtered
+                        searches always use the exact scan over the candidate rows.
+        '''
+        if len(self.rows) == 0:
+            return []
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if query_vector.shape != (self.dims,):
+            raise ValueError(f'Query vector has shape {query_vector.shape}, expected ({self.dims},)')
+
+        norm = np.linalg.norm(query_vector)
+        if norm > 0:
+            query_vector = query_vector / norm
+
+        if candidates is not None:
+            candidates = np.asarray(candidates)
+            scores = self.vectors[candidates] @ query_vector
+            return [(self.rows[candidates[i]], float(scores[i])) for i in self._top(scores, k)]
+
+        k = min(k, len(self.rows))
+
+        if self.hnsw is not None:
+            self.hnsw.set_ef(max(k * 2, 50))
+            labels, distances = self.hnsw.knn_query(query_vector, k=k)
+            return [(self.rows[i], float(1.0 - d)) for i, d in zip(labels[0], distances[0])]
+
+        scores = self.vectors @ query_vector
+        return [(self.rows[i], float(scores[i])) for i in self._top(scores, k)]
+
+    def _top(self, scores, k):
+        k = min(k, len(scores))
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top])]
@@ -0,0 +1,164 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Usage:
+# python3 bq_embeddings_refresh.py [webdata|articledata ...]
+#
+# Incrementally refreshes <source>_embeddings from <source>. Only rows whose
+# content signature changed (or that are new) go through ML.GENERATE_EMBEDDING.
+# They are MERGEd into the embeddings table, and ids that no longer exist in the
+# source are deleted. The embeddings table stays queryable throughout.
+#
+# Reads GCP_PROJECT_ID, BQ_DATASET_ID and EMBEDDING_MODEL_NAME from the environment.
+
+import os, sys
+import json
+import time
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+# key: unique id column. content: text sent to the embedding model.
+# signature_columns: extra source columns that mark a row as changed.
+SOURCES = {
+    'webdata': {
+        'key': 'contentId',
+        'content': "CONCAT(title, ' | ', logLine, ' | ', actors, ' | ', directors, ' | ', genres, ' | ', categories)",
+        'signature_columns': [],
+    },
+    'articledata': {
+        'key': 'id',
+        'content': "CONCAT(title, ' | ', `desc`)",
+        'signature_columns': ['hash', 'updatedAt'],
+    },
+}
+
+def signature(alias, signature_columns):
+    parts = [f'IFNULL({alias}.content, "")'] + [f'IFNULL(CAST({alias}.`{column}` AS STRING), "")' for column in signature_columns]
+    return 'TO_HEX(SHA256(CONCAT(' + ', "|", '.join(parts) + ')))'
+
+
+class EmbeddingRefresher:
+    def __init__(self, gcp_project_id, dataset_id, embedding_model_name):
+        self.gcp_project_id = gcp_project_id
+        self.dataset_id = dataset_id
+        self.model = f'`{gcp_project_id}.{dataset_id}.{embedding_model_name}`'
+        self.bq_client = bigquery.Client(project=self.gcp_project_id)
+
+    def table(self, table_id):
+        return f'`{self.gcp_project_id}.{self.dataset_id}.{table_id}`'
+
+    def refresh(self, source_id):
+        '''
+            Returns a dict with source_rows, skipped, embedded, failed and deleted.
+        '''
+        source = SOURCES[source_id]
+        target_id = f'{source_id}_embeddings'
+        delta_id = f'{source_id}_embeddings_delta'
+        key = source['key']
+        start_time = time.perf_counter()
+
+        try:
+            self.bq_client.get_table(f'{self.gcp_project_id}.{self.dataset_id}.{target_id}')
+            target_exists = True
+        except NotFound:
+            target_exists = False
+
+        if target_exists:
+            changed_rows = f'''
+                SELECT s.* FROM (SELECT *, {source['content']} AS content FROM {self.table(source_id)}) s
+                LEFT JOIN {self.table(target_id)} t ON s.`{key}` = t.`{key}`
+                WHERE t.`{key}` IS NULL OR {signature('s', source['signature_columns'])} != {signature('t', source['signature_columns'])}'''
+        else:
+            changed_rows = f"SELECT *, {source['content']} AS content FROM {self.table(source_id)}"
+
+        # 1. Embed new and changed rows into a delta table
+        self._run(f'''
+            CREATE OR REPLACE TABLE {self.table(delta_id)}
+            OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 1 DAY)) AS (
+              SELECT
+                * except (ml_generate_embedding_result, ml_generate_embedding_statistics, ml_generate_embedding_status),
+                ml_generate_embedding_result as text_embedding,
+                ml_generate_embedding_status as embedding_status
+              FROM ML.GENERATE_EMBEDDING(
+                MODEL {self.model},
+                ({changed_rows}),
+                STRUCT(TRUE AS flatten_json_output)
+              )
+            );''')
+
+        stats = self._counts(source_id, delta_id)
+
+        columns = [field.name for field in self.bq_client.get_table(f'{self.gcp_project_id}.{self.dataset_id}.{delta_id}').schema if field.name != 'embedding_status']
+        column_list = ', '.join(f'`{column}`' for column in columns)
+
+        # 2. Upsert the successfully embedded rows. Failed rows are retried on the next run.
+        #    MERGE fails when a target row matches several source rows, so one row is kept per id.
+        embedded_rows = f'''
+            SELECT {column_list} FROM {self.table(delta_id)}
+            WHERE embedding_status = ''
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY `{key}` ORDER BY content) = 1'''
+        if not target_exists:
+            self._run(f"CREATE TABLE {self.table(target_id)} AS {embedded_rows}")
+        elif stats['embedded']:
+            self._run(f'''
+                MERGE {self.table(target_id)} t
+                USING ({embedded_rows}) s
+                ON t.`{key}` = s.`{key}`
+                WHEN MATCHED THEN UPDATE SET {', '.join(f't.`{column}` = s.`{column}`' for column in columns if column != key)}
+                WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES ({', '.join(f's.`{column}`' for column in columns)})''')
+
+        # 3. Delete tombstoned ids, i.e. rows that are gone from the source table
+        stats['deleted'] = 0
+        if target_exists:
+            job = self._run(f'''
+                DELETE FROM {self.table(target_id)} t
+                WHERE NOT EXISTS (SELECT 1 FROM {self.table(source_id)} s WHERE s.`{key}` = t.`{key}`)''')
+            stats['deleted'] = job.num_dml_affected_rows or 0
+
+        self.bq_client.delete_table(f'{self.gcp_project_id}.{self.dataset_id}.{delta_id}', not_found_ok=True)
+        stats['seconds'] = round(time.perf_counter() - start_time, 1)
+        return stats
+
+    def _counts(self, source_id, delta_id):
+        row = list(self._run(f'''
+            SELECT
+              (SELECT COUNT(*) FROM {self.table(source_id)}) AS source_rows,
+              COUNTIF(embedding_status = '') AS embedded,
+              COUNTIF(embedding_status != '') AS failed
+            FROM {self.table(delta_id)}''').result())[0]
+        return {
+            'source_rows': row['source_rows'],
+            'skipped': row['source_rows'] - row['embedded'] - row['failed'],
+            'embedded': row['embedded'],
+            'failed': row['failed'],
+        }
+
+    def _run(self, sql):
+        job = self.bq_client.query(sql)
+        job.result()
+        return job
+
+
+if __name__=='__main__':
+    gcp_project_id = os.environ.get('GCP_PROJECT_ID','gcp_project_id_not_set')
+    dataset_id = os.environ.get('BQ_DATASET_ID','lunar_data_ds')
+    embedding_model_name = os.environ.get('EMBEDDING_MODEL_NAME','embedding_model_not_set')
+    source_ids = sys.argv[1:] or list(SOURCES)
+
+    refresher = EmbeddingRefresher(gcp_project_id, dataset_id, embedding_model_name)
+    for source_id in source_ids:
+        print(f'Refreshing {source_id}_embeddings')
+        stats = refresher.refresh(source_id)
+        print(f'{source_id}_embeddings: {json.dumps(stats)}')
+    print(f'Complete')
@@ -38,28 +38,7 @@ REMOTE WITH CONNECTION \`${BQ_CONNECTION_ID}\`
 OPTIONS (ENDPOINT = 'text-embedding-004'
 );"
 
-# Generate text embeddings for web data
-bq query --use_legacy_sql=false "
-CREATE OR REPLACE TABLE \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.webdata_embeddings\` AS (
-  SELECT 
-    * except (ml_generate_embedding_result, ml_generate_embedding_statistics, ml_generate_embedding_status),
-    ml_generate_embedding_result as text_embedding
-  FROM ML.GENERATE_EMBEDDING(
-    MODEL \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.${EMBEDDING_MODEL_NAME}\`,
-    (SELECT *, CONCAT(title, ' | ', logLine, ' | ', actors, ' | ', directors, ' | ', genres, ' | ', categories) as content FROM \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.webdata\`),
-    STRUCT(TRUE AS flatten_json_output)
-  )
-);"
-
-# Generate text embeddings for article data
-bq query --use_legacy_sql=false "
-CREATE OR REPLACE TABLE \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.articledata_embeddings\` AS (
-  SELECT 
-    * except (ml_generate_embedding_result, ml_generate_embedding_statistics, ml_generate_embedding_status),
-    ml_generate_embedding_result as text_embedding
-  FROM ML.GENERATE_EMBEDDING(
-    MODEL \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.${EMBEDDING_MODEL_NAME}\`,
-    (SELECT *, CONCAT(title, ' | ', \`desc\`) as content FROM \`${GCP_PROJECT_ID}.${BQ_DATASET_ID}.articledata\`),
-    STRUCT(TRUE AS flatten_json_output)
-  )
-);"
+# Generate text embeddings for web data and article data.
+# Only new or changed rows are embedded and merged into the existing embeddings
+# tables, so this can be rerun after every load to refresh them.
+python3 bq_embeddings_refresh.py webdata articledata
@@ -14,46 +14,92 @@
 
 # Usage: 
 # main.py <data_filepath>
+#
+# Streams the NDJSON file: lines are read lazily, parsed in a process pool and
+# written to a local Parquet file while parsing continues, then loaded with a
+# single BigQuery load job, so memory stays flat regardless of file size.
+# LOADER_WORKERS sets the number of parser processes. WRITE_DISPOSITION is
+# WRITE_TRUNCATE (default) or WRITE_APPEND. LOAD_SOURCE_FORMAT is PARQUET
+# (default, requires pyarrow) or NEWLINE_DELIMITED_JSON.
 
 import os, sys
-import requests
-from google.cloud import bigquery
+import time
 import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from google.cloud import bigquery
+from bq_bulk_load import BulkLoader, batched
+
+def as_str(value):
+    # Keeps the previous "null" text for JSON nulls without rewriting "null" inside strings
+    return 'null' if value is None else f"{value}"
+
+def parse_record(record):
+    record_clean = json.loads(record)
+    attributes = record_clean['attributes']
+    return {
+        'id': as_str(record_clean['id']),
+        'type': as_str(record_clean['type']),
+        'title': as_str(attributes['title']),
+        'lang': as_str(attributes['lang']),
+        'createdAt': as_str(attributes['createdAt']),
+        'updatedAt': as_str(attributes['updatedAt']),
+        'publishedAt': as_str(attributes['publishedAt']),
+        'slug': as_str(attributes['slug']),
+        'hash': as_str(attributes['hash']),
+        #'htmlBody': as_str(attributes['htmlBody']),
+        'desc': '' if attributes['metaDescription']==[] else as_str(attributes['metaDescription']),
+        'keywords': as_str(attributes['article']['metaKeywords']),
+        'url': f"https://support.com/en_us/'{as_str(attributes['slug'])}-{as_str(attributes['hash'])}" # TODO Update URL Prefix
+    }
+
+def parse_batch(records):
+    '''
+        Parses a batch of NDJSON lines. Runs in a worker process.
+    '''
+    jrecords = []
+    for record in records:
+        if not record.strip():
+            continue
+        try:
+            jrecords.append(parse_record(record))
+        except Exception as e:
+            print(f'[ EXCEPTION ] Unable to parse record. {e}. {record}\n')
+    return jrecords
 
 class URLToBigQuery:
-    def __init__(self, data_filepath, gcp_project_id, dataset_id, table_id):
+    def __init__(self, data_filepath, gcp_project_id, dataset_id, table_id, workers=None, parse_batch_size=2000, source_format='PARQUET'):
         self.data_filepath = data_filepath
         self.gcp_project_id = gcp_project_id
         self.dataset_id = dataset_id
         self.table_id = table_id
+        self.workers = workers or os.cpu_count() or 1
+        self.parse_batch_size = parse_batch_size
+        self.source_format = source_format
         self.bq_client = bigquery.Client(project=self.gcp_project_id)
     
     def fetch_data(self):
+        '''
+            Yields the lines of the data file one at a time.
+        '''
         try:
-            with open(data_filepath, 'r') as file:
-                data = file.read()
-            
-            return data
-        except requests.exceptions.RequestException as e:
+            with open(self.data_filepath, 'r') as file:
+                for line in file:
+                    yield line
+        except OSError as e:
             print(f"An error occurred while fetching data: {e}")
-            return None
     
-    def load_data_to_bigquery(self, records):
-        if records is None or records == []:
-            print("No data to load into BigQuery.")
-            return
-        
-        table_ref = self.bq_client.dataset(self.dataset_id).table(self.table_id)
-        
-        batch_size = 10000
-        for i in range(0, len(records), batch_size):
-            batch = records[i:i + batch_size]
-            errors = self.bq_client.insert_rows_json(table_ref, batch)
-            
-            if errors:
-                print(f"Errors occurred while loading data to BigQuery: {errors}")
-            else:
-                print(f"Batch {i // batch_size + 1} loaded successfully into BigQuery.")
+    def load_data_to_bigquery(self, records, schema, write_disposition='WRITE_TRUNCATE'):
+        '''
+            Stages records (any iterable) as Parquet while they are parsed, then runs one load job.
+        '''
+        loader = BulkLoader(self.bq_client, self.dataset_id, self.table_id, schema, write_disposition=write_disposition, source_format=self.source_format)
+        start_time = time.perf_counter()
+        stats = loader.load(records)
+        elapsed = time.perf_counter() - start_time
+        if stats['rows']:
+            print(f"Ingested {stats['rows']} rows in {elapsed:.1f}s ({stats['rows'] / elapsed:.0f} rows/s)")
+        return stats
     
     def create_table(self, schema):
         dataset_ref = self.bq_client.dataset(self.dataset_id)
@@ -68,36 +114,19 @@ class URLToBigQuery:
             print(f"An error occurred while creating the table: {e}")
     
     def process(self):
-        data = self.fetch_data()
-        if data is not None:
-            records = data.split('\n')
-            jrecords = []
-            counter = 0
-            for record in records:
-                try:
-                    record_clean = json.loads(record.replace('null','"null"'))
-                    
-                    jpayload = {
-                        'id': f"{record_clean['id']}",
-                        'type': f"{record_clean['type']}",
-                        'title': f"{record_clean['attributes']['title']}",
-                        'lang': f"{record_clean['attributes']['lang']}",
-                        'createdAt': f"{record_clean['attributes']['createdAt']}",
-                        'updatedAt': f"{record_clean['attributes']['updatedAt']}",
-                        'publishedAt': f"{record_clean['attributes']['publishedAt']}",
-                        'slug': f"{record_clean['attributes']['slug']}",
-                        'hash': f"{record_clean['attributes']['hash']}",
-                        #'htmlBody': f"{record_clean['attributes']['htmlBody']}",
-                        'desc': '' if record_clean['attributes']['metaDescription']==[] else f"{record_clean['attributes']['metaDescription']}",
-                        'keywords': f"{record_clean['attributes']['article']['metaKeywords']}",
-                        'url': f"https://support.com/en_us/'{record_clean['attributes']['slug']}-{record_clean['attributes']['hash']}" # TODO Update URL Prefix
-                    }
-                    
-                    jrecords.append(jpayload)
-                except Exception as e:
-                    print(f'[ EXCEPTION ] Unable to parse record. {e}. {record}\n')
-            
-            return jrecords
+        '''
+            Yields parsed records in file order. At most 2 x workers parse batches
+            are in flight, which bounds memory use.
+        '''
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for records in batched(self.fetch_data(), self.parse_batch_size):
+                pending.append(executor.submit(parse_batch, records))
+                if len(pending) >= self.workers * 2:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
 
 
 if __name__=='__main__':
@@ -105,7 +134,10 @@ if __name__=='__main__':
     gcp_project_id = os.environ.get('GCP_PROJECT_ID','gcp_project_id_not_set')
     dataset_id = 'lunar_data_ds'  # TODO: Create BQ Dataset
     table_id = 'articledata'
-    loader = URLToBigQuery(data_filepath, gcp_project_id, dataset_id, table_id)
+    workers = int(os.environ.get('LOADER_WORKERS', 0)) or None
+    write_disposition = os.environ.get('WRITE_DISPOSITION', 'WRITE_TRUNCATE')
+    source_format = os.environ.get('LOAD_SOURCE_FORMAT', 'PARQUET')
+    loader = URLToBigQuery(data_filepath, gcp_project_id, dataset_id, table_id, workers=workers, source_format=source_format)
     processed_records = loader.process()
     schema = [
         bigquery.SchemaField("id", "STRING", mode="NULLABLE"),
@@ -122,6 +154,5 @@ if __name__=='__main__':
         bigquery.SchemaField("keywords", "STRING", mode="NULLABLE"),
         bigquery.SchemaField("url", "STRING", mode="NULLABLE"),
     ]
-    loader.create_table(schema=schema)
-    loader.load_data_to_bigquery(processed_records)
+    loader.load_data_to_bigquery(processed_records, schema=schema, write_disposition=write_disposition)
     print(f'Complete')
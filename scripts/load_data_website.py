@@ -14,45 +14,44 @@
 
 # Usage: 
 # main.py <url>
+#
+# WRITE_DISPOSITION is WRITE_TRUNCATE (default) or WRITE_APPEND. LOAD_SOURCE_FORMAT
+# is PARQUET (default, requires pyarrow) or NEWLINE_DELIMITED_JSON.
+#
+# The catalog is crawled with FETCH_PAGE_SIZE records per page (sent as the page
+# and pageSize query parameters) and FETCH_PARALLELISM concurrent requests.
+# Completed pages are kept in FETCH_CHECKPOINT_DIR, so rerunning after a failure
+# resumes the crawl. The checkpoint is removed once the load job succeeds.
 
 import os, sys
 import requests
 from google.cloud import bigquery
-import json
+from bq_bulk_load import BulkLoader
+from paginated_fetcher import PaginatedFetcher
 
 class URLToBigQuery:
-    def __init__(self, url, gcp_project_id, dataset_id, table_id):
+    def __init__(self, url, gcp_project_id, dataset_id, table_id, source_format='PARQUET', fetcher=None):
         self.url = url
         self.gcp_project_id = gcp_project_id
         self.dataset_id = dataset_id
         self.table_id = table_id
+        self.source_format = source_format
+        self.fetcher = fetcher or PaginatedFetcher(url)
         self.bq_client = bigquery.Client(project=self.gcp_project_id)
     
     def fetch_data(self):
+        '''
+            Yields raw catalog records as pages arrive.
+        '''
         try:
-            response = requests.get(self.url)
-            response.raise_for_status()
-            return response.json()
+            yield from self.fetcher.fetch_records()
         except requests.exceptions.RequestException as e:
-            print(f"An error occurred while fetching data: {e}")
-            return None
+            print(f"An error occurred while fetching data: {e}. Rerun to resume from the checkpoint.")
+            raise
     
-    def load_data_to_bigquery(self, records):
-        if records is None or records == []:
-            print("No data to load into BigQuery.")
-            return
-        
-        table_ref = self.bq_client.dataset(self.dataset_id).table(self.table_id)
-        
-        batch_size = 10000
-        for i in range(0, len(records), batch_size):
-            batch = records[i:i + batch_size]
-            errors = self.bq_client.insert_rows_json(table_ref, batch)
-            
-            if errors:
-                print(f"Errors occurred while loading data to BigQuery: {errors}")
-            else:
-                print(f"Batch {i // batch_size + 1} loaded successfully into BigQuery.")
+    def load_data_to_bigquery(self, records, schema, write_disposition='WRITE_TRUNCATE'):
+        loader = BulkLoader(self.bq_client, self.dataset_id, self.table_id, schema, write_disposition=write_disposition, source_format=self.source_format)
+        return loader.load(records or [])
     
     def create_table(self, schema):
         dataset_ref = self.bq_client.dataset(self.dataset_id)
@@ -67,38 +66,39 @@ class URLToBigQuery:
             print(f"An error occurred while creating the table: {e}")
     
     def process(self):
-        json_data = self.fetch_data()
-        if json_data is not None:
-            if isinstance(json_data, dict):
-                records = json_data['playContentArray']['playContents']
-                processed_records = []
-                for r in records:
-                    jpayload = {
-                        'contentId': f"{r.get('contentId')}",
-                        'mediaId': f"{r.get('mediaId','')}",
-                        'title': f"{r.get('title')}",
-                        'runtime': f"{r.get('runtime','')}",
-                        'formattedRuntime': f"{r.get('formattedRuntime')}",
-                        'logLine': f"{r.get('logLine')}",
-                        'releaseYear': f"{r.get('releaseYear')}",
-                        'studioId': f"{r.get('studioId')}",
-                        'actors': f"{r.get('actors')}",
-                        'directors': f"{r.get('directors')}",
-                        'genres': f"{r.get('genres')}",
-                        'categories': f"{r.get('categories')}",
-                    }
-                    processed_records.append(jpayload)
-                
-                #self.load_data_to_bigquery(processed_records)
-                return processed_records
-
+        for r in self.fetch_data():
+            jpayload = {
+                'contentId': f"{r.get('contentId')}",
+                'mediaId': f"{r.get('mediaId','')}",
+                'title': f"{r.get('title')}",
+                'runtime': f"{r.get('runtime','')}",
+                'formattedRuntime': f"{r.get('formattedRuntime')}",
+                'logLine': f"{r.get('logLine')}",
+                'releaseYear': f"{r.get('releaseYear')}",
+                'studioId': f"{r.get('studioId')}",
+                'actors': f"{r.get('actors')}",
+                'directors': f"{r.get('directors')}",
+                'genres': f"{r.get('genres')}",
+                'categories': f"{r.get('categories')}",
+            }
+            yield jpayload
 
 if __name__=='__main__':
     url = sys.argv[1]
     gcp_project_id = os.environ.get('GCP_PROJECT_ID','gcp_project_id_not_set')
     dataset_id = 'lunar_data_ds'  # TODO: Create BQ Dataset
     table_id = 'webdata'
-    loader = URLToBigQuery(url, gcp_project_id, dataset_id, table_id)
+    write_disposition = os.environ.get('WRITE_DISPOSITION', 'WRITE_TRUNCATE')
+    source_format = os.environ.get('LOAD_SOURCE_FORMAT', 'PARQUET')
+    fetcher = PaginatedFetcher(
+        url,
+        page_size=int(os.environ.get('FETCH_PAGE_SIZE', 500)),
+        parallelism=int(os.environ.get('FETCH_PARALLELISM', 8)),
+        max_retries=int(os.environ.get('FETCH_MAX_RETRIES', 5)),
+        checkpoint_dir=os.environ.get('FETCH_CHECKPOINT_DIR', f'.{table_id}_crawl'),
+        max_pages=int(os.environ.get('FETCH_MAX_PAGES', 1000)),
+    )
+    loader = URLToBigQuery(url, gcp_project_id, dataset_id, table_id, source_format=source_format, fetcher=fetcher)
     processed_records = loader.process()
     schema = [
         bigquery.SchemaField("contentId", "STRING", mode="NULLABLE"),
@@ -114,6 +114,6 @@ if __name__=='__main__':
         bigquery.SchemaField("genres", "STRING", mode="NULLABLE"),
         bigquery.SchemaField("categories", "STRING", mode="NULLABLE"),
     ]
-    loader.create_table(schema=schema)
-    loader.load_data_to_bigquery(processed_records)
+    loader.load_data_to_bigquery(processed_records, schema=schema, write_disposition=write_disposition)
+    fetcher.clear_checkpoint()
     print(f'Complete')
@@ -0,0 +1,182 @@
+# Copyright 2024 Google LLC All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Concurrent, resumable page crawler used by load_data_website.py.
+
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PaginatedFetcher:
+    '''
+        Yields catalog records page by page.
+
+        Page 1 is fetched first. If it is full (page_size records), the remaining
+        pages are fetched with up to parallelism requests in flight over one pooled
+        session, until a short page marks the end. A server that ignores the paging
+        parameters (more than page_size records on page 1) is read as a single page.
+        A page that starts with a record already seen on another page (a server
+        that ignores or clamps the page number) also ends the crawl, and the crawl
+        never goes past max_pages.
+
+        Failed requests (connection errors, 429 and 5xx) are retried up to
+        max_retries times with exponential backoff, honouring Retry-After. Each
+        completed page is written to checkpoint_dir, so a crawl that is interrupted
+        resumes from the pages it already has. clear_checkpoint() removes it once
+        the records have been loaded.
+    '''
+
+    def __init__(self, url, page_size=500, parallelism=8, max_retries=5, backoff_seconds=0.5, timeout=30, checkpoint_dir=None,
+                 page_param='page', page_size_param='pageSize', records_path=('playContentArray', 'playContents'),
+                 record_key='contentId', max_pages=1000):
+        self.url = url
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.record_key = record_key
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.checkpoint_dir = checkpoint_dir
+        self.page_param = page_param
+        self.page_size_param = page_size_param
+        self.records_path = records_path
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_seconds,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET',),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=parallelism, pool_maxsize=parallelism, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pages_fetched = 0
+        self.pages_resumed = 0
+
+    def fetch_records(self):
+        state = self._load_state()
+        # First record key of each page, to spot a page the server has already returned
+        first_keys = {}
+
+        if 1 in state['done_pages']:
+            records = self._read_page(1)
+            self.pages_resumed += 1
+        else:
+            records = self._fetch_page(1)
+            self.pages_fetched += 1
+            if len(records) != self.page_size or self.max_pages <= 1:
+                state['last_page'] = 1
+            self._save_page(1, records, state)
+        if records:
+            first_keys[self._first_key(records)] = 1
+        yield from records
+
+        next_page = 2
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            while True:
+                while len(in_flight) < self.parallelism and next_page <= min(state['last_page'] or self.max_pages, self.max_pages):
+                    if next_page in state['done_pages']:
+                        self.pages_resumed += 1
+                        records = self._read_page(next_page)
+                        if records:
+                            first_keys.setdefault(self._first_key(records), next_page)
+                        yield from records
+                    else:
+                        in_flight[executor.submit(self._fetch_page, next_page)] = next_page
+                    next_page += 1
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    page = in_flight.pop(future)
+                    records = future.result()
+                    self.pages_fetched += 1
+                    if state['last_page'] is not None and page > state['last_page']:
+                        continue
+                    if records and first_keys.setdefault(self._first_key(records), page) != page:
+                        print(f'Page {page} repeats page {first_keys[self._first_key(records)]}. Stopping at page {page - 1}')
+                        state['last_page'] = page - 1
+                        continue
+                    if len(records) < self.page_size or page == self.max_pages:
+                        state['last_page'] = page
+                    self._save_page(page, records, state)
+                    yield from records
+
+        if state['last_page'] == self.max_pages:
+            print(f'Stopped at max_pages ({self.max_pages}). Raise max_pages if the catalog is larger')
+        print(f'Fetched {self.pages_fetched} pages, resumed {self.pages_resumed} pages from checkpoint')
+
+    def _first_key(self, records):
+        return json.dumps(records[0].get(self.record_key, records[0]), sort_keys=True, default=str)
+
+    def _fetch_page(self, page):
+        params = {self.page_param: page, self.page_size_param: self.page_size}
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        payload = response.json()
+        for key in self.records_path:
+            payload = payload.get(key) or {}
+        return payload or []
+
+    def _load_state(self):
+        state = {'done_pages': set(), 'last_page': None}
+        if not self.checkpoint_dir:
+            return state
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        state_path = os.path.join(self.checkpoint_dir, 'state.json')
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                saved = json.load(file)
+            if saved.get('url') == self.url and saved.get('page_size') == self.page_size:
+                state['last_page'] = saved.get('last_page')
+                state['done_pages'] = {
+                    int(filename[len('page_'):-len('.json')]) for filename in os.listdir(self.checkpoint_dir)
+                    if filename.startswith('page_') and filename.endswith('.json')
+                }
+                print(f"Resuming crawl with {len(state['done_pages'])} pages from {self.checkpoint_dir}")
+            else:
+                self.clear_checkpoint()
+                os.makedirs(self.checkpoint_dir, exist_ok=True)
+        return state
+
+    def _save_page(self, page, records, state):
+        state['done_pages'].add(page)
+        if not self.checkpoint_dir:
+            return
+        # Write then rename so a page file is either complete or absent
+        self._write_json(os.path.join(self.checkpoint_dir, f'page_{page}.json'), records)
+        self._write_json(os.path.join(self.checkpoint_dir, 'state.json'), {'url': self.url, 'page_size': self.page_size, 'last_page': state['last_page']})
+
+    def _read_page(self, page):
+        with open(os.path.join(self.checkpoint_dir, f'page_{page}.json')) as file:
+            return json.load(file)
+
+    def _write_json(self, path, payload):
+        with open(path + '.tmp', 'w') as file:
+            json.dump(payload, file)
+        os.replace(path + '.tmp', path)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_dir:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)